@@ -0,0 +1,653 @@
+# --- START OF FILE bench.py ---
+"""
+Офлайн-бенчмарк: прогон синтетической или записанной переписки через handle_message и background_tasks
+с поддельным Telegram и заглушкой модели. Ни сети, ни ключей не нужно; состояние чатов — во временной папке.
+
+    python bench.py                                   # синтетика, параметры по умолчанию
+    python bench.py --replay state.db --chats 4       # реплики пользователя из архива чата
+    python bench.py --save base.json                  # сохранить результат...
+    python bench.py --compare base.json               # ...и сравнить с ним после изменений
+
+Результаты сравнимы между коммитами при одинаковых параметрах и --seed.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import sqlite3
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+
+# config требует переменные окружения — для бенчмарка хватит фиктивных
+os.environ.setdefault("TELEGRAM_TOKEN", "bench:token")
+os.environ.setdefault("ALLOWED_USER_ID", "1")
+os.environ.setdefault("API_KEY_1", "bench-key")
+os.environ.setdefault("METRICS_PORT", "0")
+
+import config
+import bot_ai
+import bot_metrics
+from bot_llm import LLMProvider, LLMResponse, LLMError, LLMClient, KeyPool
+from bot_state import StateManager
+from bot_storage import create_backend
+from bot_registry import ChatStateRegistry
+from bot_outbox import OutboundDispatcher
+from bot_handlers import ChatInbox, handle_message, background_tasks
+
+logger = logging.getLogger("bench")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STALL_SECONDS = 0.02
+
+TOPICS = ["работа", "отпуск", "кот", "сериал", "спортзал", "дедлайн", "мама", "машина", "дача", "концерт",
+          "книга", "переезд", "собеседование", "день рождения", "ремонт", "велосипед", "английский", "диета"]
+USER_PHRASES = [
+    "привет, как ты?", "сегодня опять {topic}, устал", "слушай, что думаешь про {topic}", "ахах да",
+    "не знаю даже", "короче {topic} отменился", "ну и денёк", "а ты чем занят", "напомни мне про {topic} через час",
+    "вчера весь вечер думал про {topic}", "ладно, пойду", "ты серьёзно?", "хочу в {topic} на выходных",
+    "мне кажется, {topic} — это надолго", "ок", "спасибо, правда помогло",
+]
+RECALL_PHRASES = ["помнишь, я тебе говорил про {topic}?", "мы же обсуждали {topic}, что я тогда решил?",
+                  "вспомни, что было с {topic}"]
+BOT_PHRASES = ["ого", "понимаю", "звучит как план", "ну ты даёшь", "расскажи подробнее", "хах", "держись",
+               "а что с {topic}?", "я бы тоже устал", "главное не торопись"]
+
+
+def _percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _parse_distribution(spec):
+    """fixed:0.8 | uniform:0.3,1.5 | lognormal:медиана,sigma | normal:mu,sd"""
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(*values)
+    if kind == "lognormal" and len(values) == 2:
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    if kind == "normal" and len(values) == 2:
+        return lambda rng: max(0.0, rng.gauss(*values))
+    raise argparse.ArgumentTypeError(f"Неизвестное распределение задержки: {spec}")
+
+
+# --- Заглушка модели ---
+
+class StubProvider(LLMProvider):
+    """
+    Провайдер-заглушка: задержка из заданного распределения, доля ошибок и битого JSON.
+    Тип вызова определяется по маркерам промпта, ответ — правдоподобный для этого типа.
+    """
+    name = "stub"
+
+    def __init__(self, latency, seed=0, failure_rate=0.0, malformed_rate=0.0, garbage_rate=0.0, memory_rate=0.0,
+                 task_rate=0.0, chunks=4):
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.failure_rate = failure_rate
+        self.malformed_rate = malformed_rate
+        self.garbage_rate = garbage_rate
+        self.memory_rate = memory_rate
+        self.task_rate = task_rate
+        self.chunks = chunks
+        self.calls = Counter()
+        self.failures = 0
+        self.prompt_chars = 0
+
+    @staticmethod
+    def classify(prompt):
+        if "<SYSTEM_SUMMARY>" in prompt:
+            return "summary"
+        if "<SYSTEM_REFLECT>" in prompt:
+            return "reflection"
+        if prompt.startswith("Ответ AI содержит ошибку"):
+            return "repair"
+        if "<MEMORY_CONTEXT>" in prompt:
+            return "memory"
+        return "chat"
+
+    def _text(self, kind):
+        topic = self.rng.choice(TOPICS)
+        if kind == "summary":
+            return f"Пользователь рассказывал про {topic}, договорились вернуться к этому позже."
+        if kind == "reflection":
+            return json.dumps({"thoughts": [f"интересно, как у него с {topic}"]}, ensure_ascii=False)
+        replies = [self.rng.choice(BOT_PHRASES).format(topic=topic) for _ in range(self.rng.randint(1, 3))]
+        data = {
+            "replies": replies, "mood_shift": round(self.rng.uniform(-0.1, 0.2), 2), "add_task": None,
+            "ignored_topic_keywords": None, "used_thought_id": None, "is_offended": False, "forgive": False,
+            "memory_query_topic": None,
+        }
+        if kind == "chat" and self.rng.random() < self.memory_rate:
+            data["memory_query_topic"] = topic
+        if self.rng.random() < self.task_rate:
+            data["add_task"] = {"text": f"спросить про {topic}", "minutes": 600, "priority": "low"}
+        text = json.dumps(data, ensure_ascii=False)
+        if kind != "repair":
+            roll = self.rng.random()
+            if roll < self.garbage_rate:
+                # Локально не чинится — уйдёт в удалённый ремонт
+                return f"ну {replies[0]}, короче"
+            if roll < self.garbage_rate + self.malformed_rate:
+                # Обрыв посреди ответа и висячая запятая — чинится локально
+                return text[:text.index('"mood_shift"')] + ','
+        return text
+
+    def _respond(self, prompt):
+        kind = self.classify(prompt)
+        self.calls[kind] += 1
+        self.prompt_chars += len(prompt)
+        delay = self.latency(self.rng)
+        failed = self.rng.random() < self.failure_rate
+        return kind, delay, failed, self._text(kind)
+
+    async def generate(self, prompt, temperature, api_key, response_schema=None):
+        kind, delay, failed, text = self._respond(prompt)
+        await asyncio.sleep(delay)
+        if failed:
+            self.failures += 1
+            raise LLMError("Заглушка: сбой сервера", kind="server")
+        return LLMResponse([text], prompt_tokens=len(prompt) // 4, output_tokens=len(text) // 4)
+
+    async def stream(self, prompt, temperature, api_key, response_schema=None):
+        kind, delay, failed, text = self._respond(prompt)
+        step = max(1, len(text) // self.chunks + 1)
+        for start in range(0, len(text), step):
+            await asyncio.sleep(delay / self.chunks)
+            if failed:
+                self.failures += 1
+                raise LLMError("Заглушка: обрыв потока", kind="server")
+            yield text[start:start + step]
+
+
+# --- Поддельный Telegram ---
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+        self.type = "private" if chat_id > 0 else "group"
+
+
+class FakeMessage:
+    def __init__(self, message_id, chat, text):
+        self.message_id = message_id
+        self.chat = chat
+        self.text = text
+
+
+class FakeUpdate:
+    def __init__(self, update_id, message):
+        self.update_id = update_id
+        self.message = message
+        self.effective_chat = message.chat
+
+
+class FakeContext:
+    """Подмножество CallbackContext, которое читают обработчики."""
+    def __init__(self, bot, bot_data):
+        self.bot = bot
+        self.bot_data = bot_data
+
+
+class FakeBot:
+    """Записывает исходящие сообщения и меряет время от сообщения пользователя до первого ответа."""
+    def __init__(self, send_latency=0.0):
+        self.send_latency = send_latency
+        self.sent = Counter()
+        self.chat_actions = 0
+        self.latencies = []
+        self._waiting = {}
+        self._replied = {}
+
+    def expect_reply(self, chat_id):
+        self._waiting.setdefault(chat_id, []).append(time.monotonic())
+        event = self._replied.setdefault(chat_id, asyncio.Event())
+        event.clear()
+        return event
+
+    def unanswered(self):
+        return sum(len(waiting) for waiting in self._waiting.values())
+
+    async def send_chat_action(self, chat_id, action):
+        self.chat_actions += 1
+        await asyncio.sleep(self.send_latency)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.send_latency)
+        self.sent[chat_id] += 1
+        now = time.monotonic()
+        self.latencies.extend(now - started for started in self._waiting.pop(chat_id, ()))
+        if event := self._replied.get(chat_id):
+            event.set()
+
+
+# --- Замеры ---
+
+def _payload_bytes(payload):
+    if payload is None:
+        return 0
+    if isinstance(payload, str):
+        return len(payload.encode('utf-8'))
+    if isinstance(payload, bytes):
+        return len(payload)
+    if isinstance(payload, dict):
+        return sum(_payload_bytes(k) + _payload_bytes(v) for k, v in payload.items())
+    if isinstance(payload, (list, tuple)):
+        return sum(_payload_bytes(item) for item in payload)
+    return 8
+
+
+class MeteredBackend:
+    """Обёртка над хранилищем: считает сбросы и объём того, что уходит на запись."""
+    def __init__(self, backend, stats):
+        self.backend = backend
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def write(self, payload):
+        size = _payload_bytes(payload)
+        with self.stats["lock"]:
+            self.stats["flushes"] += 1
+            self.stats["bytes"] += size
+        self.backend.write(payload)
+
+
+class LoopMonitor:
+    """Блокировки цикла событий: на сколько опаздывает короткий sleep."""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.blocked = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - started - self.interval
+            # Погрешность таймера меньше миллисекунды не считаем
+            if lag > 0.001:
+                self.blocked += lag
+                self.max_lag = max(self.max_lag, lag)
+                self.stalls += lag > STALL_SECONDS
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+# --- Переписка ---
+
+def synthetic_conversation(rng, messages, burst_rate, recall_rate):
+    """Список (роль, текст): серии подряд идущих реплик пользователя уходят пачкой."""
+    turns = []
+    for _ in range(messages):
+        topic = rng.choice(TOPICS)
+        phrases = RECALL_PHRASES if rng.random() < recall_rate else USER_PHRASES
+        turns.append(("user", rng.choice(phrases).format(topic=topic)))
+        if rng.random() < burst_rate:
+            turns.append(("user", rng.choice(USER_PHRASES).format(topic=rng.choice(TOPICS))))
+        turns.append(("model", rng.choice(BOT_PHRASES).format(topic=topic)))
+    return turns
+
+
+def load_recorded(path):
+    """Переписка из архива чата (state.db / state.json) или JSONL с полями role и text."""
+    if path.endswith(".db"):
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            rows = conn.execute("SELECT role, content FROM messages ORDER BY id").fetchall()
+        finally:
+            conn.close()
+        return [(role, text) for role, text in rows]
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith(".jsonl"):
+            records = [json.loads(line) for line in f if line.strip()]
+            return [(r.get("role", "user"), r["text"]) for r in records]
+        state = json.load(f)
+    return [(m["role"], m["content"]) for m in state.get("reflection_history", [])]
+
+
+def to_bursts(conversation):
+    bursts, current = [], []
+    for role, text in conversation:
+        if role == "user" and text:
+            current.append(text)
+        elif current:
+            bursts.append(current)
+            current = []
+    if current:
+        bursts.append(current)
+    return bursts
+
+
+# --- Прогон ---
+
+async def simulate_user(chat_id, bursts, ctx, bot, rng, args, update_ids):
+    for burst in bursts:
+        replied = None
+        for i, text in enumerate(burst):
+            if i:
+                await asyncio.sleep(rng.uniform(0.1, 0.5))
+            replied = bot.expect_reply(chat_id)
+            update_id = next(update_ids)
+            update = FakeUpdate(update_id, FakeMessage(update_id, FakeChat(chat_id), text))
+            await handle_message(update, ctx)
+        # Замкнутая модель: пользователь ждёт ответа, потом думает
+        try:
+            await asyncio.wait_for(replied.wait(), args.reply_timeout)
+        except asyncio.TimeoutError:
+            pass
+        await asyncio.sleep(rng.expovariate(1 / args.think) if args.think > 0 else 0)
+
+
+async def run_background(ctx, interval, stop):
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            await background_tasks(ctx)
+
+
+async def run_bench(args):
+    rng = random.Random(args.seed)
+    # Опечатки и прочая "человечность" берут random из модуля — фиксируем и его
+    random.seed(args.seed)
+
+    stub = StubProvider(
+        args.latency, seed=args.seed, failure_rate=args.failure_rate, malformed_rate=args.malformed_rate,
+        garbage_rate=args.garbage_rate, memory_rate=args.memory_rate, task_rate=args.task_rate,
+    )
+    bot_ai.llm_client = LLMClient(stub, timeout=config.LLM_TIMEOUT_SECONDS, max_concurrency=config.LLM_MAX_CONCURRENCY,
+                                  on_service=bot_ai.admission.record)
+    bot_ai.key_pool = KeyPool([f"bench-{i}" for i in range(args.keys)], rpm=args.key_rpm, burst=args.key_burst,
+                              max_cooldown=config.KEY_MAX_COOLDOWN_SECONDS)
+    if args.background_interval > 0:
+        # Рефлексия на каждом фоновом проходе, а не раз в час после тишины
+        config.SILENCE_BEFORE_REFLECTION_HOURS = 0
+        config.REFLECTION_INTERVAL_HOURS = 0
+    config.CHAT_DEADLINE_SECONDS = args.deadline
+
+    workdir = tempfile.mkdtemp(prefix="tg_bot_bench_")
+    write_stats = {"lock": threading.Lock(), "flushes": 0, "bytes": 0}
+
+    def build_state_manager(chat_id):
+        directory = os.path.join(workdir, str(chat_id))
+        os.makedirs(directory, exist_ok=True)
+        state_file = os.path.join(directory, config.STATE_FILE)
+        backend = create_backend(args.backend, state_file, os.path.join(directory, config.STATE_DB_FILE))
+        return StateManager(
+            state_file,
+            backend=MeteredBackend(backend, write_stats),
+            durability=args.durability,
+            coalesce_ms=config.STATE_COALESCE_MS,
+            flush_interval=config.STATE_FLUSH_INTERVAL_SECONDS,
+            semantic_index_file=os.path.join(directory, config.SEMANTIC_INDEX_FILE),
+            semantic_dim=config.SEMANTIC_DIM,
+            memory_snapshot_file=os.path.join(directory, config.MEMORY_SNAPSHOT_FILE),
+        )
+
+    chat_ids = [1000 + i for i in range(args.chats)]
+    if args.replay:
+        recorded = to_bursts(load_recorded(args.replay))
+        if not recorded:
+            raise SystemExit(f"В {args.replay} нет сообщений пользователя.")
+        # Каждый чат проигрывает запись со своего места, чтобы чаты не шли в ногу
+        conversations = {
+            chat_id: [recorded[(n * len(recorded) // args.chats + i) % len(recorded)] for i in range(args.messages)]
+            for n, chat_id in enumerate(chat_ids)
+        }
+    else:
+        conversations = {
+            chat_id: to_bursts(synthetic_conversation(rng, args.messages, args.burst_rate, args.recall_rate))
+            for chat_id in chat_ids
+        }
+
+    registry = ChatStateRegistry(build_state_manager, chat_ids, max_active=config.STATE_MAX_ACTIVE_CHATS,
+                                 memory_budget=config.STATE_MEMORY_BUDGET_MESSAGES)
+    inbox = ChatInbox(debounce=args.debounce, max_wait=args.max_wait, supersede=config.INBOUND_SUPERSEDE)
+    bot = FakeBot(send_latency=args.send_latency)
+    outbox = OutboundDispatcher(
+        bot,
+        global_rate=config.OUTBOX_GLOBAL_RATE,
+        global_burst=config.OUTBOX_GLOBAL_BURST,
+        chat_rate=config.OUTBOX_CHAT_RATE,
+        chat_burst=config.OUTBOX_CHAT_BURST,
+        group_rate=config.OUTBOX_GROUP_PER_MINUTE / 60,
+        max_retries=config.OUTBOX_MAX_RETRIES,
+    )
+    ctx = FakeContext(bot, {
+        "chat_registry": registry,
+        "chat_inbox": inbox,
+        "outbox": outbox,
+        "process_user_input": bot_ai.process_user_input,
+        "retrieve_memory": bot_ai.retrieve_memory,
+        "respond_to_user": bot_ai.respond_to_user,
+        "generate_reflection": bot_ai.generate_reflection,
+        "admission": bot_ai.admission,
+    })
+
+    try:
+        # Подготовка (не замеряется): архив сообщений, чтобы поиск по памяти и рефлексия работали не вхолостую
+        for chat_id in chat_ids:
+            async with registry.use(chat_id) as state_manager:
+                for role, text in synthetic_conversation(rng, args.history // 2, 0.0, 0.0):
+                    await state_manager.add_history(role, text)
+        # Чаты выгружаются: прогон начнётся с холодной загрузки, а размер на диске — с устоявшихся файлов
+        await registry.close()
+        bot_metrics.reset_metrics()
+        stub.calls.clear()
+        stub.failures = stub.prompt_chars = 0
+        write_stats["flushes"] = write_stats["bytes"] = 0
+        disk_before = _dir_size(workdir)
+
+        monitor = LoopMonitor()
+        monitor.start()
+        stop_background = asyncio.Event()
+        background = asyncio.create_task(run_background(ctx, args.background_interval, stop_background)) \
+            if args.background_interval > 0 else None
+        update_ids = iter(range(1, 10 ** 9))
+        started = time.monotonic()
+        await asyncio.gather(*(
+            simulate_user(chat_id, conversations[chat_id], ctx, bot, random.Random(args.seed + chat_id), args, update_ids)
+            for chat_id in chat_ids
+        ))
+        await inbox.join()
+        await outbox.join()
+        elapsed = time.monotonic() - started
+        stop_background.set()
+        if background is not None:
+            await background
+        await monitor.stop()
+    finally:
+        await inbox.close()
+        await outbox.close()
+        await registry.close()
+        await bot_ai.llm_client.aclose()
+
+    disk_after = _dir_size(workdir)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    user_messages = sum(len(burst) for bursts in conversations.values() for burst in bursts)
+    stages = {
+        dict(key)["stage"]: {"count": count, "mean_ms": round(total / count * 1000, 2), "total_s": round(total, 3)}
+        for key, (_, total, count) in bot_metrics.stage_seconds.series.items() if count
+    }
+    return {
+        "commit": _git_commit(),
+        "params": {name: value for name, value in vars(args).items()
+                   if name not in ("latency", "latency_spec", "save", "compare", "verbose")} | {"latency": args.latency_spec},
+        "messages": user_messages,
+        "turns": bot_metrics.requests_total.values.get((("kind", "chat"),), 0),
+        "unanswered": bot.unanswered(),
+        "elapsed_s": round(elapsed, 2),
+        "latency_s": {
+            "p50": _round(_percentile(bot.latencies, 0.50)),
+            "p95": _round(_percentile(bot.latencies, 0.95)),
+            "p99": _round(_percentile(bot.latencies, 0.99)),
+            "max": _round(max(bot.latencies, default=None)),
+        },
+        "llm_calls_per_message": round(sum(stub.calls.values()) / max(1, user_messages), 3),
+        "llm_calls": dict(stub.calls),
+        "llm_failures": stub.failures,
+        "prompt_chars_per_call": round(stub.prompt_chars / max(1, sum(stub.calls.values()))),
+        "hedges": sum(bot_metrics.hedges_total.values.values()),
+        "json_outcomes": {dict(key)["outcome"]: value for key, value in bot_metrics.json_repairs_total.values.items()},
+        "shed": {dict(key)["work"]: value for key, value in bot_metrics.admission_shed_total.values.items()},
+        "state_flushes": write_stats["flushes"],
+        "state_bytes_written": write_stats["bytes"],
+        "state_disk_growth_bytes": disk_after - disk_before,
+        "loop_blocked_s": round(monitor.blocked, 3),
+        "loop_max_stall_ms": round(monitor.max_lag * 1000, 1),
+        "loop_stalls": monitor.stalls,
+        "stages": stages,
+    }
+
+
+def _round(value):
+    return None if value is None else round(value, 3)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# --- Отчёт ---
+
+COMPARED = (
+    ("p50, s", lambda r: r["latency_s"]["p50"]),
+    ("p95, s", lambda r: r["latency_s"]["p95"]),
+    ("p99, s", lambda r: r["latency_s"]["p99"]),
+    ("вызовов модели на сообщение", lambda r: r["llm_calls_per_message"]),
+    ("символов промпта на вызов", lambda r: r["prompt_chars_per_call"]),
+    ("сбросов состояния", lambda r: r["state_flushes"]),
+    ("записано в состояние, байт", lambda r: r["state_bytes_written"]),
+    ("блокировка цикла, s", lambda r: r["loop_blocked_s"]),
+    ("макс. блокировка, ms", lambda r: r["loop_max_stall_ms"]),
+)
+
+
+def format_report(result):
+    p = result["params"]
+    latency = result["latency_s"]
+    lines = [
+        f"коммит {result['commit']} | seed {p['seed']} | чатов {p['chats']} × {p['messages']} ходов | "
+        f"модель {p['latency']}, сбоев {p['failure_rate']:.0%}, битого JSON {p['malformed_rate']:.0%}+{p['garbage_rate']:.0%}",
+        f"сообщений: {result['messages']} (ходов: {result['turns']}, без ответа: {result['unanswered']}), "
+        f"время прогона: {result['elapsed_s']} s",
+        f"задержка до первого ответа, s: p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  max {latency['max']}",
+        f"вызовов модели на сообщение: {result['llm_calls_per_message']} "
+        f"({', '.join(f'{kind} {count}' for kind, count in sorted(result['llm_calls'].items()))}; "
+        f"сбоев {result['llm_failures']}, хеджей {result['hedges']}), символов промпта на вызов: {result['prompt_chars_per_call']}",
+        f"разбор JSON: {', '.join(f'{k} {v}' for k, v in sorted(result['json_outcomes'].items())) or '—'}",
+        f"отложено из-за нагрузки: {', '.join(f'{k} {v}' for k, v in sorted(result.get('shed', {}).items())) or '—'}",
+        f"состояние: сбросов {result['state_flushes']}, записано {result['state_bytes_written'] / 1024:.1f} KB, "
+        f"рост на диске {result['state_disk_growth_bytes'] / 1024:.1f} KB",
+        f"цикл событий: заблокирован {result['loop_blocked_s']} s, макс. {result['loop_max_stall_ms']} ms, "
+        f"задержек > {STALL_SECONDS * 1000:.0f} ms: {result['loop_stalls']}",
+        "этапы (среднее, ms × число):",
+    ]
+    for name, values in sorted(result["stages"].items(), key=lambda item: -item[1]["total_s"]):
+        lines.append(f"  {name:<14} {values['mean_ms']:>9.2f} × {values['count']}")
+    return "\n".join(lines)
+
+
+def format_comparison(base, result):
+    lines = [f"сравнение с {base['commit']}:"]
+    if base["params"] != result["params"]:
+        lines.append("  ⚠️ параметры прогонов отличаются — сравнение условное")
+    for label, get in COMPARED:
+        old, new = get(base), get(result)
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old:+.1%}" if old else "—"
+        lines.append(f"  {label:<30} {old:>12} → {new:<12} {change}")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота с заглушками Telegram и модели.")
+    parser.add_argument("--chats", type=int, default=8, help="одновременных чатов")
+    parser.add_argument("--messages", type=int, default=12, help="ходов пользователя на чат")
+    parser.add_argument("--replay", help="state.db / state.json / .jsonl с перепиской вместо синтетики")
+    parser.add_argument("--history", type=int, default=300, help="сообщений в архиве каждого чата до прогона")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--think", type=float, default=1.0, help="средняя пауза пользователя после ответа, s")
+    parser.add_argument("--burst-rate", type=float, default=0.2, help="доля ходов из двух сообщений подряд")
+    parser.add_argument("--recall-rate", type=float, default=0.1, help="доля просьб вспомнить")
+    parser.add_argument("--reply-timeout", type=float, default=60.0)
+    parser.add_argument("--deadline", type=float, default=config.CHAT_DEADLINE_SECONDS, help="срок хода диалога, s")
+    parser.add_argument("--latency", dest="latency_spec", default="lognormal:0.8,0.35",
+                        help="задержка модели: fixed:x | uniform:a,b | lognormal:медиана,sigma | normal:mu,sd")
+    parser.add_argument("--failure-rate", type=float, default=0.02)
+    parser.add_argument("--malformed-rate", type=float, default=0.05, help="битый JSON, который чинится локально")
+    parser.add_argument("--garbage-rate", type=float, default=0.01, help="ответ не JSON — нужен удалённый ремонт")
+    parser.add_argument("--memory-rate", type=float, default=0.05, help="доля ответов с memory_query_topic")
+    parser.add_argument("--task-rate", type=float, default=0.05, help="доля ответов с add_task")
+    parser.add_argument("--keys", type=int, default=3)
+    parser.add_argument("--key-rpm", type=float, default=600)
+    parser.add_argument("--key-burst", type=float, default=20)
+    parser.add_argument("--send-latency", type=float, default=0.05, help="задержка API Telegram на отправку, s")
+    parser.add_argument("--debounce", type=float, default=config.INBOUND_DEBOUNCE_SECONDS)
+    parser.add_argument("--max-wait", type=float, default=config.INBOUND_MAX_WAIT_SECONDS)
+    parser.add_argument("--background-interval", type=float, default=10.0, help="период background_tasks, s; 0 — выкл.")
+    parser.add_argument("--backend", default=config.STATE_BACKEND, choices=("sqlite", "json"))
+    parser.add_argument("--durability", default=config.STATE_DURABILITY, choices=("immediate", "coalesce", "periodic"))
+    parser.add_argument("--save", help="сохранить результат в JSON")
+    parser.add_argument("--compare", help="сравнить с сохранённым результатом")
+    parser.add_argument("--verbose", action="store_true", help="логи бота уровня INFO")
+    args = parser.parse_args(argv)
+    args.latency = _parse_distribution(args.latency_spec)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format='%(asctime)s | %(levelname)s | %(name)s | %(message)s',
+        datefmt='%H:%M:%S',
+    )
+    # Файл промпта ищется относительно рабочей папки
+    os.chdir(BASE_DIR)
+    result = asyncio.run(run_bench(args))
+    print(format_report(result))
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            print(format_comparison(json.load(f), result))
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
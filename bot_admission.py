@@ -0,0 +1,127 @@
+# --- START OF FILE bot_admission.py ---
+
+import time
+import logging
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+import bot_metrics
+
+logger = logging.getLogger(__name__)
+
+# Срок текущего хода (time.monotonic()); задачи, созданные внутри хода, наследуют его через контекст
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds):
+    """Срок хода диалога: вызовы модели внутри не начинаются, если заведомо к нему не успеют."""
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Секунды до срока текущего хода; None — срока нет (фоновая работа, напоминания)."""
+    value = _deadline.get()
+    return None if value is None else value - time.monotonic()
+
+
+class AdmissionController:
+    """
+    Контроль нагрузки на модель: вызовы в полёте (сверх LLM_MAX_CONCURRENCY они стоят в очереди),
+    задержки за последнее окно и доступность ключей. Под давлением откладывается необязательная работа —
+    рефлексия, проактивные задачи, хеджи, спекулятивная память, — а вызов, который не успеет к сроку хода,
+    не начинается вовсе: пользователь сразу получает заглушку, а не после всех повторов.
+    """
+    def __init__(self, capacity, pressure_queue=0, slow_seconds=10.0, key_wait_seconds=5.0, window=60.0,
+                 key_wait=None):
+        self.capacity = capacity
+        # Сколько вызовов может стоять в очереди к слотам, прежде чем это считается насыщением
+        self.pressure_queue = pressure_queue
+        self.slow_seconds = slow_seconds
+        self.key_wait_seconds = key_wait_seconds
+        self.window = window
+        # key_wait() — через сколько секунд освободится хоть один ключ (все на кулдауне или без токенов)
+        self.key_wait = key_wait
+        self.in_flight = 0
+        self._latencies = deque()
+        self._pressure = False
+
+    @contextmanager
+    def call(self):
+        """Один логический вызов модели (с повторами и ожиданием ключа или слота) — учитывается как в полёте."""
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    def record(self, seconds):
+        """Время обслуживания одного запроса к модели, без очереди к слотам (LLMClient.on_service)."""
+        now = time.monotonic()
+        self._latencies.append((now, seconds))
+        self._trim(now)
+
+    def _trim(self, now):
+        while self._latencies and now - self._latencies[0][0] > self.window:
+            self._latencies.popleft()
+
+    def recent_latency(self, q):
+        """Квантиль времени обслуживания за окно; None — вызовов не было, давления по задержке нет."""
+        self._trim(time.monotonic())
+        if not self._latencies:
+            return None
+        ordered = sorted(seconds for _, seconds in self._latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def queued(self):
+        """Вызовы сверх числа слотов — они ждут семафора LLMClient."""
+        return max(0, self.in_flight - self.capacity)
+
+    def _key_wait(self):
+        return self.key_wait() if self.key_wait is not None else 0.0
+
+    def estimated_wait(self):
+        """Через сколько ответит новый вызов: ожидание ключа + очередь к слотам + типичное время обслуживания."""
+        latency = self.recent_latency(0.5) or 0.0
+        # Новый вызов встанет в очередь за уже ждущими
+        queued = max(0, self.in_flight + 1 - self.capacity) / self.capacity
+        return self._key_wait() + latency * (1 + queued)
+
+    def under_pressure(self):
+        latency = self.recent_latency(0.9)
+        key_wait = self._key_wait()
+        pressure = (self.queued() > self.pressure_queue or key_wait >= self.key_wait_seconds
+                    or (latency is not None and latency >= self.slow_seconds))
+        if pressure != self._pressure:
+            self._pressure = pressure
+            if pressure:
+                logger.warning(f"🚧 [ADMISSION] Модель под нагрузкой (в полёте {self.in_flight}/{self.capacity}, "
+                               f"p90 {latency or 0:.1f} с, ключ через {key_wait:.0f} с) — фоновая работа откладывается.")
+            else:
+                logger.info("✅ [ADMISSION] Нагрузка спала — фоновая работа возобновлена.")
+        return pressure
+
+    def admit(self, work):
+        """Можно ли сейчас запускать необязательную работу work; отказ учитывается в метриках."""
+        if not self.under_pressure():
+            return True
+        bot_metrics.admission_shed_total.inc(work=work)
+        return False
+
+    def can_meet_deadline(self, call_type):
+        """Успеет ли новый вызов модели к сроку текущего хода (без срока — всегда да)."""
+        left = remaining()
+        if left is None:
+            return True
+        wait = self.estimated_wait()
+        if wait <= left:
+            return True
+        logger.warning(f"⏳ [ADMISSION] Вызов {call_type} не успеет к сроку хода (ожидание ~{wait:.1f} с, "
+                       f"осталось {max(0.0, left):.1f} с) — пропускаю.")
+        bot_metrics.admission_shed_total.inc(work=call_type)
+        return False
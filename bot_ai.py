@@ -1,222 +1,596 @@
-# --- START OF FILE bot_ai.py ---
-
-import logging
-import asyncio
-import json
-import re
-import google.generativeai as genai
-
-import config
-
-logger = logging.getLogger(__name__)
-
-model = None
-current_key_index = 0
-API_KEYS = []
-
-def init_ai(api_keys_list):
-    global API_KEYS, current_key_index
-    API_KEYS = api_keys_list
-    current_key_index = 0
-    return initialize_model()
-    
-def initialize_model():
-    global model, current_key_index
-    if not API_KEYS:
-        logger.critical("❌ API_KEYS пуст!")
-        return False
-    current_key = API_KEYS[current_key_index]
-    
-    # Настройки безопасности: отключаем блокировки
-    safety_settings = {
-        'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE',
-        'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_NONE',
-        'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_NONE',
-        'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE'
-    }
-    
-    genai.configure(api_key=current_key, transport='rest')
-    try:
-        model = genai.GenerativeModel('gemini-flash-latest', safety_settings=safety_settings)
-        logger.info(f"🔑 Успешная инициализация ключа #{current_key_index+1}")
-        return True
-    except Exception:
-        try:
-            model = genai.GenerativeModel('gemini-1.5-flash', safety_settings=safety_settings)
-            logger.info(f"🔑 Успешная инициализация ключа #{current_key_index+1} с gemini-1.5-flash")
-            return True
-        except Exception as e:
-            logger.error(f"❌ Не удалось инициализировать модель: {e}")
-            return False
-
-def rotate_key():
-    global current_key_index
-    current_key_index = (current_key_index + 1) % len(API_KEYS)
-    logger.warning("⚠️ Меняю API ключ...")
-    return initialize_model()
-
-def clean_json_response(text):
-    match = re.search(r'\{.*\}', text, re.DOTALL)
-    return match.group(0).strip() if match else text.strip()
-
-async def safe_generate_content(prompt, temperature=0.85):
-    """
-    Безопасная обертка для вызова Gemini API.
-    """
-    global model
-    logger.info(f"📤 [GEMINI] Отправка промпта длиной: {len(prompt)} символов")
-    config_gen = genai.types.GenerationConfig(temperature=temperature)
-    
-    for _ in range(len(API_KEYS) + 1):
-        if not model:
-            logger.error("❌ Модель не инициализирована.")
-            return None
-        try:
-            loop = asyncio.get_running_loop()
-            response = await loop.run_in_executor(None, lambda: model.generate_content(prompt, generation_config=config_gen))
-            
-            if not response.candidates:
-                block_reason = "Неизвестно"
-                if response.prompt_feedback:
-                    block_reason = response.prompt_feedback.block_reason.name
-                logger.error(f"❌ [GEMINI] Ответ заблокирован! Причина: {block_reason}")
-                raise ValueError(f"Blocked: {block_reason}")
-                
-            return response
-        except Exception as e:
-            logger.error(f"❌ [GEMINI] Ошибка API с ключом #{current_key_index+1}: {e}", exc_info=False)
-            if not rotate_key():
-                logger.critical("❌ [GEMINI] Все ключи нерабочие.")
-                return None
-    return None
-
-async def try_parse_or_repair_json(raw_response_obj):
-    if not raw_response_obj: return None
-    
-    text_content = ""
-    try:
-        text_content = raw_response_obj.text
-    except ValueError:
-        logger.warning("⚠️ [JSON] Ответ API пуст (нет валидных частей текста). Пропускаю.")
-        return None
-    except Exception as e:
-        logger.error(f"⚠️ [JSON] Неизвестная ошибка при чтении текста: {e}")
-        return None
-        
-    if not text_content: return None
-
-    try:
-        return json.loads(clean_json_response(text_content))
-    except (json.JSONDecodeError, AttributeError, ValueError):
-        logger.warning(f"⚠️ [JSON] Ошибка парсинга. Запускаю Аварийное Восстановление JSON.")
-        repair_prompt = f"Ответ AI содержит ошибку в JSON. Исправь его. ВАЖНО: Ответ должен быть в поле 'replies': ['текст']. Не используй поле 'text' для ответа. Вот нерабочий ответ:\n\n{text_content}"
-        repaired_response = await safe_generate_content(repair_prompt, temperature=0.0)
-        
-        if repaired_response:
-            try:
-                repaired_text = repaired_response.text
-                repaired_json = json.loads(clean_json_response(repaired_text))
-                logger.info("✅ [JSON] Аварийное Восстановление JSON успешно!")
-                return repaired_json
-            except Exception:
-                 logger.error(f"❌ [JSON] Аварийное Восстановление НЕ удалось.")
-    return None
-
-async def retrieve_memory(user_query, query_topic, state_manager):
-    logger.info(f"🧠 [MEMORY] Запущен процесс воспоминания по теме: '{query_topic}'")
-    
-    reflection_history = state_manager.state.get("reflection_history", [])
-    keywords = query_topic.split()
-    
-    scored_messages = []
-    for msg in reflection_history:
-        score = sum(1 for keyword in keywords if keyword.lower() in msg['content'].lower())
-        if score > 0: scored_messages.append((score, msg))
-            
-    scored_messages.sort(key=lambda x: x[0], reverse=True)
-    relevant_context = [msg for score, msg in scored_messages[:20]]
-    memory_packet_text = "\n".join([f"{m['role']}: {m['content']}" for m in relevant_context])
-    
-    memory_context = f"ВНИМАНИЕ! Это приоритетная задача. Пользователь просит тебя что-то вспомнить. Вот контекст из памяти:\n---\n{memory_packet_text}\n---\nТвоя задача — изучить контекст и ответить на вопрос: '{user_query}'. Следуй своему характеру. Если ответа нет, честно признайся."
-    
-    return await process_user_input(user_query, state_manager, memory_context=memory_context)
-
-async def generate_reflection(state_manager):
-    logger.info("💡 [REFLECTION] Запускаю процесс гибридной рефлексии...")
-    recent_history = state_manager.state["chat_history"][-40:]
-    recent_history_text = "\n".join([f"{'Юзер' if m['role']=='user' else 'Бот'}: {m['content']}" for m in recent_history])
-    
-    reflection_history = state_manager.state["reflection_history"]
-    if len(reflection_history) < 50: return []
-
-    older_context_end_index = max(0, len(reflection_history) - len(recent_history))
-    older_context_start_index = max(0, older_context_end_index - 200)
-    older_context = reflection_history[older_context_start_index:older_context_end_index]
-    older_context_text = "\n".join([f"{'Юзер' if m['role']=='user' else 'Бот'}: {m['content']}" for m in older_context])
-    
-    prompt = f'<SYSTEM_REFLECT>Ты — ИИ-аналитик. Найди связи между НЕДАВНИМ и СТАРЫМ диалогом. Сгенерируй 1-2 "фоновые мысли" (наблюдения, шутки, темы для разговора). Верни JSON-список строк.</SYSTEM_REFLECT><RECENT_HISTORY>{recent_history_text}</RECENT_HISTORY><OLDER_CONTEXT>{older_context_text}</OLDER_CONTEXT><JSON_OUTPUT>{{"thoughts": ["текст мысли"]}}</JSON_OUTPUT>'
-    
-    raw_response_obj = await safe_generate_content(prompt, temperature=0.7)
-    parsed = await try_parse_or_repair_json(raw_response_obj)
-    return parsed.get("thoughts", []) if parsed else []
-
-async def process_user_input(user_text, state_manager, memory_context=None):
-    try:
-        with open(config.PROMPT_FILE, 'r', encoding='utf-8') as f: 
-            prompt_template = f.read()
-    except FileNotFoundError:
-        logger.error("❌ КРИТИЧЕСКАЯ ОШИБКА: Файл промпта не найден!")
-        return {"replies": ["ошибка. не могу найти файл своего характера."], "mood_shift": 0.0}
-        
-    system_alert = ""
-    memory_context_block = ""
-    task_execution_block = ""
-    
-    # --- КЛЮЧЕВАЯ ЛОГИКА: ОПРЕДЕЛЕНИЕ ТИПА ВХОДА ---
-    is_system_trigger = "[SYSTEM_TRIGGER:" in user_text
-    
-    if is_system_trigger:
-        # Извлекаем текст задачи и очищаем user_text, чтобы бот не путал это с сообщением юзера
-        clean_task_text = user_text.replace("[SYSTEM_TRIGGER:", "").replace("]", "").strip()
-        task_execution_block = f"<TASK_EXECUTION>\nПРИШЛО ВРЕМЯ ВЫПОЛНИТЬ ЗАДАЧУ/НАПОМИНАНИЕ:\n'{clean_task_text}'\nСформулируй сообщение пользователю об этом прямо сейчас.\n</TASK_EXECUTION>"
-        user_text = "" # Очистка ввода, так как это системный вызов
-        logger.info(f"⚙️ [AI] Режим выполнения задачи: {clean_task_text}")
-    else:
-        # Обычная обработка сообщений пользователя
-        if memory_context:
-            memory_context_block = f"<MEMORY_CONTEXT>\n{memory_context}\n</MEMORY_CONTEXT>"
-        elif triggered_topic := state_manager.get_and_clear_pending_topic(user_text):
-            system_alert = f"<SYSTEM_ALERT>ВНИМАНИЕ: Пользователь второй раз вернулся к теме '{', '.join(triggered_topic)}'. Прояви интерес.</SYSTEM_ALERT>"
-        elif state_manager.is_offended():
-            system_alert = "<SYSTEM_ALERT>ВНИМАНИЕ: Ты обижен. Отвечай холодно/односложно, либо молчи. Если юзер извиняется, можешь простить (`forgive: true`).</SYSTEM_ALERT>"
-        
-    mood_instr = state_manager.get_mood_instruction()
-    history = "\n".join([f"{'Юзер' if m['role']=='user' else 'Ты'}: {m['content']}" for m in state_manager.state["chat_history"]])
-    
-    thoughts_block = ""
-    if state_manager.state["background_thoughts"]:
-        thoughts_text = "\n".join([f'- ({t["id"]}) {t["text"]}' for t in state_manager.state["background_thoughts"]])
-        thoughts_block = f'<BACKGROUND_THOUGHTS>Твои фоновые мысли. ПРАВИЛО: Если разговор затухает, используй мысль.\nТвои текущие мысли:\n{thoughts_text}</BACKGROUND_THOUGHTS>'
-    
-    existing_tasks_list = state_manager.state.get("task_list", [])
-    existing_tasks_str = "\n".join([f"- [{t['priority']}] {t.get('text', 'без темы')}" for t in existing_tasks_list])
-    if not existing_tasks_str: existing_tasks_str = "Список пуст."
-        
-    prompt = prompt_template.format(
-        memory_context_block=memory_context_block, 
-        system_alert=system_alert, 
-        msk_time=state_manager.get_msk_time_obj().strftime("%H:%M"), 
-        mood_instr=mood_instr, 
-        thoughts_block=thoughts_block, 
-        history=history,
-        task_execution_block=task_execution_block, # Вставляем блок выполнения задачи
-        user_text=user_text, 
-        existing_tasks=existing_tasks_str
-    )
-    
-    raw_response_obj = await safe_generate_content(prompt)
-    parsed_json = await try_parse_or_repair_json(raw_response_obj)
-    
-    if parsed_json: 
-        logger.info(f"📥 [DECISION] {parsed_json}")
-    return parsed_json
\ No newline at end of file
+# --- START OF FILE bot_ai.py ---
+
+import time
+import logging
+import asyncio
+import json
+
+import config
+import bot_metrics
+from bot_memory import hybrid_search, detect_recall_intent, may_be_recall, import_numpy
+from bot_schema import Decision, DECISION_SCHEMA, REFLECTION_SCHEMA
+from bot_json import StreamingRepliesParser, RecoveryStats, parse_strict, recover_json
+from bot_llm import LLMClient, LLMError, LLMResponse, KeyPool, LatencyTracker, HedgeLimiter, create_provider
+from bot_admission import AdmissionController, remaining
+from bot_prompt import PromptBuilder, ContextPacker, truncate_text, HISTORY_LINE_MAX_CHARS
+from bot_summary import SummaryTree
+
+logger = logging.getLogger(__name__)
+
+llm_client = None
+key_pool = None
+latency_tracker = LatencyTracker()
+hedge_limiter = HedgeLimiter(config.HEDGE_MAX_PER_MINUTE)
+json_recovery_stats = RecoveryStats()
+admission = AdmissionController(
+    config.LLM_MAX_CONCURRENCY,
+    pressure_queue=config.ADMISSION_PRESSURE_QUEUE,
+    slow_seconds=config.ADMISSION_SLOW_SECONDS,
+    key_wait_seconds=config.ADMISSION_KEY_WAIT_SECONDS,
+    window=config.ADMISSION_WINDOW_SECONDS,
+    key_wait=lambda: key_pool.wait_time() if key_pool else 0.0,
+)
+prompt_builder = PromptBuilder(config.PROMPT_FILE)
+
+def _key_series(field):
+    """Поле KeyPool.stats() по ключам для /metrics — снимается при каждом запросе метрик."""
+    def collect():
+        if key_pool is None:
+            return {}
+        return {(("key", label),): stats[field] for label, stats in key_pool.stats().items()}
+    return collect
+
+def _key_error_series():
+    if key_pool is None:
+        return {}
+    return {(("key", label), ("kind", kind)): count
+            for label, stats in key_pool.stats().items() for kind, count in stats["errors"].items()}
+
+bot_metrics.key_requests_total.collect = _key_series("requests")
+bot_metrics.key_errors_total.collect = _key_error_series
+bot_metrics.key_in_flight.collect = _key_series("in_flight")
+bot_metrics.key_cooldown_seconds.collect = _key_series("cooldown_left")
+bot_metrics.key_tokens.collect = _key_series("tokens")
+
+def init_ai(api_keys_list):
+    global llm_client, key_pool
+    if not api_keys_list:
+        logger.critical("❌ API_KEYS пуст!")
+        return False
+    key_pool = KeyPool(api_keys_list, rpm=config.KEY_RPM_LIMIT, burst=config.KEY_BURST, max_cooldown=config.KEY_MAX_COOLDOWN_SECONDS)
+    try:
+        provider = create_provider(
+            config.LLM_PROVIDER,
+            config.GEMINI_MODEL,
+            base_url=config.GEMINI_BASE_URL,
+            proxy=config.PROXY_URL,
+            pool_size=config.LLM_POOL_SIZE,
+        )
+    except Exception as e:
+        logger.error(f"❌ Не удалось инициализировать LLM-клиент: {e}")
+        return False
+    llm_client = LLMClient(provider, timeout=config.LLM_TIMEOUT_SECONDS, max_concurrency=config.LLM_MAX_CONCURRENCY,
+                           on_service=admission.record)
+    logger.info(f"🔑 LLM-клиент готов: провайдер '{provider.name}', модель {config.GEMINI_MODEL}, ключей: {len(key_pool)}")
+    return True
+
+def warm_up():
+    """Ленивые тяжёлые импорты (SDK модели, numpy) заранее — в фоне, пока идёт подключение к Telegram."""
+    if llm_client:
+        try:
+            llm_client.provider.warm_up()
+        except ImportError as e:
+            logger.error(f"❌ Не удалось импортировать SDK модели: {e}")
+    import_numpy()
+
+async def shutdown_ai():
+    if llm_client:
+        await llm_client.aclose()
+
+async def _call_with_key(prompt, temperature, key_state, call_type, response_schema=None):
+    """Один вызов на конкретном ключе. Возвращает (ответ, класс ошибки или None)."""
+    error_kind = None
+    started = time.monotonic()
+    try:
+        # Таймаут, отмена и лимит параллельных вызовов — внутри клиента
+        response = await llm_client.generate(prompt, temperature, key_state.key, response_schema=response_schema)
+        if not response.candidates:
+            block_reason = response.block_reason or "Неизвестно"
+            logger.error(f"❌ [GEMINI] Ответ заблокирован! Причина: {block_reason}")
+            error_kind = "blocked"
+            return None, error_kind
+        latency_tracker.record(call_type, time.monotonic() - started)
+        if response.prompt_tokens:
+            bot_metrics.llm_tokens_total.inc(response.prompt_tokens, direction="input", call_type=call_type)
+        if response.output_tokens:
+            bot_metrics.llm_tokens_total.inc(response.output_tokens, direction="output", call_type=call_type)
+        return response, None
+    except asyncio.CancelledError:
+        error_kind = "cancelled"
+        raise
+    except LLMError as e:
+        error_kind = e.kind
+        logger.error(f"❌ [GEMINI] Ошибка API с ключом {key_state.label}: {e}", exc_info=False)
+        return None, error_kind
+    except Exception as e:
+        error_kind = "server"
+        logger.error(f"❌ [GEMINI] Ошибка API с ключом {key_state.label}: {e}", exc_info=False)
+        return None, error_kind
+    finally:
+        bot_metrics.llm_seconds.observe(time.monotonic() - started, call_type=call_type)
+        key_pool.release(key_state, error_kind)
+
+async def _hedged_call(prompt, temperature, key_state, call_type, response_schema=None):
+    """
+    Если основной запрос не ответил за p90 своего типа, отправляем дубль на другой ключ.
+    Побеждает первый валидный ответ, второй запрос отменяется.
+    """
+    primary = asyncio.create_task(_call_with_key(prompt, temperature, key_state, call_type, response_schema))
+    hedge = None
+    delay = max(config.HEDGE_MIN_DELAY_SECONDS, latency_tracker.percentile(call_type, 0.9) or 0.0)
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+        hedge_key = await key_pool.acquire(exclude={key_state.index}, max_wait=0)
+        if hedge_key is None:
+            return await primary
+        if not hedge_limiter.try_acquire():
+            key_pool.release(hedge_key, "cancelled")
+            return await primary
+        logger.info(f"🪞 [HEDGE] Нет ответа за {delay:.1f} с — дублирую запрос на ключ {hedge_key.label}.")
+        bot_metrics.hedges_total.inc(call_type=call_type)
+        hedge = asyncio.create_task(_call_with_key(prompt, temperature, hedge_key, call_type, response_schema))
+
+        pending = {primary, hedge}
+        result = (None, "server")
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                if result[1] is None:
+                    logger.info(f"🪞 [HEDGE] Победил {'дубль' if task is hedge else 'основной запрос'}.")
+                    return result
+        return result
+    finally:
+        for task in (primary, hedge):
+            if task is not None and not task.done():
+                task.cancel()
+
+async def safe_generate_content(prompt, temperature=0.85, call_type="chat", hedge=None, response_schema=None):
+    """
+    Безопасная обертка для вызова Gemini API.
+    call_type нужен для статистики задержек; hedge=False отключает дублирующие запросы;
+    response_schema включает структурированный JSON-вывод.
+    """
+    logger.info(f"📤 [GEMINI] Отправка промпта длиной: {len(prompt)} символов")
+    if not llm_client:
+        logger.error("❌ Модель не инициализирована.")
+        return None
+    if not admission.can_meet_deadline(call_type):
+        return None
+    hedge = _should_hedge(call_type, hedge)
+
+    with bot_metrics.stage("llm_wait"), admission.call():
+        tried = set()
+        for _ in range(len(key_pool) + 1):
+            # Сначала пробуем ключи, которые в этом вызове ещё не падали
+            key_state = await key_pool.acquire(exclude=tried if len(tried) < len(key_pool) else (), max_wait=_key_max_wait())
+            if key_state is None:
+                logger.critical(f"❌ [GEMINI] Нет доступных ключей. {key_pool.stats()}")
+                return None
+            if tried:
+                _count_retry(call_type, key_state, tried)
+            if hedge:
+                response, error_kind = await _hedged_call(prompt, temperature, key_state, call_type, response_schema)
+            else:
+                response, error_kind = await _call_with_key(prompt, temperature, key_state, call_type, response_schema)
+            if error_kind is None:
+                return response
+            # Блокировка и кривой запрос зависят от промпта, а не от ключа — менять ключ бессмысленно
+            if error_kind in ("blocked", "bad_request"):
+                return None
+            tried.add(key_state.index)
+        logger.critical(f"❌ [GEMINI] Все ключи нерабочие. {key_pool.stats()}")
+        return None
+
+def _should_hedge(call_type, hedge=None):
+    if hedge is None:
+        hedge = config.HEDGE_ENABLED and call_type in config.HEDGE_CALL_TYPES
+    # Дубль запроса под нагрузкой только добавил бы очередь к модели
+    return hedge and len(key_pool) > 1 and not admission.under_pressure()
+
+def _key_max_wait():
+    # Свободный ключ ждём не дольше срока хода
+    left = remaining()
+    return 10.0 if left is None else max(0.0, min(10.0, left))
+
+def _count_retry(call_type, key_state, tried):
+    bot_metrics.llm_retries_total.inc(call_type=call_type)
+    if key_state.index not in tried:
+        bot_metrics.key_rotations_total.inc()
+
+class _StreamRace:
+    """Какой из параллельных потоков первым отдал кусок: в on_chunk идут только его куски."""
+    def __init__(self, on_chunk):
+        self.on_chunk = on_chunk
+        self.winner = None
+        self.started = asyncio.Event()
+
+    def gate(self, name):
+        async def on_chunk(chunk):
+            if self.winner is None:
+                self.winner = name
+                self.started.set()
+            if self.winner == name:
+                await self.on_chunk(chunk)
+        return on_chunk
+
+async def _stream_with_key(prompt, temperature, key_state, call_type, response_schema, on_chunk):
+    """Один поток на одном ключе. Возвращает (полученные куски, класс ошибки или None)."""
+    error_kind = None
+    received = []
+    started = time.monotonic()
+    try:
+        async for chunk in llm_client.stream(prompt, temperature, key_state.key, response_schema=response_schema):
+            if not received:
+                # Время до первого куска — по нему решается, не пора ли дублировать поток
+                latency_tracker.record(f"{call_type}_first_chunk", time.monotonic() - started)
+            received.append(chunk)
+            await on_chunk(chunk)
+        latency_tracker.record(f"{call_type}_stream", time.monotonic() - started)
+    except asyncio.CancelledError:
+        error_kind = "cancelled"
+        raise
+    except LLMError as e:
+        error_kind = e.kind
+        logger.error(f"❌ [GEMINI] Ошибка потока с ключом {key_state.label}: {e}", exc_info=False)
+    except Exception as e:
+        error_kind = "server"
+        logger.error(f"❌ [GEMINI] Ошибка потока с ключом {key_state.label}: {e}", exc_info=False)
+    finally:
+        bot_metrics.llm_seconds.observe(time.monotonic() - started, call_type=f"{call_type}_stream")
+        key_pool.release(key_state, error_kind)
+    return received, error_kind
+
+async def _hedged_stream(prompt, temperature, key_state, call_type, response_schema, on_chunk):
+    """
+    Хедж фазы до первого куска: если поток не начался за p90 времени до первого куска,
+    открываем второй поток на другом ключе. Пользователю идёт тот, что начался первым, другой отменяется.
+    """
+    race = _StreamRace(on_chunk)
+    attempts = {
+        asyncio.create_task(_stream_with_key(prompt, temperature, key_state, call_type, response_schema,
+                                             race.gate("primary"))): "primary",
+    }
+    started = asyncio.create_task(race.started.wait())
+    delay = max(config.HEDGE_MIN_DELAY_SECONDS, latency_tracker.percentile(f"{call_type}_first_chunk", 0.9) or 0.0)
+    try:
+        await asyncio.wait({started, *attempts}, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+        if not race.started.is_set() and not any(task.done() for task in attempts):
+            hedge_key = await key_pool.acquire(exclude={key_state.index}, max_wait=0)
+            if hedge_key is not None and not hedge_limiter.try_acquire():
+                key_pool.release(hedge_key, "cancelled")
+            elif hedge_key is not None:
+                logger.info(f"🪞 [HEDGE] Поток не начался за {delay:.1f} с — дублирую его на ключ {hedge_key.label}.")
+                bot_metrics.hedges_total.inc(call_type=call_type)
+                attempts[asyncio.create_task(_stream_with_key(prompt, temperature, hedge_key, call_type, response_schema,
+                                                              race.gate("hedge")))] = "hedge"
+
+        pending = set(attempts)
+        result = ([], "server")
+        while pending:
+            if race.winner is not None:
+                # Поток пошёл пользователю — дальше важен только он
+                if len(attempts) > 1:
+                    logger.info(f"🪞 [HEDGE] Победил {'дубль' if race.winner == 'hedge' else 'основной поток'}.")
+                return await next(task for task, name in attempts.items() if name == race.winner)
+            done, pending = await asyncio.wait(pending | {started}, return_when=asyncio.FIRST_COMPLETED)
+            pending.discard(started)
+            for task in done - {started}:
+                result = task.result()
+                if result[1] is None:
+                    return result
+        return result
+    finally:
+        for task in (*attempts, started):
+            if not task.done():
+                task.cancel()
+
+async def stream_generate_content(prompt, on_chunk, temperature=0.85, call_type="chat", response_schema=None, hedge=None):
+    """
+    Потоковая генерация: каждый кусок текста сразу отдаётся в on_chunk.
+    Ключ меняется, только пока не пришло ни одного куска; частичный ответ возвращается как есть.
+    До первого куска поток хеджируется так же, как обычный вызов.
+    """
+    logger.info(f"📤 [GEMINI] Потоковая отправка промпта длиной: {len(prompt)} символов")
+    if not llm_client:
+        logger.error("❌ Модель не инициализирована.")
+        return None
+    if not admission.can_meet_deadline(call_type):
+        return None
+    hedge = _should_hedge(call_type, hedge)
+
+    with bot_metrics.stage("llm_wait"), admission.call():
+        tried = set()
+        for _ in range(len(key_pool) + 1):
+            key_state = await key_pool.acquire(exclude=tried if len(tried) < len(key_pool) else (), max_wait=_key_max_wait())
+            if key_state is None:
+                logger.critical(f"❌ [GEMINI] Нет доступных ключей. {key_pool.stats()}")
+                return None
+            if tried:
+                _count_retry(call_type, key_state, tried)
+            if hedge:
+                received, error_kind = await _hedged_stream(prompt, temperature, key_state, call_type, response_schema, on_chunk)
+            else:
+                received, error_kind = await _stream_with_key(prompt, temperature, key_state, call_type, response_schema, on_chunk)
+            if received:
+                # Часть ответа уже ушла пользователю — повтор на другом ключе её бы задублировал
+                return LLMResponse(["".join(received)])
+            if error_kind in ("blocked", "bad_request"):
+                return None
+            tried.add(key_state.index)
+        logger.critical(f"❌ [GEMINI] Все ключи нерабочие. {key_pool.stats()}")
+        return None
+
+def _record_json_outcome(outcome):
+    json_recovery_stats.record(outcome)
+    bot_metrics.json_repairs_total.inc(outcome=outcome)
+
+async def try_parse_or_repair_json(raw_response_obj, list_field="replies", response_schema=None):
+    if not raw_response_obj: return None
+    
+    text_content = ""
+    try:
+        text_content = raw_response_obj.text
+    except ValueError:
+        logger.warning("⚠️ [JSON] Ответ API пуст (нет валидных частей текста). Пропускаю.")
+        return None
+    except Exception as e:
+        logger.error(f"⚠️ [JSON] Неизвестная ошибка при чтении текста: {e}")
+        return None
+        
+    if not text_content: return None
+
+    with bot_metrics.stage("json_parse"):
+        try:
+            parsed = parse_strict(text_content, list_field)
+        except (json.JSONDecodeError, AttributeError, ValueError):
+            parsed = None
+        # Сначала чиним локально: запятые, кавычки, обрывы — без второго вызова модели
+        recovered = recover_json(text_content, list_field) if parsed is None else None
+    if parsed is not None:
+        _record_json_outcome("strict")
+        return parsed
+    if recovered is not None:
+        _record_json_outcome("local")
+        logger.info(f"🩹 [JSON] JSON восстановлен локально. {json_recovery_stats.summary()}")
+        return recovered
+
+    logger.warning(f"⚠️ [JSON] Ошибка парсинга. Запускаю Аварийное Восстановление JSON.")
+    repair_instruction = f"Ответ AI содержит ошибку в JSON. Исправь его. ВАЖНО: Ответ должен быть в поле '{list_field}': ['текст']. Не используй поле 'text' для ответа. Вот нерабочий ответ:\n\n"
+    packer = ContextPacker("repair", config.TOKEN_BUDGETS["repair"])
+    packer.reserve("system", repair_instruction)
+    repair_prompt = repair_instruction + packer.fit_text("broken_json", text_content)
+    packer.log()
+    repaired_response = await safe_generate_content(repair_prompt, temperature=0.0, call_type="repair", response_schema=response_schema)
+    
+    if repaired_response:
+        repaired_text = repaired_response.text
+        try:
+            repaired_json = parse_strict(repaired_text, list_field)
+        except (json.JSONDecodeError, AttributeError, ValueError):
+            repaired_json = recover_json(repaired_text, list_field)
+        if repaired_json is not None:
+            _record_json_outcome("remote")
+            logger.info(f"✅ [JSON] Аварийное Восстановление JSON успешно! {json_recovery_stats.summary()}")
+            return repaired_json
+    _record_json_outcome("failed")
+    logger.error(f"❌ [JSON] Аварийное Восстановление НЕ удалось. {json_recovery_stats.summary()}")
+    return None
+
+def find_memories(query_topic, state_manager, limit=config.MEMORY_RECALL_LIMIT):
+    # То, что и так попадёт в промпт историей (включая сам вопрос), в память не дублируем. История — хвост архива,
+    # поэтому сверяем по позиции в индексе: после перезапуска её словари — другие объекты, чем документы индекса
+    docs = state_manager.memory_index.docs
+    window = min(len(state_manager.state["chat_history"]), len(docs))
+    in_history = {id(m) for m in docs[len(docs) - window:]}
+    # BM25 + семантический поиск по всему архиву вместо перебора reflection_history
+    with bot_metrics.stage("memory_search"):
+        scored_messages = hybrid_search(state_manager.memory_index, state_manager.semantic_index, query_topic, limit=limit + window)
+    return [msg for score, msg in scored_messages if id(msg) not in in_history][:limit]
+
+async def retrieve_memory(user_query, query_topic, state_manager, on_reply=None):
+    logger.info(f"🧠 [MEMORY] Запущен процесс воспоминания по теме: '{query_topic}'")
+    relevant_context = find_memories(query_topic, state_manager)
+    return await process_user_input(user_query, state_manager, memory_hits=relevant_context, on_reply=on_reply)
+
+async def respond_to_user(user_text, state_manager, on_reply=None):
+    """
+    Ответ на сообщение пользователя. Просьба вспомнить распознаётся локально, и память
+    ищется до вызова модели — один вызов вместо "узнать тему, потом ответить".
+    """
+    if detect_recall_intent(user_text):
+        logger.info("🧠 [MEMORY] Просьба вспомнить распознана локально — ищу в памяти до вызова модели.")
+        return await retrieve_memory(user_text, user_text, state_manager, on_reply=on_reply)
+
+    speculative = None
+    if config.MEMORY_SPECULATIVE_RECALL and may_be_recall(user_text) and admission.admit("speculative_recall"):
+        # Ответ с памятью готовится параллельно; реплики из него не стримим, чтобы не было дублей
+        logger.info("🧠 [MEMORY] Похоже на вопрос о прошлом — параллельно готовлю ответ с памятью.")
+        speculative = asyncio.create_task(retrieve_memory(user_text, user_text, state_manager))
+    try:
+        decision = await process_user_input(user_text, state_manager, on_reply=on_reply)
+        if not decision or not (memory_topic := decision.memory_query_topic):
+            return decision
+        if speculative is not None:
+            logger.info("🧠 [MEMORY] Спекулятивный ответ с памятью пригодился.")
+            return await speculative
+        # Модель сама попросила память: старый путь со вторым вызовом
+        return await retrieve_memory(user_text, memory_topic, state_manager, on_reply=on_reply)
+    finally:
+        if speculative is not None and not speculative.done():
+            speculative.cancel()
+
+async def summarize_range(state_manager, tree, level, start, end):
+    """Одна сводка дерева: кусок сообщений архива (уровень 1) или несколько сводок уровнем ниже."""
+    if level == 1:
+        offset = state_manager.archive_offset()
+        items = [format_reflection_line(m) for m in state_manager.memory_index.docs[start - offset:end - offset]]
+    else:
+        items = tree.children(level, start)
+    system_text = '<SYSTEM_SUMMARY>Сожми фрагмент переписки в краткую сводку (3-6 предложений): факты о пользователе, события, планы, договорённости, настроение. Только текст сводки, без вступлений.</SYSTEM_SUMMARY>'
+    packer = ContextPacker("summary", config.TOKEN_BUDGETS["summary"])
+    packer.reserve("system", system_text)
+    fragment_text = "\n".join(packer.take("fragment", items))
+    packer.log()
+
+    response = await safe_generate_content(f'{system_text}<FRAGMENT>{fragment_text}</FRAGMENT>', temperature=0.3, call_type="summary")
+    text = response.text.strip() if response else ""
+    if not text:
+        return False
+    await state_manager.add_summary(tree.key(level, start, end), text)
+    logger.info(f"🗜️ [SUMMARY] Сводка уровня {level} по сообщениям {start}–{end} готова ({len(text)} символов).")
+    return True
+
+async def update_summaries(state_manager, tree, limit):
+    """Досоздаёт недостающие сводки по сообщениям [0, limit), не больше SUMMARY_MAX_PER_RUN вызовов за раз."""
+    for _ in range(config.SUMMARY_MAX_PER_RUN):
+        missing = tree.next_missing(limit, state_manager.archive_offset())
+        if missing is None or not await summarize_range(state_manager, tree, *missing):
+            return
+
+async def generate_reflection(state_manager):
+    logger.info("💡 [REFLECTION] Запускаю процесс гибридной рефлексии...")
+    recent_history = state_manager.state["chat_history"][-40:]
+    
+    reflection_history = state_manager.state["reflection_history"]
+    if len(reflection_history) < 50: return []
+
+    # Старое уже сжато в сводки (каждая создаётся один раз); сырым идёт только хвост между сводками и свежим диалогом
+    tree = SummaryTree(state_manager.state["summaries"], config.SUMMARY_CHUNK_MESSAGES, config.SUMMARY_FANOUT)
+    recent_start = state_manager.state["message_seq"] - len(recent_history)
+    await update_summaries(state_manager, tree, recent_start)
+    summaries, covered_end = tree.cover(recent_start)
+    offset = state_manager.archive_offset()
+    older_context = state_manager.memory_index.docs[max(0, max(covered_end, recent_start - 200) - offset):max(0, recent_start - offset)]
+
+    # Далёкие воспоминания из всего архива, похожие по смыслу на недавний разговор
+    related = []
+    if state_manager.semantic_index is not None:
+        recent_user_text = " ".join(m['content'] for m in recent_history if m['role'] == 'user')
+        window = len(recent_history) + len(older_context)
+        related = [m for _, m in state_manager.semantic_index.search(recent_user_text, limit=10, exclude_last=window)]
+
+    # Бюджет: сначала свежий диалог, потом похожие воспоминания, потом несжатый хвост и сводки
+    system_text = '<SYSTEM_REFLECT>Ты — ИИ-аналитик. Найди связи между НЕДАВНИМ и СТАРЫМ диалогом (старый дан сводками и хвостом сообщений). Сгенерируй 1-2 "фоновые мысли" (наблюдения, шутки, темы для разговора). Верни JSON-список строк.</SYSTEM_REFLECT>'
+    output_text = '<JSON_OUTPUT>{"thoughts": ["текст мысли"]}</JSON_OUTPUT>'
+    packer = ContextPacker("reflection", config.TOKEN_BUDGETS["reflection"])
+    packer.reserve("system", system_text, output_text)
+    recent_history_text = "\n".join(packer.take_newest("recent_history", [format_reflection_line(m) for m in recent_history]))
+    related_text = "\n".join(packer.take("related_memories", [format_reflection_line(m) for m in related]))
+    older_context_text = "\n".join(packer.take_newest("older_context", [format_reflection_line(m) for m in older_context]))
+    summaries_text = "\n".join(packer.take_newest("summaries", [f"[сообщения {start}–{end}] {text}" for _, start, end, text in summaries]))
+    related_block = f'<RELATED_MEMORIES>{related_text}</RELATED_MEMORIES>' if related_text else ""
+    packer.log()
+    
+    prompt = f'{system_text}<RECENT_HISTORY>{recent_history_text}</RECENT_HISTORY><OLDER_SUMMARIES>{summaries_text}</OLDER_SUMMARIES><OLDER_CONTEXT>{older_context_text}</OLDER_CONTEXT>{related_block}{output_text}'
+    
+    response_schema = REFLECTION_SCHEMA if config.STRUCTURED_OUTPUT else None
+    raw_response_obj = await safe_generate_content(prompt, temperature=0.7, call_type="reflection", response_schema=response_schema)
+    parsed = await try_parse_or_repair_json(raw_response_obj, list_field="thoughts", response_schema=response_schema)
+    return [t for t in parsed.get("thoughts", []) if isinstance(t, str) and t] if parsed else []
+
+def format_reflection_line(message):
+    return f"{'Юзер' if message['role']=='user' else 'Бот'}: {truncate_text(message['content'], HISTORY_LINE_MAX_CHARS)}"
+
+async def process_user_input(user_text, state_manager, memory_hits=None, on_reply=None):
+    build_started = time.monotonic()
+    system_alert = ""
+    memory_context_block = ""
+    task_execution_block = ""
+    
+    # --- КЛЮЧЕВАЯ ЛОГИКА: ОПРЕДЕЛЕНИЕ ТИПА ВХОДА ---
+    is_system_trigger = "[SYSTEM_TRIGGER:" in user_text
+    
+    if is_system_trigger:
+        # Извлекаем текст задачи и очищаем user_text, чтобы бот не путал это с сообщением юзера
+        clean_task_text = user_text.replace("[SYSTEM_TRIGGER:", "").replace("]", "").strip()
+        task_execution_block = f"<TASK_EXECUTION>\nПРИШЛО ВРЕМЯ ВЫПОЛНИТЬ ЗАДАЧУ/НАПОМИНАНИЕ:\n'{clean_task_text}'\nСформулируй сообщение пользователю об этом прямо сейчас.\n</TASK_EXECUTION>"
+        user_text = "" # Очистка ввода, так как это системный вызов
+        logger.info(f"⚙️ [AI] Режим выполнения задачи: {clean_task_text}")
+    else:
+        # Обычная обработка сообщений пользователя (блок памяти собирается ниже, под остаток бюджета)
+        if memory_hits is None:
+            if triggered_topic := state_manager.get_and_clear_pending_topic(user_text):
+                system_alert = f"<SYSTEM_ALERT>ВНИМАНИЕ: Пользователь второй раз вернулся к теме '{', '.join(triggered_topic)}'. Прояви интерес.</SYSTEM_ALERT>"
+            elif state_manager.is_offended():
+                system_alert = "<SYSTEM_ALERT>ВНИМАНИЕ: Ты обижен. Отвечай холодно/односложно, либо молчи. Если юзер извиняется, можешь простить (`forgive: true`).</SYSTEM_ALERT>"
+        
+    mood_instr = state_manager.get_mood_instruction()
+    msk_time = state_manager.get_msk_time_obj().strftime("%H:%M")
+    
+    existing_tasks_list = state_manager.state.get("task_list", [])
+    existing_tasks_str = "\n".join([f"- [{t['priority']}] {t.get('text', 'без темы')}" for t in existing_tasks_list])
+    if not existing_tasks_str: existing_tasks_str = "Список пуст."
+        
+    try:
+        # Бюджет токенов по приоритету: система -> свежая история -> память -> фоновые мысли
+        call_type = "memory" if memory_hits is not None else "chat"
+        packer = ContextPacker(call_type, config.TOKEN_BUDGETS[call_type])
+        packer.reserve("system", system_alert, msk_time, mood_instr, existing_tasks_str, task_execution_block)
+        packer.reserve_tokens("system", prompt_builder.static_tokens())
+        packer.reserve("user_input", user_text)
+        # История берётся из кольцевого буфера билдера, шаблон перечитывается только при смене mtime
+        # При воспоминании история не должна съесть всё место, нужное под найденные сообщения
+        history = prompt_builder.render_history(state_manager, packer, leave=config.MEMORY_MIN_TOKENS if memory_hits is not None else 0)
+
+        if memory_hits is not None:
+            memory_header = "ВНИМАНИЕ! Это приоритетная задача. Пользователь просит тебя что-то вспомнить. Вот контекст из памяти:\n---\n"
+            memory_footer = f"\n---\nТвоя задача — изучить контекст и ответить на вопрос: '{user_text}'. Следуй своему характеру. Если ответа нет, честно признайся."
+            packer.reserve("memory", memory_header, memory_footer)
+            memory_packet_text = "\n".join(packer.take("memory", [f"{m['role']}: {truncate_text(m['content'], HISTORY_LINE_MAX_CHARS)}" for m in memory_hits]))
+            memory_context_block = f"<MEMORY_CONTEXT>\n{memory_header}{memory_packet_text}{memory_footer}\n</MEMORY_CONTEXT>"
+
+        thoughts_block = ""
+        if state_manager.state["background_thoughts"]:
+            thoughts_header = 'Твои фоновые мысли. ПРАВИЛО: Если разговор затухает, используй мысль.\nТвои текущие мысли:\n'
+            packer.reserve("thoughts", thoughts_header)
+            thoughts_text = "\n".join(packer.take_newest("thoughts", [f'- ({t["id"]}) {t["text"]}' for t in state_manager.state["background_thoughts"]]))
+            thoughts_block = f'<BACKGROUND_THOUGHTS>{thoughts_header}{thoughts_text}</BACKGROUND_THOUGHTS>'
+        packer.log()
+
+        prompt = prompt_builder.build(
+            state_manager,
+            history=history,
+            memory_context_block=memory_context_block, 
+            system_alert=system_alert, 
+            msk_time=msk_time, 
+            mood_instr=mood_instr, 
+            thoughts_block=thoughts_block, 
+            task_execution_block=task_execution_block, # Вставляем блок выполнения задачи
+            user_text=user_text, 
+            existing_tasks=existing_tasks_str
+        )
+    except FileNotFoundError:
+        logger.error("❌ КРИТИЧЕСКАЯ ОШИБКА: Файл промпта не найден!")
+        return Decision(replies=["ошибка. не могу найти файл своего характера."])
+    
+    bot_metrics.observe_stage("prompt_build", time.monotonic() - build_started)
+    # Схема ответа генерируется из того же описания, по которому потом разбирается Decision
+    response_schema = DECISION_SCHEMA if config.STRUCTURED_OUTPUT else None
+    if on_reply is not None and config.STREAMING_ENABLED:
+        # Реплики уходят в on_reply по мере закрытия строк в "replies"; остальные поля — после конца потока
+        parser = StreamingRepliesParser()
+        async def on_chunk(chunk):
+            for reply in parser.feed(chunk):
+                await on_reply(reply)
+        raw_response_obj = await stream_generate_content(prompt, on_chunk, call_type=call_type, response_schema=response_schema)
+    else:
+        raw_response_obj = await safe_generate_content(prompt, call_type=call_type, response_schema=response_schema)
+    parsed_json = await try_parse_or_repair_json(raw_response_obj, response_schema=response_schema)
+    
+    decision = Decision.from_dict(parsed_json)
+    if decision: 
+        logger.info(f"📥 [DECISION] {decision}")
+    return decision
\ No newline at end of file
@@ -0,0 +1,251 @@
+# --- START OF FILE bot_cluster.py ---
+
+import time
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from bisect import bisect
+
+logger = logging.getLogger(__name__)
+
+
+class ChatNotOwned(Exception):
+    """Чат обслуживает другой воркер (или аренда ещё не получена)."""
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Консистентное хеширование: при уходе воркера перераспределяются только его чаты."""
+    def __init__(self, nodes, vnodes=64):
+        self.nodes = frozenset(nodes)
+        self._points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in self._points]
+
+    def owner(self, key):
+        if not self._points:
+            return None
+        return self._points[bisect(self._hashes, _hash(str(key))) % len(self._points)][1]
+
+
+class ClusterStore:
+    """
+    Общая для воркеров SQLite-база координации (WAL): живые воркеры с пульсом и аренды чатов со сроком.
+    Методы блокирующие — вызываются через asyncio.to_thread.
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, address TEXT NOT NULL, heartbeat REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS leases (chat_id INTEGER PRIMARY KEY, worker_id TEXT NOT NULL, expires REAL NOT NULL);
+        """)
+
+    def heartbeat(self, worker_id, address, now, ttl):
+        """Отмечает воркер живым и возвращает {worker_id: address} всех живых."""
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO workers (worker_id, address, heartbeat) VALUES (?, ?, ?)",
+                              (worker_id, address, now))
+            rows = self.conn.execute("SELECT worker_id, address FROM workers WHERE heartbeat > ?", (now - ttl,)).fetchall()
+        return dict(rows)
+
+    def acquire(self, worker_id, chat_ids, now, lease_seconds):
+        """Продлевает свои аренды и забирает свободные или просроченные. Возвращает чаты, арендованные этим воркером."""
+        if not chat_ids:
+            return set()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany(
+                    "INSERT INTO leases (chat_id, worker_id, expires) VALUES (?, ?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET worker_id = excluded.worker_id, expires = excluded.expires "
+                    "WHERE leases.worker_id = excluded.worker_id OR leases.expires < ?",
+                    [(chat_id, worker_id, now + lease_seconds, now) for chat_id in chat_ids],
+                )
+                placeholders = ",".join("?" * len(chat_ids))
+                rows = self.conn.execute(
+                    f"SELECT chat_id FROM leases WHERE worker_id = ? AND chat_id IN ({placeholders})",
+                    (worker_id, *chat_ids),
+                ).fetchall()
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return {chat_id for chat_id, in rows}
+
+    def release(self, worker_id, chat_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM leases WHERE chat_id = ? AND worker_id = ?", (chat_id, worker_id))
+
+    def remove_worker(self, worker_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+
+    def close(self):
+        self.conn.close()
+
+
+class ChatCluster:
+    """
+    Несколько процессов над общей папкой chats/: чаты делятся между живыми воркерами по консистентному хешу,
+    а обслуживать чат (загружать состояние, напоминания, рефлексия) можно только под его арендой.
+    Аренда продлевается с каждым пульсом; упавший воркер перестаёт пульсировать, и его чаты
+    после истечения аренды забирают остальные.
+    """
+    def __init__(self, store, worker_id, address, chat_ids, registry, lease_seconds=15.0, heartbeat_seconds=2.0,
+                 worker_ttl=10.0, vnodes=64, on_acquire=None, on_release=None, on_membership=None):
+        self.store = store
+        self.worker_id = worker_id
+        self.address = address
+        self.chat_ids = sorted(chat_ids)
+        self.registry = registry
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.worker_ttl = worker_ttl
+        self.vnodes = vnodes
+        # async on_acquire(chat_id) — фоном после получения аренды; on_release(chat_id), on_membership(число живых воркеров)
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.on_membership = on_membership
+        self.workers = {worker_id: address}
+        self.ring = HashRing(self.workers, vnodes)
+        # chat_id -> срок аренды по локальным часам
+        self._leases = {}
+        self._lease_events = {}
+        self._releasing = {}
+        self._acquired_tasks = set()
+        self._task = None
+
+    def owner(self, chat_id):
+        return self.ring.owner(chat_id)
+
+    def is_owner(self, chat_id):
+        return self.owner(chat_id) == self.worker_id
+
+    def holds_lease(self, chat_id):
+        """Действует ли аренда чата по локальным часам — без неё в общее хранилище не пишем."""
+        expires = self._leases.get(chat_id)
+        return expires is not None and expires > time.time()
+
+    def serves(self, chat_id):
+        """Чат наш по кольцу, под действующей арендой и не передаётся другому — можно запускать его задачи."""
+        return self.is_owner(chat_id) and chat_id not in self._releasing and self.holds_lease(chat_id)
+
+    def route(self, update):
+        """Адрес воркера, которому переслать обновление, или None — обрабатываем сами."""
+        chat = update.effective_chat
+        if chat is None or self.is_owner(chat.id):
+            return None
+        return self.workers.get(self.owner(chat.id))
+
+    def _event(self, chat_id):
+        event = self._lease_events.get(chat_id)
+        if event is None:
+            event = self._lease_events[chat_id] = asyncio.Event()
+        return event
+
+    async def before_load(self, chat_id):
+        """Шлюз загрузки чата в реестр: только у владельца и только под арендой (ждём её, если она ещё у прежнего)."""
+        if not self.is_owner(chat_id):
+            raise ChatNotOwned(f"Чат {chat_id} обслуживает воркер {self.owner(chat_id)}")
+        if chat_id in self._leases:
+            return
+        try:
+            await asyncio.wait_for(self._event(chat_id).wait(), timeout=self.lease_seconds * 2)
+        except asyncio.TimeoutError:
+            raise ChatNotOwned(f"Аренда чата {chat_id} не получена за {self.lease_seconds * 2:.0f} с") from None
+
+    async def start(self):
+        await self._tick()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_seconds)
+            try:
+                await self._tick()
+            except Exception:
+                logger.error("💥 [CLUSTER] Ошибка синхронизации с другими воркерами!", exc_info=True)
+                # Продлить аренды не удалось: истёкшие уже могут быть у других — прекращаем обслуживать
+                now = time.time()
+                for chat_id, expires in list(self._leases.items()):
+                    if expires < now:
+                        self._start_release(chat_id, lost=True)
+
+    async def _tick(self):
+        now = time.time()
+        workers = await asyncio.to_thread(self.store.heartbeat, self.worker_id, self.address, now, self.worker_ttl)
+        if set(workers) != set(self.workers):
+            logger.info(f"🧩 [CLUSTER] Живые воркеры: {', '.join(sorted(workers))}.")
+            self.ring = HashRing(workers, self.vnodes)
+            if self.on_membership is not None:
+                self.on_membership(len(workers))
+        self.workers = workers
+
+        owned = [chat_id for chat_id in self.chat_ids if self.is_owner(chat_id) and chat_id not in self._releasing]
+        # Свои аренды продлеваем, пока чат не выгружен — даже если он уже уходит другому
+        wanted = sorted(set(owned) | set(self._leases))
+        granted = await asyncio.to_thread(self.store.acquire, self.worker_id, wanted, now, self.lease_seconds)
+
+        for chat_id in list(self._leases):
+            if chat_id not in granted:
+                # Аренду забрали (например, процесс надолго подвис): прекращаем обслуживать немедленно
+                logger.warning(f"⚠️ [CLUSTER] Аренда чата {chat_id} потеряна.")
+                self._start_release(chat_id, lost=True)
+            elif not self.is_owner(chat_id):
+                logger.info(f"🔀 [CLUSTER] Чат {chat_id} переходит к воркеру {self.owner(chat_id)}.")
+                self._start_release(chat_id)
+            else:
+                self._leases[chat_id] = now + self.lease_seconds
+        for chat_id in owned:
+            if chat_id in granted and chat_id not in self._leases:
+                self._leases[chat_id] = now + self.lease_seconds
+                self._event(chat_id).set()
+                logger.info(f"🔑 [CLUSTER] Получена аренда чата {chat_id}.")
+                if self.on_acquire is not None:
+                    task = asyncio.create_task(self.on_acquire(chat_id))
+                    self._acquired_tasks.add(task)
+                    task.add_done_callback(self._acquired_tasks.discard)
+
+    def _start_release(self, chat_id, lost=False):
+        if lost:
+            # Чат, возможно, уже у другого: запреты на запись действуют сразу, а не после выгрузки
+            self._leases.pop(chat_id, None)
+        if chat_id not in self._releasing:
+            self._releasing[chat_id] = asyncio.create_task(self._release(chat_id, lost))
+
+    async def _release(self, chat_id, lost=False):
+        self._event(chat_id).clear()
+        try:
+            if self.on_release is not None:
+                self.on_release(chat_id)
+            if lost:
+                # Аренда у другого: наше несохранённое устарело, сброс затёр бы его записи
+                await self.registry.discard(chat_id)
+            else:
+                # Сначала сброс состояния на диск, потом аренда: новый владелец прочитает уже сохранённое
+                await self.registry.unload(chat_id)
+                await asyncio.to_thread(self.store.release, self.worker_id, chat_id)
+        except Exception:
+            logger.error(f"💥 [CLUSTER] Ошибка передачи чата {chat_id}!", exc_info=True)
+        finally:
+            self._leases.pop(chat_id, None)
+            self._releasing.pop(chat_id, None)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await asyncio.gather(*self._acquired_tasks, return_exceptions=True)
+        for chat_id in list(self._leases):
+            self._start_release(chat_id)
+        await asyncio.gather(*self._releasing.values(), return_exceptions=True)
+        # Уходим из кольца сразу, не дожидаясь истечения пульса
+        await asyncio.to_thread(self.store.remove_worker, self.worker_id)
+        await asyncio.to_thread(self.store.close)
@@ -1,160 +1,345 @@
-# --- START OF FILE bot_handlers.py ---
-
-import logging
-import asyncio
-import random
-import datetime
-from datetime import timezone
-from telegram import Update
-from telegram.constants import ChatAction
-from telegram.ext import ContextTypes
-
-import config
-
-logger = logging.getLogger(__name__)
-
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    state_manager = context.bot_data["state_manager"]
-    process_user_input = context.bot_data["process_user_input"]
-    retrieve_memory = context.bot_data["retrieve_memory"]
-    
-    if not update.message or not update.message.text or update.effective_user.id != config.ALLOWED_USER_ID: 
-        return
-        
-    user_id = update.effective_user.id
-    user_text = update.message.text
-    logger.info(f"💬-> {user_text}")
-    
-    await state_manager.check_and_apply_peak_decay()
-    await state_manager.add_history("user", user_text)
-    await state_manager.update_interaction()
-    
-    await context.bot.send_chat_action(chat_id=user_id, action=ChatAction.TYPING)
-    
-    initial_decision = await process_user_input(user_text, state_manager)
-    
-    if initial_decision and (memory_topic := initial_decision.get("memory_query_topic")):
-        decision = await retrieve_memory(user_text, memory_topic, state_manager)
-    else:
-        decision = initial_decision
-        
-    if not decision: 
-        await update.message.reply_text(random.choice(config.FALLBACK_PHRASES))
-        return
-        
-    if decision.get("forgive"): await state_manager.set_offense_state(False)
-    elif decision.get("is_offended"): await state_manager.set_offense_state(True)
-    if ignored_keywords := decision.get("ignored_topic_keywords"): await state_manager.set_pending_topic(ignored_keywords)
-    if used_thought_id := decision.get("used_thought_id"): await state_manager.remove_thought(used_thought_id)
-    if (shift := float(decision.get("mood_shift", 0.0))) != 0.0: await state_manager.apply_reaction(shift)
-    
-    if task_data := decision.get("add_task"):
-        if isinstance(task_data, dict): 
-            await state_manager.add_task(
-                text=task_data.get("text", "без темы"), 
-                minutes=int(task_data.get("minutes", 5)), 
-                priority=task_data.get("priority", "low")
-            )
-    
-    replies = decision.get("replies") or []
-    if not replies and (single_text := decision.get("text")):
-        if isinstance(single_text, str) and len(single_text) > 0:
-            logger.warning(f"⚠️ [JSON] Обнаружен ответ в поле 'text' вместо 'replies'. Исправляю.")
-            replies = [single_text]
-            
-    if replies:
-        for i, item in enumerate(replies):
-            message_text = item if isinstance(item, str) else item.get("text", "")
-            if not message_text: continue
-
-            message_text = message_text.lower()
-            logger.info(f"💡<- {message_text}")
-            await state_manager.add_history("model", message_text)
-            
-            if random.random() < config.TYPO_CHANCE and ' ' in message_text and len(message_text) > 10:
-                words = message_text.split(' '); word_idx = random.randint(0, len(words) - 1)
-                if len(words[word_idx]) > 3:
-                    ow = words[word_idx]; pos = random.randint(0, len(ow) - 2)
-                    words[word_idx] = ow[:pos] + ow[pos+1] + ow[pos] + ow[pos+2:]
-                    await update.message.reply_text(" ".join(words))
-                    await asyncio.sleep(1.5)
-                    await context.bot.send_message(chat_id=user_id, text=f"*{ow}")
-                    continue
-            
-            await update.message.reply_text(message_text)
-            if i < len(replies) - 1:
-                await context.bot.send_chat_action(chat_id=user_id, action=ChatAction.TYPING)
-                next_len = len(replies[i+1]) if isinstance(replies[i+1], str) else len(replies[i+1].get("text", ""))
-                await asyncio.sleep(min(1.0 + next_len * 0.06, 4.0))
-    else:
-        logger.info("💡<- [молчание]")
-
-async def background_tasks(context: ContextTypes.DEFAULT_TYPE):
-    state_manager = context.bot_data["state_manager"]
-    process_user_input = context.bot_data["process_user_input"]
-    generate_reflection = context.bot_data["generate_reflection"]
-    
-    now_ts = datetime.datetime.now(timezone.utc).timestamp()
-    
-    try:
-        if (now_ts - state_manager.state["last_interaction"]) > config.SILENCE_BEFORE_REFLECTION_HOURS * 3600 and \
-           (now_ts - state_manager.state["last_reflection_time"]) > config.REFLECTION_INTERVAL_HOURS * 3600:
-            thoughts = await generate_reflection(state_manager)
-            await state_manager.add_thoughts(thoughts)
-    except Exception:
-        logger.error("💥 [CRON] Ошибка в процессе рефлексии!", exc_info=True)
-
-    try:
-        tasks = state_manager.state.get("task_list", [])
-        if not tasks: return
-
-        due_tasks = sorted([t for t in tasks if now_ts >= t.get("due_time", now_ts + 1)], key=lambda x: x.get("due_time"))
-        if not due_tasks: return
-
-        task_to_process = None
-        system_trigger_text = ""
-        
-        high_priority_task = next((t for t in due_tasks if t.get("priority") == "high"), None)
-        
-        if high_priority_task:
-            task_to_process = high_priority_task
-            logger.info(f"⏰ [TASK] Напоминание: '{task_to_process['text']}'")
-            # ЧЕТКИЙ ТРИГГЕР ДЛЯ БОТА
-            system_trigger_text = f"[SYSTEM_TRIGGER: Сработало напоминание: {task_to_process['text']}]"
-            
-        elif (now_ts - state_manager.state["last_interaction"]) > config.SILENCE_BEFORE_PROACTIVE_MINUTES * 60:
-            task_to_process = due_tasks[0]
-            logger.info(f"🤔 [TASK] Follow-up: '{task_to_process['text']}'")
-            system_trigger_text = f"[SYSTEM_TRIGGER: Тишина в чате. Задача из списка: {task_to_process['text']}. Начни разговор об этом.]"
-
-        if task_to_process:
-            # Отправляем триггер
-            decision = await process_user_input(system_trigger_text, state_manager)
-            
-            replies = decision.get("replies") or []
-            if not replies and (single_text := decision.get("text")):
-                 if isinstance(single_text, str) and len(single_text) > 0:
-                    replies = [single_text]
-            
-            if replies:
-                for msg in replies:
-                    text_to_send = msg if isinstance(msg, str) else msg.get("text", "")
-                    if text_to_send:
-                        await context.bot.send_message(chat_id=config.ALLOWED_USER_ID, text=text_to_send.lower())
-                        await state_manager.add_history("model", text_to_send.lower())
-                        await asyncio.sleep(random.uniform(1.5, 3.0))
-                
-                await state_manager.remove_task(task_to_process["id"])
-            elif high_priority_task:
-                # Если проигнорил важное - переносим на 5 мин
-                logger.warning("⚠️ [TASK] Бот проигнорировал важное напоминание. Откладываю.")
-                await state_manager.remove_task(task_to_process["id"])
-                await state_manager.add_task(task_to_process["text"], 5, "high")
-                
-    except Exception:
-        logger.error("💥 [CRON] Ошибка в исполнителе задач!", exc_info=True)
-
-    try:
-        await state_manager.update_physics()
-    except Exception:
-        logger.error("💥 [CRON] Ошибка в обновлении физики!", exc_info=True)
\ No newline at end of file
+# --- START OF FILE bot_handlers.py ---
+
+import logging
+import asyncio
+import random
+import datetime
+from collections import Counter
+from datetime import timezone
+from telegram import Update
+from telegram.constants import ChatType
+from telegram.ext import ContextTypes
+
+import config
+import bot_metrics
+from bot_metrics import stage
+from bot_admission import deadline, remaining
+
+logger = logging.getLogger(__name__)
+
+class ReplySender:
+    """
+    Реплики одного ответа: сразу пишутся в историю и уходят в очередь исходящих чата.
+    Паузы "набора текста" и исправление опечаток выдерживает OutboundDispatcher — ход не ждёт отправки.
+    """
+    def __init__(self, update, context, state_manager):
+        self.outbox = context.bot_data["outbox"]
+        self.chat_id = update.effective_chat.id
+        # В группах реплика цитирует сообщение пользователя, как делал reply_text; в личке — нет
+        self.reply_to = update.message.message_id if update.effective_chat.type != ChatType.PRIVATE else None
+        self.state_manager = state_manager
+        self.queued = 0
+        self.sent = 0
+        # Тексты реплик, ушедших из потока: Decision.replies потом отфильтрованы и приведены к строкам,
+        # так что индексы потока с ними не совпадают
+        self.streamed = Counter()
+
+    async def on_reply(self, item):
+        self.streamed[item] += 1
+        await self.enqueue(item)
+
+    def unsent(self, replies):
+        """Реплики решения, которых ещё не было в потоке (сверка по тексту, с учётом повторов)."""
+        streamed = self.streamed.copy()
+        result = []
+        for item in replies:
+            if streamed[item] > 0:
+                streamed[item] -= 1
+            else:
+                result.append(item)
+        return result
+
+    def send_fallback(self):
+        self.outbox.send(self.chat_id, random.choice(config.FALLBACK_PHRASES), reply_to=self.reply_to)
+
+    async def enqueue(self, item):
+        self.queued += 1
+        message_text = item if isinstance(item, str) else item.get("text", "")
+        if not message_text: return
+
+        message_text = message_text.lower()
+        logger.info(f"💡<- {message_text}")
+        with stage("state_update"):
+            await self.state_manager.add_history("model", message_text)
+        # Первая реплика хода уходит сразу, следующие — после паузы "набора" со статусом
+        pause = min(1.0 + len(message_text) * 0.06, 4.0) if self.sent else 0.0
+        typing = self.sent > 0
+        self.sent += 1
+
+        if random.random() < config.TYPO_CHANCE and ' ' in message_text and len(message_text) > 10:
+            words = message_text.split(' '); word_idx = random.randint(0, len(words) - 1)
+            if len(words[word_idx]) > 3:
+                ow = words[word_idx]; pos = random.randint(0, len(ow) - 2)
+                words[word_idx] = ow[:pos] + ow[pos+1] + ow[pos] + ow[pos+2:]
+                self.outbox.send(self.chat_id, " ".join(words), pause=pause, reply_to=self.reply_to, typing=typing)
+                self.outbox.send(self.chat_id, f"*{ow}", pause=1.5)
+                return
+
+        self.outbox.send(self.chat_id, message_text, pause=pause, reply_to=self.reply_to, typing=typing)
+
+class ChatInbox:
+    """
+    Входящая очередь по чатам: сообщения одного чата обрабатываются строго по порядку,
+    разные чаты — параллельно. Серия быстрых сообщений склеивается в один вызов модели,
+    а сообщение, пришедшее до первой реплики ответа, перезапускает генерацию вместе с собой.
+    """
+    def __init__(self, debounce=1.5, max_wait=6.0, supersede=True):
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.supersede = supersede
+        self._queues = {}
+        self._workers = {}
+        self._turns = {}
+
+    def submit(self, update, context):
+        chat_id = update.effective_chat.id
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = asyncio.Queue()
+            self._workers[chat_id] = asyncio.create_task(self._run(chat_id, queue))
+        queue.put_nowait((update, context))
+
+        turn = self._turns.get(chat_id)
+        if turn and self.supersede:
+            generation, sender = turn
+            # Если пользователь уже видит ответ, не обрываем его — новое сообщение пойдёт следующим ходом
+            if sender.queued == 0 and not generation.done():
+                logger.info(f"✋ [INBOX] [{chat_id}] Новое сообщение до ответа — генерация будет перезапущена.")
+                generation.cancel()
+
+    def track(self, chat_id, generation, sender):
+        self._turns[chat_id] = (generation, sender)
+
+    async def _collect(self, queue):
+        batch = [await queue.get()]
+        update, context = batch[0]
+        context.bot_data["outbox"].send_action(update.effective_chat.id)
+
+        # Ждём, пока серия не затихнет на debounce секунд, но не дольше max_wait
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while (timeout := min(self.debounce, deadline - loop.time())) > 0:
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        while not queue.empty():
+            batch.append(queue.get_nowait())
+        return batch
+
+    async def _run(self, chat_id, queue):
+        # Сообщения, ответ на которые был отменён: уже в истории, но ещё без ответа
+        carried = []
+        while True:
+            try:
+                fresh = await self._collect(queue)
+                batch = carried + fresh
+                if len(batch) > 1:
+                    logger.info(f"📨 [INBOX] [{chat_id}] {len(batch)} сообщений — один вызов модели.")
+                update, context = batch[-1]
+                async with context.bot_data["chat_registry"].use(chat_id) as state_manager:
+                    with bot_metrics.trace_request("chat", f"[{chat_id}]", config.SLOW_REQUEST_SECONDS), \
+                            deadline(config.CHAT_DEADLINE_SECONDS):
+                        answered = await handle_chat_turn(
+                            update, context, state_manager,
+                            texts=[u.message.text for u, _ in batch],
+                            new_texts=[u.message.text for u, _ in fresh],
+                            inbox=self,
+                        )
+                carried = [] if answered else batch
+            except Exception:
+                logger.error(f"💥 [INBOX] [{chat_id}] Ошибка обработки сообщений!", exc_info=True)
+                carried = []
+            finally:
+                self._turns.pop(chat_id, None)
+            # Очередь пуста — воркер завершается; следующий submit запустит новый
+            if queue.empty() and not carried:
+                del self._queues[chat_id]
+                del self._workers[chat_id]
+                return
+
+    async def join(self):
+        """Ждёт, пока все чаты не будут разобраны до конца, включая отправку реплик."""
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    async def close(self):
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        pending = sum(queue.qsize() for queue in self._queues.values())
+        if pending:
+            logger.warning(f"⚠️ [INBOX] При остановке не обработано сообщений: {pending}.")
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.message or not update.message.text or not context.bot_data["chat_registry"].is_allowed(update.effective_chat.id): 
+        return
+    logger.info(f"💬-> [{update.effective_chat.id}] {update.message.text}")
+    context.bot_data["chat_inbox"].submit(update, context)
+
+async def handle_chat_turn(update: Update, context: ContextTypes.DEFAULT_TYPE, state_manager, texts, new_texts, inbox=None):
+    """Один ход диалога на пачку сообщений. False — генерацию вытеснило новое сообщение."""
+    respond_to_user = context.bot_data["respond_to_user"]
+    chat_id = update.effective_chat.id
+    
+    with stage("state_update"):
+        await state_manager.check_and_apply_peak_decay()
+        for text in new_texts:
+            await state_manager.add_history("user", text)
+        await state_manager.update_interaction()
+    
+    user_text = "\n".join(texts)
+    
+    # При потоковой генерации реплики отправляются, пока модель дописывает остальные поля
+    sender = ReplySender(update, context, state_manager)
+    generation = None
+    try:
+        # Воспоминание, если оно нужно, уже учтено внутри: память ищется до вызова модели
+        generation = asyncio.create_task(respond_to_user(user_text, state_manager, on_reply=sender.on_reply))
+        if inbox is not None:
+            inbox.track(chat_id, generation, sender)
+        await asyncio.wait({generation}, timeout=remaining())
+        if not generation.done():
+            if sender.queued == 0:
+                # Срок хода вышел, а пользователь ещё ничего не видел: заглушка сейчас лучше ответа когда-нибудь
+                logger.warning(f"⏳ [ADMISSION] [{chat_id}] Ответ не готов за {config.CHAT_DEADLINE_SECONDS:.0f} с — отвечаю заглушкой.")
+                bot_metrics.admission_shed_total.inc(work="chat_deadline")
+                sender.send_fallback()
+                return True
+            # Ответ уже пошёл — дописываем его без срока
+            await asyncio.wait({generation})
+        if generation.cancelled():
+            logger.info(f"✋ [INBOX] [{chat_id}] Генерация вытеснена новым сообщением.")
+            return False
+        decision = generation.result()
+            
+        if not decision: 
+            if sender.queued == 0:
+                sender.send_fallback()
+            return True
+            
+        # Decision уже провалидирован и приведён к типам — здесь только применяем
+        with stage("state_update"):
+            if decision.forgive: await state_manager.set_offense_state(False)
+            elif decision.is_offended: await state_manager.set_offense_state(True)
+            if decision.ignored_topic_keywords: await state_manager.set_pending_topic(decision.ignored_topic_keywords)
+            if decision.used_thought_id: await state_manager.remove_thought(decision.used_thought_id)
+            if decision.mood_shift != 0.0: await state_manager.apply_reaction(decision.mood_shift)
+            
+            if task := decision.add_task:
+                await state_manager.add_task(text=task.text, minutes=task.minutes, priority=task.priority)
+        
+        # Уже отправленные из потока реплики не дублируем
+        for item in sender.unsent(decision.replies):
+            await sender.enqueue(item)
+    finally:
+        if generation is not None and not generation.done():
+            generation.cancel()
+
+    if sender.sent == 0:
+        logger.info("💡<- [молчание]")
+    return True
+
+async def background_tasks(context: ContextTypes.DEFAULT_TYPE):
+    chat_registry = context.bot_data["chat_registry"]
+    now_ts = datetime.datetime.now(timezone.utc).timestamp()
+    
+    # Рефлексия — только для загруженных чатов; задачи ведёт TaskScheduler, настроение считается при чтении
+    chat_ids = chat_registry.active_chat_ids()
+    await asyncio.gather(*(run_chat_background(context, chat_id, now_ts) for chat_id in chat_ids))
+
+async def run_chat_background(context: ContextTypes.DEFAULT_TYPE, chat_id, now_ts):
+    try:
+        async with context.bot_data["chat_registry"].use(chat_id) as state_manager:
+            with stage("background"):
+                await chat_background_tasks(context, chat_id, state_manager, now_ts)
+    except Exception:
+        logger.error(f"💥 [CRON] Ошибка фоновых задач чата {chat_id}!", exc_info=True)
+
+async def chat_background_tasks(context: ContextTypes.DEFAULT_TYPE, chat_id, state_manager, now_ts):
+    generate_reflection = context.bot_data["generate_reflection"]
+    
+    try:
+        if (now_ts - state_manager.state["last_interaction"]) > config.SILENCE_BEFORE_REFLECTION_HOURS * 3600 and \
+           (now_ts - state_manager.state["last_reflection_time"]) > config.REFLECTION_INTERVAL_HOURS * 3600:
+            # Рефлексия подождёт следующего прохода, если модель занята ответами пользователям
+            if not context.bot_data["admission"].admit("reflection"):
+                logger.info(f"🚧 [CRON] [{chat_id}] Модель под нагрузкой — рефлексия отложена.")
+                return
+            thoughts = await generate_reflection(state_manager)
+            await state_manager.add_thoughts(thoughts)
+    except Exception:
+        logger.error("💥 [CRON] Ошибка в процессе рефлексии!", exc_info=True)
+
+async def run_due_tasks(context: ContextTypes.DEFAULT_TYPE, chat_id):
+    """Колбэк планировщика: обрабатывает наступившую задачу чата и возвращает время следующего пробуждения."""
+    if not context.bot_data["chat_registry"].owns(chat_id):
+        # Чат у другого воркера — его напоминания ведёт тот
+        return None
+    async with context.bot_data["chat_registry"].use(chat_id) as state_manager:
+        now_ts = datetime.datetime.now(timezone.utc).timestamp()
+        try:
+            with bot_metrics.trace_request("task", f"[{chat_id}]", config.SLOW_REQUEST_SECONDS):
+                await process_due_task(context, chat_id, state_manager, now_ts)
+        except Exception:
+            logger.error("💥 [TASK] Ошибка в исполнителе задач!", exc_info=True)
+        return next_task_wake(state_manager, datetime.datetime.now(timezone.utc).timestamp())
+
+def next_task_wake(state_manager, now_ts):
+    next_due = state_manager.next_task_due()
+    if next_due is None or next_due > now_ts:
+        return next_due
+    # Есть наступившие задачи: важные — сразу, остальные ждут тишины в чате (но не дольше интервала повтора)
+    if any(t.get("priority") == "high" for t in state_manager.tasks.due(now_ts)):
+        return now_ts
+    silence_until = state_manager.state["last_interaction"] + config.SILENCE_BEFORE_PROACTIVE_MINUTES * 60
+    return silence_until if silence_until > now_ts else now_ts + config.TASK_RETRY_SECONDS
+
+async def process_due_task(context: ContextTypes.DEFAULT_TYPE, chat_id, state_manager, now_ts):
+    process_user_input = context.bot_data["process_user_input"]
+    
+    due_tasks = list(state_manager.tasks.due(now_ts))
+    if not due_tasks: return
+
+    task_to_process = None
+    system_trigger_text = ""
+    
+    high_priority_task = min((t for t in due_tasks if t.get("priority") == "high"), key=lambda x: x["due_time"], default=None)
+    
+    if high_priority_task:
+        task_to_process = high_priority_task
+        logger.info(f"⏰ [TASK] Напоминание: '{task_to_process['text']}'")
+        # ЧЕТКИЙ ТРИГГЕР ДЛЯ БОТА
+        system_trigger_text = f"[SYSTEM_TRIGGER: Сработало напоминание: {task_to_process['text']}]"
+        
+    elif (now_ts - state_manager.state["last_interaction"]) > config.SILENCE_BEFORE_PROACTIVE_MINUTES * 60:
+        # Проактивная задача не срочная: под нагрузкой планировщик вернётся к ней через TASK_RETRY_SECONDS
+        if not context.bot_data["admission"].admit("proactive_task"):
+            logger.info(f"🚧 [TASK] [{chat_id}] Модель под нагрузкой — проактивная задача отложена.")
+            return
+        # Вершина кучи — самая ранняя из наступивших
+        task_to_process = state_manager.tasks.peek()
+        logger.info(f"🤔 [TASK] Follow-up: '{task_to_process['text']}'")
+        system_trigger_text = f"[SYSTEM_TRIGGER: Тишина в чате. Задача из списка: {task_to_process['text']}. Начни разговор об этом.]"
+
+    if task_to_process:
+        # Отправляем триггер
+        decision = await process_user_input(system_trigger_text, state_manager)
+        replies = decision.replies if decision else []
+        
+        if replies:
+            # Паузы между репликами выдерживает очередь исходящих, таймер планировщика не держим
+            outbox = context.bot_data["outbox"]
+            sent = 0
+            for text_to_send in replies:
+                if text_to_send:
+                    await state_manager.add_history("model", text_to_send.lower())
+                    outbox.send(chat_id, text_to_send.lower(), pause=random.uniform(1.5, 3.0) if sent else 0.0)
+                    sent += 1
+            
+            await state_manager.remove_task(task_to_process["id"])
+        elif high_priority_task:
+            # Если проигнорил важное - переносим на 5 мин (перенос в куче, без удаления и вставки)
+            logger.warning("⚠️ [TASK] Бот проигнорировал важное напоминание. Откладываю.")
+            await state_manager.reschedule_task(task_to_process["id"], 5)
@@ -0,0 +1,265 @@
+# --- START OF FILE bot_json.py ---
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def decode_json_string(raw):
+    try:
+        return json.loads(f'"{raw}"', strict=False)
+    except json.JSONDecodeError:
+        return raw
+
+
+class StreamingRepliesParser:
+    """
+    Инкрементальный разбор JSON-ответа модели.
+    Кормится кусками текста и отдаёт строки из массива "replies" сразу, как только строка закрылась,
+    не дожидаясь остальных полей. Элемент-объект {"text": ...} отдаётся своим текстом на своём месте —
+    так же его потом прочитает Decision.
+    """
+    def __init__(self, field="replies"):
+        self.field = field
+        self.stack = []
+        self.started = False
+        self.done = False
+        self.in_string = False
+        self.escape = False
+        self.expect_key = False
+        self.key = None
+        # Ключ внутри элемента-объекта массива
+        self.item_key = None
+        self.buffer = []
+        self.emitted = 0
+
+    def feed(self, chunk):
+        out = []
+        for ch in chunk:
+            if self.done:
+                break
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                    self.buffer.append(ch)
+                elif ch == '\\':
+                    self.escape = True
+                    self.buffer.append(ch)
+                elif ch == '"':
+                    self.in_string = False
+                    self._end_string(out)
+                else:
+                    self.buffer.append(ch)
+                continue
+            if not self.started:
+                # Всё до первой "{" (```json и прочий мусор) пропускаем
+                if ch == '{':
+                    self.started = True
+                    self.stack.append('{')
+                    self.expect_key = True
+                continue
+            if ch == '"':
+                self.in_string = True
+                self.buffer = []
+            elif ch in '{[':
+                self.stack.append(ch)
+                self.expect_key = ch == '{'
+                self.item_key = None
+            elif ch in '}]':
+                if self.stack:
+                    self.stack.pop()
+                self.expect_key = False
+                if not self.stack:
+                    self.done = True
+            elif ch == ',':
+                self.expect_key = self.stack[-1] == '{'
+            elif ch == ':':
+                self.expect_key = False
+        return out
+
+    def _end_string(self, out):
+        value = decode_json_string("".join(self.buffer))
+        if self.stack[-1] == '{' and self.expect_key:
+            if len(self.stack) == 1:
+                self.key = value
+            elif len(self.stack) == 3:
+                self.item_key = value
+            return
+        if self.key != self.field or len(self.stack) < 2 or self.stack[1] != '[':
+            return
+        if len(self.stack) == 2 or (len(self.stack) == 3 and self.stack[2] == '{' and self.item_key == "text"):
+            out.append(value)
+            self.emitted += 1
+
+
+BAREWORDS = {"True": "true", "False": "false", "None": "null", "true": "true", "false": "false", "null": "null"}
+
+
+def extract_json_object(text):
+    """Первый сбалансированный {...} с учётом строк; в отличие от жадного \\{.*\\} не склеивает несколько объектов."""
+    start = text.find('{')
+    if start == -1:
+        return text.strip()
+    depth = 0
+    in_string = False
+    escape = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return text[start:].strip()
+
+
+def _strip_trailing_comma(out):
+    while out and out[-1] in " \t\r\n":
+        out.pop()
+    if out and out[-1] == ',':
+        out.pop()
+
+
+def _closes_string(text, pos):
+    # Кавычка закрывает строку, только если за ней идёт структурный символ — иначе это кавычка внутри текста
+    while pos < len(text) and text[pos] in " \t\r\n":
+        pos += 1
+    return pos >= len(text) or text[pos] in ',:}]'
+
+
+def repair_json_text(text):
+    """
+    Терпимый перепис JSON-подобного текста: кавычки, переводы строк внутри строк,
+    висячие запятые, True/False/None, обрыв посреди строки или массива.
+    """
+    start = min((i for i in (text.find('{'), text.find('[')) if i != -1), default=-1)
+    if start == -1:
+        return None
+    out = []
+    stack = []
+    quote = None
+    i = start
+    while i < len(text):
+        ch = text[i]
+        if quote:
+            if ch == '\\' and i + 1 < len(text):
+                nxt = text[i + 1]
+                out.append("'" if nxt == "'" else ch + nxt)
+                i += 2
+                continue
+            if ch == quote and _closes_string(text, i + 1):
+                out.append('"')
+                quote = None
+            elif ch == '"':
+                out.append('\\"')
+            elif ch == '\n':
+                out.append('\\n')
+            elif ch == '\r':
+                pass
+            elif ch == '\t':
+                out.append('\\t')
+            else:
+                out.append(ch)
+            i += 1
+            continue
+
+        if ch in '"\'':
+            quote = ch
+            out.append('"')
+        elif ch in '{[':
+            stack.append('}' if ch == '{' else ']')
+            out.append(ch)
+        elif ch in '}]':
+            _strip_trailing_comma(out)
+            if stack:
+                out.append(stack.pop())
+            if not stack:
+                break
+        elif ch.isalpha():
+            j = i
+            while j < len(text) and (text[j].isalnum() or text[j] == '_'):
+                j += 1
+            word = text[i:j]
+            out.append(BAREWORDS.get(word, f'"{word}"'))
+            i = j
+            continue
+        elif ch == '`':
+            pass
+        else:
+            out.append(ch)
+        i += 1
+
+    # Ответ оборвался: закрываем строку и все открытые скобки
+    if quote:
+        out.append('"')
+    _strip_trailing_comma(out)
+    while out and out[-1] in " \t\r\n":
+        out.pop()
+    if out and out[-1] == ':':
+        out.append('null')
+    while stack:
+        _strip_trailing_comma(out)
+        out.append(stack.pop())
+    return "".join(out)
+
+
+def coerce_schema(data, list_field="replies"):
+    """Типовые промахи модели: голый список вместо объекта, строка вместо списка, 'text' вместо 'replies'."""
+    if isinstance(data, list):
+        return {list_field: data}
+    if not isinstance(data, dict):
+        return None
+    value = data.get(list_field)
+    if isinstance(value, str):
+        data[list_field] = [value] if value else []
+    if list_field == "replies" and not data.get("replies") and isinstance(data.get("text"), str) and data["text"]:
+        logger.warning("⚠️ [JSON] Обнаружен ответ в поле 'text' вместо 'replies'. Исправляю.")
+        data["replies"] = [data.pop("text")]
+    return data
+
+
+def parse_strict(text, list_field="replies"):
+    return coerce_schema(json.loads(extract_json_object(text)), list_field)
+
+
+def recover_json(text, list_field="replies"):
+    """Локальное восстановление без обращения к модели. None — если не вышло."""
+    repaired = repair_json_text(text)
+    if not repaired:
+        return None
+    try:
+        return coerce_schema(json.loads(repaired, strict=False), list_field)
+    except (json.JSONDecodeError, ValueError):
+        return None
+
+
+class RecoveryStats:
+    """Сколько ответов разобрано сразу, сколько спасено локально и сколько потребовало ремонта моделью."""
+    OUTCOMES = ("strict", "local", "remote", "failed")
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.OUTCOMES, 0)
+
+    def record(self, outcome):
+        self.counts[outcome] += 1
+
+    def summary(self):
+        broken = self.counts["local"] + self.counts["remote"] + self.counts["failed"]
+        if not broken:
+            return "битых ответов не было"
+        local_rate = self.counts["local"] / broken * 100
+        remote_rate = self.counts["remote"] / broken * 100
+        return (f"битых: {broken}, локально: {self.counts['local']} ({local_rate:.0f}%), "
+                f"моделью: {self.counts['remote']} ({remote_rate:.0f}%), не спасено: {self.counts['failed']}; "
+                f"сэкономлено вызовов: {self.counts['local']}")
@@ -0,0 +1,455 @@
+# --- START OF FILE bot_llm.py ---
+
+import time
+import json
+import asyncio
+import logging
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com"
+
+# Настройки безопасности: отключаем блокировки
+SAFETY_CATEGORIES = (
+    'HARM_CATEGORY_HARASSMENT',
+    'HARM_CATEGORY_HATE_SPEECH',
+    'HARM_CATEGORY_SEXUALLY_EXPLICIT',
+    'HARM_CATEGORY_DANGEROUS_CONTENT',
+)
+
+
+class LLMError(Exception):
+    """
+    Ошибка вызова модели. kind — класс ошибки:
+    quota, auth, network, timeout, server, blocked, bad_request.
+    """
+    def __init__(self, message, kind="server"):
+        super().__init__(message)
+        self.kind = kind
+
+
+class LLMResponse:
+    """Ответ модели в форме, совместимой с тем, как его читает остальной код (как у SDK)."""
+    def __init__(self, candidates, block_reason=None, prompt_tokens=0, output_tokens=0):
+        self.candidates = candidates
+        self.block_reason = block_reason
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens = output_tokens
+
+    @property
+    def text(self):
+        if not self.candidates:
+            raise ValueError("Ответ не содержит кандидатов")
+        return self.candidates[0]
+
+
+class LLMProvider:
+    """Минимальный интерфейс провайдера: один асинхронный вызов генерации."""
+    name = "base"
+
+    async def generate(self, prompt, temperature, api_key, response_schema=None):
+        raise NotImplementedError
+
+    async def stream(self, prompt, temperature, api_key, response_schema=None):
+        # По умолчанию "поток" из одного куска — для провайдеров без потоковой генерации
+        response = await self.generate(prompt, temperature, api_key, response_schema)
+        if not response.candidates:
+            raise LLMError(f"Blocked: {response.block_reason or 'Неизвестно'}", kind="blocked")
+        yield response.text
+
+    def warm_up(self):
+        """Блокирующая подготовка до первого вызова (ленивые импорты); вызывается в фоновом потоке на старте."""
+
+    async def aclose(self):
+        pass
+
+
+class GeminiRestProvider(LLMProvider):
+    """
+    Нативный асинхронный REST-клиент Gemini поверх общего httpx.AsyncClient с пулом соединений.
+    base_url можно направить на локальный заглушечный сервер.
+    """
+    name = "rest"
+
+    def __init__(self, model_name, base_url=None, proxy=None, pool_size=10):
+        self.model_name = model_name
+        self.client = httpx.AsyncClient(
+            base_url=base_url or GEMINI_BASE_URL,
+            proxy=proxy,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=60),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+        )
+
+    def _payload(self, prompt, temperature, response_schema=None):
+        generation_config = {"temperature": temperature}
+        if response_schema is not None:
+            # Структурированный вывод: модель обязана вернуть JSON по схеме
+            generation_config["responseMimeType"] = "application/json"
+            generation_config["responseSchema"] = response_schema
+        return {
+            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+            "generationConfig": generation_config,
+            "safetySettings": [{"category": c, "threshold": "BLOCK_NONE"} for c in SAFETY_CATEGORIES],
+        }
+
+    @staticmethod
+    def _raise_for_status(response):
+        if response.status_code < 400:
+            return
+        status = response.status_code
+        try:
+            message = response.json().get("error", {}).get("message", response.text)
+        except ValueError:
+            message = response.text
+        if status == 429:
+            kind = "quota"
+        elif status in (401, 403) or "API_KEY" in message or "API key" in message:
+            kind = "auth"
+        elif status >= 500:
+            kind = "server"
+        else:
+            kind = "bad_request"
+        raise LLMError(f"HTTP {status}: {message[:200]}", kind=kind)
+
+    @staticmethod
+    def _parse(data):
+        candidates = []
+        for candidate in data.get("candidates", []):
+            parts = candidate.get("content", {}).get("parts", [])
+            text = "".join(part.get("text", "") for part in parts)
+            if text:
+                candidates.append(text)
+        block_reason = data.get("promptFeedback", {}).get("blockReason")
+        usage = data.get("usageMetadata", {})
+        return LLMResponse(
+            candidates,
+            block_reason=block_reason,
+            prompt_tokens=usage.get("promptTokenCount", 0),
+            output_tokens=usage.get("candidatesTokenCount", 0),
+        )
+
+    async def generate(self, prompt, temperature, api_key, response_schema=None):
+        try:
+            response = await self.client.post(
+                f"/v1beta/models/{self.model_name}:generateContent",
+                headers={"x-goog-api-key": api_key},
+                json=self._payload(prompt, temperature, response_schema),
+            )
+        except httpx.TimeoutException as e:
+            raise LLMError(f"Таймаут HTTP: {e}", kind="timeout") from e
+        except httpx.HTTPError as e:
+            raise LLMError(f"Сетевая ошибка: {e}", kind="network") from e
+        self._raise_for_status(response)
+        return self._parse(response.json())
+
+    async def stream(self, prompt, temperature, api_key, response_schema=None):
+        try:
+            async with self.client.stream(
+                "POST",
+                f"/v1beta/models/{self.model_name}:streamGenerateContent",
+                params={"alt": "sse"},
+                headers={"x-goog-api-key": api_key},
+                json=self._payload(prompt, temperature, response_schema),
+            ) as response:
+                if response.status_code >= 400:
+                    await response.aread()
+                    self._raise_for_status(response)
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    chunk = self._parse(json.loads(line[5:]))
+                    if chunk.candidates:
+                        yield chunk.candidates[0]
+                    elif chunk.block_reason:
+                        raise LLMError(f"Blocked: {chunk.block_reason}", kind="blocked")
+        except httpx.TimeoutException as e:
+            raise LLMError(f"Таймаут HTTP: {e}", kind="timeout") from e
+        except httpx.HTTPError as e:
+            raise LLMError(f"Сетевая ошибка: {e}", kind="network") from e
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class GenaiSdkProvider(LLMProvider):
+    """
+    Старый путь через google.generativeai (блокирующий вызов).
+    Работает в собственном ограниченном пуле потоков, чтобы не занимать общий executor цикла.
+    Сам SDK импортируется при первом вызове (это ~0.5 с) — уже в потоке пула, а не на старте.
+    """
+    name = "sdk"
+
+    def __init__(self, model_name, max_workers=4):
+        self.genai = None
+        self.model_name = model_name
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="genai")
+        # genai.configure глобален, поэтому смена ключа и вызов сериализуются
+        self._configure_lock = threading.Lock()
+
+    def _import_sdk(self):
+        if self.genai is None:
+            import google.generativeai as genai
+            self.genai = genai
+        return self.genai
+
+    def warm_up(self):
+        self._import_sdk()
+
+    def _call(self, prompt, temperature, api_key, response_schema=None):
+        genai = self._import_sdk()
+        generation_config = {"temperature": temperature}
+        if response_schema is not None:
+            generation_config["response_mime_type"] = "application/json"
+            generation_config["response_schema"] = response_schema
+        with self._configure_lock:
+            genai.configure(api_key=api_key, transport='rest')
+            model = genai.GenerativeModel(
+                self.model_name, safety_settings={c: 'BLOCK_NONE' for c in SAFETY_CATEGORIES}
+            )
+            response = model.generate_content(prompt, generation_config=genai.types.GenerationConfig(**generation_config))
+        candidates = []
+        try:
+            if response.candidates and response.text:
+                candidates.append(response.text)
+        except ValueError:
+            pass
+        block_reason = None
+        if not response.candidates and response.prompt_feedback:
+            block_reason = response.prompt_feedback.block_reason.name
+        usage = getattr(response, "usage_metadata", None)
+        return LLMResponse(
+            candidates,
+            block_reason=block_reason,
+            prompt_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+            output_tokens=getattr(usage, "candidates_token_count", 0) or 0,
+        )
+
+    async def generate(self, prompt, temperature, api_key, response_schema=None):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, self._call, prompt, temperature, api_key, response_schema)
+        except LLMError:
+            raise
+        except Exception as e:
+            text = str(e)
+            if "429" in text or "quota" in text.lower():
+                kind = "quota"
+            elif "API key" in text or "API_KEY" in text or "403" in text:
+                kind = "auth"
+            else:
+                kind = "server"
+            raise LLMError(text, kind=kind) from e
+
+    async def aclose(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class LLMClient:
+    """
+    Обёртка над провайдером: таймаут на вызов, отмена, ограничение числа одновременных запросов.
+    on_service(seconds) получает время самого вызова — без ожидания свободного слота.
+    """
+    def __init__(self, provider, timeout=30.0, max_concurrency=4, on_service=None):
+        self.provider = provider
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.on_service = on_service
+
+    def _observe_service(self, started):
+        if self.on_service is not None:
+            self.on_service(time.monotonic() - started)
+
+    async def generate(self, prompt, temperature, api_key, timeout=None, response_schema=None):
+        async with self.semaphore:
+            started = time.monotonic()
+            try:
+                response = await asyncio.wait_for(
+                    self.provider.generate(prompt, temperature, api_key, response_schema), timeout or self.timeout
+                )
+            except asyncio.TimeoutError as e:
+                self._observe_service(started)
+                raise LLMError(f"Нет ответа за {timeout or self.timeout:.0f} с", kind="timeout") from e
+            self._observe_service(started)
+            return response
+
+    async def stream(self, prompt, temperature, api_key, timeout=None, response_schema=None):
+        async with self.semaphore:
+            started = time.monotonic()
+            try:
+                async with asyncio.timeout(timeout or self.timeout):
+                    async for chunk in self.provider.stream(prompt, temperature, api_key, response_schema):
+                        yield chunk
+            except TimeoutError as e:
+                self._observe_service(started)
+                raise LLMError(f"Поток не завершился за {timeout or self.timeout:.0f} с", kind="timeout") from e
+            self._observe_service(started)
+
+    async def aclose(self):
+        await self.provider.aclose()
+
+
+# Базовый кулдаун ключа по классу ошибки, удваивается с каждой ошибкой подряд
+KEY_COOLDOWN_SECONDS = {
+    "quota": 30.0,
+    "auth": 3600.0,
+    "network": 2.0,
+    "timeout": 5.0,
+    "server": 5.0,
+}
+# Ошибки, которые зависят от промпта, а не от ключа: ключ за них не штрафуем
+NON_KEY_ERRORS = frozenset({"blocked", "bad_request", "cancelled"})
+RECENT_ERROR_WINDOW_SECONDS = 300
+
+
+class KeyState:
+    """Здоровье одного API-ключа: запросы в полёте, ошибки, токен-бакет, кулдаун."""
+    def __init__(self, index, key, rpm, burst):
+        self.index = index
+        self.key = key
+        self.label = f"#{index + 1}"
+        self.rate = rpm / 60.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.consecutive_failures = 0
+        self.recent_errors = deque(maxlen=50)
+        self.requests = 0
+        self.successes = 0
+        self.errors = Counter()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, now):
+        return now >= self.cooldown_until and self.tokens >= 1.0
+
+    def wait_time(self, now):
+        token_wait = 0.0 if self.tokens >= 1.0 else (1.0 - self.tokens) / self.rate
+        return max(self.cooldown_until - now, token_wait, 0.0)
+
+    def health_penalty(self, now):
+        recent = sum(1 for ts, _ in self.recent_errors if now - ts < RECENT_ERROR_WINDOW_SECONDS)
+        return self.in_flight + 2 * recent
+
+
+class KeyPool:
+    """
+    Пул API-ключей. На каждый запрос выбирается самый здоровый доступный ключ;
+    глобальное состояние не меняется, поэтому параллельные вызовы не мешают друг другу.
+    """
+    def __init__(self, keys, rpm=15, burst=3, max_cooldown=600.0):
+        self.keys = [KeyState(i, key, rpm, burst) for i, key in enumerate(keys)]
+        self.max_cooldown = max_cooldown
+
+    def __len__(self):
+        return len(self.keys)
+
+    async def acquire(self, exclude=(), max_wait=10.0):
+        deadline = time.monotonic() + max_wait
+        while True:
+            now = time.monotonic()
+            candidates = [k for k in self.keys if k.index not in exclude]
+            for k in candidates:
+                k.refill(now)
+            ready = [k for k in candidates if k.available(now)]
+            if ready:
+                best = min(ready, key=lambda k: (k.health_penalty(now), -k.tokens))
+                best.tokens -= 1.0
+                best.in_flight += 1
+                best.requests += 1
+                return best
+            if not candidates:
+                return None
+            wait = min(k.wait_time(now) for k in candidates)
+            if now + wait > deadline:
+                return None
+            await asyncio.sleep(wait)
+
+    def wait_time(self):
+        """Через сколько секунд будет доступен хоть один ключ; 0 — свободный есть сейчас."""
+        now = time.monotonic()
+        for k in self.keys:
+            k.refill(now)
+        return min((k.wait_time(now) for k in self.keys), default=0.0)
+
+    def release(self, key_state, error_kind=None):
+        key_state.in_flight -= 1
+        if error_kind is None:
+            key_state.successes += 1
+            key_state.consecutive_failures = 0
+            return
+        key_state.errors[error_kind] += 1
+        if error_kind in NON_KEY_ERRORS:
+            return
+        now = time.monotonic()
+        key_state.recent_errors.append((now, error_kind))
+        key_state.consecutive_failures += 1
+        base = KEY_COOLDOWN_SECONDS.get(error_kind, 5.0)
+        cooldown = min(self.max_cooldown, base * 2 ** (key_state.consecutive_failures - 1))
+        key_state.cooldown_until = now + cooldown
+        logger.warning(f"🔌 [KEYS] Ключ {key_state.label} на паузе {cooldown:.0f} с ({error_kind}, ошибок подряд: {key_state.consecutive_failures}).")
+
+    def stats(self):
+        now = time.monotonic()
+        for k in self.keys:
+            k.refill(now)
+        return {
+            k.label: {
+                "requests": k.requests,
+                "successes": k.successes,
+                "in_flight": k.in_flight,
+                "tokens": round(k.tokens, 2),
+                "cooldown_left": round(max(0.0, k.cooldown_until - now), 1),
+                "errors": dict(k.errors),
+            }
+            for k in self.keys
+        }
+
+
+class LatencyTracker:
+    """Скользящее окно задержек успешных вызовов по типам (chat, reflection, ...)."""
+    def __init__(self, window=200):
+        self.window = window
+        self.samples = {}
+
+    def record(self, call_type, seconds):
+        self.samples.setdefault(call_type, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, call_type, q, min_samples=20):
+        samples = self.samples.get(call_type)
+        if not samples or len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class HedgeLimiter:
+    """Не больше max_per_minute дублирующих запросов, чтобы хеджирование не удваивало расход квоты."""
+    def __init__(self, max_per_minute):
+        self.max_per_minute = max_per_minute
+        self.sent = deque()
+
+    def try_acquire(self):
+        now = time.monotonic()
+        while self.sent and now - self.sent[0] > 60:
+            self.sent.popleft()
+        if len(self.sent) >= self.max_per_minute:
+            return False
+        self.sent.append(now)
+        return True
+
+
+def create_provider(kind, model_name, base_url=None, proxy=None, pool_size=10):
+    if kind == "rest":
+        return GeminiRestProvider(model_name, base_url=base_url, proxy=proxy, pool_size=pool_size)
+    if kind == "sdk":
+        return GenaiSdkProvider(model_name, max_workers=pool_size)
+    raise ValueError(f"Неизвестный LLM-провайдер: {kind}")
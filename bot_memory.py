@@ -0,0 +1,343 @@
+# --- START OF FILE bot_memory.py ---
+
+import os
+import re
+import json
+import math
+import zlib
+import heapq
+import marshal
+import logging
+import functools
+from collections import defaultdict
+
+# numpy импортируется лениво (import_numpy): он нужен только семантическому индексу, а на старте это ~0.1 с
+np = None
+
+logger = logging.getLogger(__name__)
+
+# Версия формата снимка индекса памяти: при изменении разбора текста старые снимки просто перестраиваются
+MEMORY_SNAPSHOT_VERSION = 1
+
+TOKEN_RE = re.compile(r"[а-яёa-z0-9]+")
+# Явная просьба вспомнить: память подтягивается до первого вызова модели
+RECALL_TRIGGERS_RE = re.compile(
+    r"\b(помнишь|помните|вспомни\w*|припомни\w*|напомни,?\s+(что|как|где|когда|кто|какой|какая|какое)|"
+    r"(ты|вы)\s+забыл\w*|не\s+забыл\w*|я\s+(же\s+)?(тебе\s+)?(говорил|говорила|рассказывал|рассказывала|писал|писала)|"
+    r"мы\s+(же\s+)?(говорили|обсуждали|болтали))\b",
+    re.IGNORECASE,
+)
+# Косвенные признаки: вопрос о прошлом — повод спекулятивно подготовить ответ с памятью
+RECALL_HINTS_RE = re.compile(r"\b(тогда|раньше|прошл\w+|когда-то|давно|в\s+тот\s+раз)\b", re.IGNORECASE)
+RUSSIAN_VOWELS = "аеиоуыэюя"
+
+STOP_WORDS = frozenset("""
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было
+вот от меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до вас
+нибудь опять уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их
+чем была сам чтоб без будто чего раз тоже себе под будет ж тогда кто этот того потому этого какой
+совсем ним здесь этом один почти мой тем чтобы нее сейчас были куда зачем всех никогда можно при
+наконец два об другой хоть после над больше тот через эти нас про всего них какая много разве
+три эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда
+конечно всю между помнишь помню вспомни
+""".split())
+
+# Окончания в порядке убывания длины — берётся самое длинное подходящее
+_PERFECTIVE_GERUND = ("ившись", "ывшись", "вшись", "ивши", "ывши", "вши", "ив", "ыв", "в")
+_REFLEXIVE = ("ся", "сь")
+_ADJECTIVAL = (
+    "ими", "ыми", "его", "ого", "ему", "ому", "ее", "ие", "ые", "ое", "ей", "ий", "ый", "ой",
+    "ем", "им", "ым", "ом", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею",
+)
+_VERB = (
+    "уйте", "ейте", "ила", "ыла", "ена", "ите", "или", "ыли", "ило", "ыло", "ено", "ует", "уют",
+    "ены", "ить", "ыть", "ишь", "ете", "йте", "ешь", "нно", "ла", "на", "ли", "ем", "ло", "но",
+    "ет", "ют", "ны", "ть", "ей", "уй", "ил", "ыл", "им", "ым", "ен", "ят", "ит", "ыт", "ую", "ю",
+)
+_NOUN = (
+    "иями", "ями", "ами", "ией", "иям", "ием", "иях", "ев", "ов", "ие", "ье", "еи", "ии", "ей",
+    "ой", "ий", "ям", "ем", "ам", "ом", "ах", "ях", "ию", "ью", "ия", "ья", "а", "е", "и", "й",
+    "о", "у", "ы", "ь", "ю", "я",
+)
+
+
+@functools.cache
+def import_numpy():
+    """numpy при первой надобности; None — не установлен (семантический индекс необязателен, работает только BM25)."""
+    global np
+    try:
+        import numpy
+    except ImportError:
+        return None
+    np = numpy
+    return np
+
+
+def _strip(word, endings, min_len):
+    for ending in endings:
+        if word.endswith(ending) and len(word) - len(ending) >= min_len:
+            return word[:-len(ending)], True
+    return word, False
+
+
+@functools.lru_cache(maxsize=65536)
+def stem(word):
+    """Облегчённый стеммер для русского: срезает типовые окончания, не трогая короткую основу."""
+    if len(word) <= 3 or not any(ch in RUSSIAN_VOWELS for ch in word):
+        return word
+    # Граница RV: всё после первой гласной
+    rv_start = next(i for i, ch in enumerate(word) if ch in RUSSIAN_VOWELS) + 1
+    head, rv = word[:rv_start], word[rv_start:]
+    min_len = 1
+
+    rv, stripped = _strip(rv, _PERFECTIVE_GERUND, min_len)
+    if not stripped:
+        rv, _ = _strip(rv, _REFLEXIVE, min_len)
+        rv, stripped = _strip(rv, _ADJECTIVAL, min_len)
+        if not stripped:
+            rv, stripped = _strip(rv, _VERB, min_len)
+            if not stripped:
+                rv, _ = _strip(rv, _NOUN, min_len)
+    if rv.endswith("ост") and len(rv) > 4:
+        rv = rv[:-3]
+    if rv.endswith("нн"):
+        rv = rv[:-1]
+    return head + rv
+
+
+def detect_recall_intent(text):
+    return bool(RECALL_TRIGGERS_RE.search(text))
+
+
+def may_be_recall(text):
+    return "?" in text and bool(RECALL_HINTS_RE.search(text))
+
+
+def normalize(text):
+    text = text.lower().replace("ё", "е")
+    return [stem(token) for token in TOKEN_RE.findall(text) if token not in STOP_WORDS]
+
+
+def _fingerprint(messages, count):
+    """Контрольная сумма первых count сообщений архива по краям: снимок индекса относится именно к ним."""
+    if not count:
+        return 0
+    edges = [[m.get("role"), m.get("content")] for m in (messages[0], messages[count - 1])]
+    return zlib.crc32(json.dumps(edges, ensure_ascii=False).encode('utf-8'))
+
+
+class MemoryIndex:
+    """
+    Инвертированный индекс по сообщениям с ранжированием BM25.
+    Пополняется по одному сообщению, поэтому поиск — это проход по спискам вхождений, а не по всему архиву.
+    """
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs = []
+        self.doc_lengths = []
+        self.total_length = 0
+        self.postings = defaultdict(dict)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, message):
+        doc_id = len(self.docs)
+        terms = normalize(message.get("content", ""))
+        self.docs.append(message)
+        self.doc_lengths.append(len(terms))
+        self.total_length += len(terms)
+        for term in terms:
+            postings = self.postings[term]
+            postings[doc_id] = postings.get(doc_id, 0) + 1
+        return doc_id
+
+    def extend(self, messages):
+        for message in messages:
+            self.add(message)
+
+    @classmethod
+    def load(cls, messages, snapshot_path=None):
+        """
+        Индекс по архиву: начало берётся из бинарного снимка, если он совпадает с архивом,
+        разбирается только хвост. Возвращает (индекс, сколько сообщений взято из снимка).
+        """
+        index = cls()
+        restored = index._restore(snapshot_path, messages) if snapshot_path else 0
+        index.extend(messages[restored:])
+        return index, restored
+
+    def _restore(self, path, messages):
+        try:
+            with open(path, 'rb') as f:
+                version, count, fingerprint, doc_lengths, postings = marshal.load(f)
+        except FileNotFoundError:
+            return 0
+        except (EOFError, ValueError, TypeError, OSError) as e:
+            logger.warning(f"⚠️ [MEMORY] Снимок индекса {path} не читается ({e}) — строю заново.")
+            return 0
+        if (version != MEMORY_SNAPSHOT_VERSION or count > len(messages) or len(doc_lengths) != count
+                or fingerprint != _fingerprint(messages, count)):
+            logger.info(f"🧠 [MEMORY] Снимок индекса {path} не совпадает с архивом — строю заново.")
+            return 0
+        self.docs = messages[:count]
+        self.doc_lengths = doc_lengths
+        self.total_length = sum(doc_lengths)
+        self.postings = defaultdict(dict, postings)
+        return count
+
+    def snapshot(self):
+        """Снимок индекса в marshal: загрузка — одно чтение файла вместо стемминга всего архива."""
+        return marshal.dumps((MEMORY_SNAPSHOT_VERSION, len(self.docs), _fingerprint(self.docs, len(self.docs)),
+                              self.doc_lengths, dict(self.postings)))
+
+    @staticmethod
+    def write_snapshot(path, payload):
+        temp_file = path + ".tmp"
+        with open(temp_file, 'wb') as f:
+            f.write(payload)
+        os.replace(temp_file, path)
+
+    def search(self, query, limit=20):
+        terms = set(normalize(query))
+        if not terms or not self.docs:
+            return []
+
+        n_docs = len(self.docs)
+        avg_length = self.total_length / n_docs or 1.0
+        scores = defaultdict(float)
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [(score, self.docs[doc_id]) for doc_id, score in best]
+
+
+class SemanticIndex:
+    """
+    Локальный семантический индекс: хешированные символьные n-граммы -> L2-нормированные векторы.
+    Матрица лежит в memory-mapped файле, строка i соответствует i-му сообщению архива.
+    Поиск top-k — одно матрично-векторное произведение.
+    """
+    def __init__(self, docs, path=None, dim=512, ngram_sizes=(3, 4)):
+        self.docs = docs
+        self.path = path
+        self.dim = dim
+        self.ngram_sizes = ngram_sizes
+        self.count = 0
+        self.matrix = None
+        self._open()
+
+    @property
+    def _meta_path(self):
+        return self.path + ".json"
+
+    def _open(self):
+        capacity = max(1024, len(self.docs) * 2)
+        if self.path is None:
+            self.matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+        else:
+            meta = {}
+            if os.path.exists(self._meta_path) and os.path.exists(self.path):
+                with open(self._meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+            if meta.get("dim") == self.dim:
+                # Строки позиционные: всё, что за пределами архива, просто пересчитаем
+                self.count = min(meta.get("count", 0), len(self.docs))
+                capacity = max(capacity, meta.get("capacity", 0))
+            self._map(capacity, keep=self.count > 0)
+
+        missing = self.docs[self.count:]
+        for message in missing:
+            self._append_vector(self.embed(message.get("content", "")))
+        if missing:
+            logger.info(f"🧭 [SEMANTIC] Проиндексировано {len(missing)} сообщений (всего {self.count}).")
+        self._save_meta()
+
+    def _map(self, capacity, keep=True):
+        mode = 'r+' if keep and os.path.exists(self.path) else 'w+'
+        if mode == 'r+' and os.path.getsize(self.path) < capacity * self.dim * 4:
+            with open(self.path, 'r+b') as f:
+                f.truncate(capacity * self.dim * 4)
+        self.matrix = np.memmap(self.path, dtype=np.float32, mode=mode, shape=(capacity, self.dim))
+
+    def _grow(self):
+        capacity = self.matrix.shape[0] * 2
+        if self.path is None:
+            grown = np.zeros((capacity, self.dim), dtype=np.float32)
+            grown[:self.count] = self.matrix[:self.count]
+            self.matrix = grown
+        else:
+            self.matrix.flush()
+            del self.matrix
+            self._map(capacity)
+
+    def _save_meta(self):
+        if self.path is None:
+            return
+        with open(self._meta_path, 'w', encoding='utf-8') as f:
+            json.dump({"dim": self.dim, "count": self.count, "capacity": self.matrix.shape[0]}, f)
+
+    def embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        padded = " " + " ".join(TOKEN_RE.findall(text.lower().replace("ё", "е"))) + " "
+        for n in self.ngram_sizes:
+            for i in range(len(padded) - n + 1):
+                # crc32 стабилен между запусками, в отличие от hash()
+                h = zlib.crc32(padded[i:i + n].encode('utf-8'))
+                vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector
+
+    def _append_vector(self, vector):
+        if self.count >= self.matrix.shape[0]:
+            self._grow()
+        self.matrix[self.count] = vector
+        self.count += 1
+
+    def add(self, message):
+        self._append_vector(self.embed(message.get("content", "")))
+
+    def search(self, query, limit=20, exclude_last=0):
+        end = self.count - exclude_last
+        if end <= 0 or not query.strip():
+            return []
+        scores = self.matrix[:end] @ self.embed(query)
+        limit = min(limit, end)
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.docs[i]) for i in top if scores[i] > 0]
+
+    def close(self):
+        if self.path is not None:
+            self.matrix.flush()
+            self._save_meta()
+
+    def discard(self):
+        """Закрытие без сохранения: метаданные не трогаем, строки сверх их count при открытии пересчитаются."""
+        self.matrix = None
+
+
+def hybrid_search(memory_index, semantic_index, query, limit=20, rrf_k=60):
+    """Объединяет BM25 и семантическую выдачу через Reciprocal Rank Fusion."""
+    keyword_hits = memory_index.search(query, limit=limit)
+    if semantic_index is None:
+        return keyword_hits
+    semantic_hits = semantic_index.search(query, limit=limit)
+
+    fused = {}
+    for hits in (keyword_hits, semantic_hits):
+        for rank, (_, message) in enumerate(hits):
+            key = id(message)
+            score, _ = fused.get(key, (0.0, message))
+            fused[key] = (score + 1.0 / (rrf_k + rank + 1), message)
+    return heapq.nlargest(limit, fused.values(), key=lambda item: item[0])
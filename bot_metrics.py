@@ -0,0 +1,240 @@
+# --- START OF FILE bot_metrics.py ---
+
+import time
+import asyncio
+import logging
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Все наблюдения делаются из потока цикла событий, поэтому метрики обходятся без блокировок:
+# между двумя await никто другой их не меняет.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+STAGES = ("state_update", "prompt_build", "llm_wait", "json_parse", "memory_search",
+          "telegram_send", "typing_sleep", "state_flush", "background")
+
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # ключ — кортеж пар (метка, значение); значение — [счётчики по корзинам, сумма, количество]
+        self.series = {}
+
+    def observe(self, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, seconds)] += 1
+        series[1] += seconds
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels_text(key + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(key)} {total:.6f}")
+            lines.append(f"{self.name}_count{_labels_text(key)} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_labels_text(key)} {value}" for key, value in sorted(self.values.items()))
+        return lines
+
+
+class Gauge:
+    """Значения снимаются при каждом запросе /metrics: collect() -> {кортеж пар (метка, значение): число}."""
+    def __init__(self, name, help_text, metric_type="gauge"):
+        self.name = name
+        self.help_text = help_text
+        # "counter" — для счётчиков, которые ведёт сам источник (например, KeyPool)
+        self.metric_type = metric_type
+        self.collect = None
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        if self.collect is not None:
+            lines.extend(f"{self.name}{_labels_text(key)} {value}" for key, value in sorted(self.collect().items()))
+        return lines
+
+
+stage_seconds = Histogram("bot_stage_seconds", "Время этапов обработки сообщения")
+llm_seconds = Histogram("bot_llm_seconds", "Время ожидания ответа модели по типу вызова")
+request_seconds = Histogram("bot_request_seconds", "Полное время хода диалога от сообщения до последней реплики")
+requests_total = Counter("bot_requests_total", "Обработанные ходы диалога")
+llm_retries_total = Counter("bot_llm_retries_total", "Повторы вызова модели после ошибки")
+key_rotations_total = Counter("bot_key_rotations_total", "Переключения на другой API-ключ")
+hedges_total = Counter("bot_hedges_total", "Дублирующие (хеджированные) запросы")
+json_repairs_total = Counter("bot_json_repairs_total", "Разбор ответа модели по исходу")
+llm_tokens_total = Counter("bot_llm_tokens_total", "Входные и выходные токены по данным API")
+slow_requests_total = Counter("bot_slow_requests_total", "Ходы диалога дольше порога медленного запроса")
+webhook_updates_total = Counter("bot_webhook_updates_total", "Запросы к вебхуку по итогу приёма")
+admission_shed_total = Counter("bot_admission_shed_total", "Работа, отложенная или пропущенная из-за нагрузки на модель")
+# По API-ключам — видно, какой ключ упирается в лимит или сыплет ошибками
+key_requests_total = Gauge("bot_llm_key_requests_total", "Запросы к модели по API-ключу", "counter")
+key_errors_total = Gauge("bot_llm_key_errors_total", "Ошибки вызова модели по API-ключу и классу ошибки", "counter")
+key_in_flight = Gauge("bot_key_in_flight", "Запросы к модели в полёте по API-ключу")
+key_cooldown_seconds = Gauge("bot_key_cooldown_seconds", "Сколько ещё ключ на паузе после ошибок")
+key_tokens = Gauge("bot_key_tokens", "Токены в бакете RPM-лимита ключа")
+
+METRICS = (stage_seconds, llm_seconds, request_seconds, requests_total, llm_retries_total, key_rotations_total,
+           hedges_total, json_repairs_total, llm_tokens_total, slow_requests_total, webhook_updates_total,
+           admission_shed_total, key_requests_total, key_errors_total, key_in_flight, key_cooldown_seconds, key_tokens)
+
+
+def reset_metrics():
+    """Обнуляет все метрики — например, чтобы бенчмарк не учитывал подготовительный прогон."""
+    for metric in METRICS:
+        if isinstance(metric, Histogram):
+            metric.series.clear()
+        elif isinstance(metric, Counter):
+            metric.values.clear()
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class RequestTrace:
+    """Разбивка одного хода по этапам — для лога медленных запросов."""
+    def __init__(self, kind):
+        self.kind = kind
+        self.started = time.monotonic()
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def breakdown(self):
+        return ", ".join(f"{stage}={seconds:.2f}s" for stage, seconds in sorted(self.stages.items(), key=lambda item: -item[1]))
+
+
+# Задачи, созданные внутри хода (генерация, отправка реплик), наследуют трассу через контекст
+_current_trace = contextvars.ContextVar("request_trace", default=None)
+
+
+def observe_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def stage(name):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.monotonic() - started)
+
+
+@contextmanager
+def trace_request(kind, label, slow_seconds):
+    """Оборачивает ход диалога: полное время в гистограмму, при превышении порога — разбивка в лог."""
+    trace = RequestTrace(kind)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        elapsed = time.monotonic() - trace.started
+        request_seconds.observe(elapsed, kind=kind)
+        requests_total.inc(kind=kind)
+        if elapsed > slow_seconds:
+            slow_requests_total.inc(kind=kind)
+            logger.warning(f"🐢 [SLOW] {kind} {label}: {elapsed:.2f}s ({trace.breakdown() or 'этапы не замерены'})")
+
+
+class StartupProfile:
+    """
+    Фазы холодного старта (--profile-startup). Критический путь отмечается по порядку через mark(),
+    фазы, идущие параллельно с ним (фоновый поток, задача), — через overlapped(). Отчёт — на первом обновлении.
+    """
+    def __init__(self, started, enabled=False):
+        self.enabled = enabled
+        self.started = started
+        self.last = started
+        self.phases = []
+        # Пишется и из фонового потока: list.append атомарен
+        self.background = []
+        self.reported = False
+
+    def mark(self, phase):
+        """Фаза phase закончилась сейчас (началась с прошлой отметки)."""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    @contextmanager
+    def overlapped(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.background.append((phase, time.perf_counter() - started))
+
+    def report(self):
+        if not self.enabled or self.reported:
+            return
+        self.reported = True
+        lines = [f"  {phase:<16} {seconds * 1000:7.0f} ms" for phase, seconds in self.phases]
+        lines += [f"  {phase:<16} {seconds * 1000:7.0f} ms  (параллельно)" for phase, seconds in self.background]
+        logger.info(f"⏱️ [STARTUP] До первого обновления {(self.last - self.started) * 1000:.0f} ms:\n" + "\n".join(lines))
+
+
+async def _handle_http(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Заголовки запроса не нужны, но их надо дочитать
+        while (line := await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render_metrics().encode('utf-8')
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host, port):
+    """Локальный /metrics в формате Prometheus на asyncio, без сторонних зависимостей."""
+    server = await asyncio.start_server(_handle_http, host, port)
+    logger.info(f"📈 [METRICS] Метрики доступны на http://{host}:{port}/metrics")
+    return server
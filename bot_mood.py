@@ -0,0 +1,56 @@
+# --- START OF FILE bot_mood.py ---
+
+import math
+import zlib
+
+# Настроение хранится как параметры на момент mood_updated_at и вычисляется на любой момент аналитически.
+# Константы — те же, что у прежнего минутного тика update_physics: один шаг = одна минута.
+MOOD_STEP_SECONDS = 60
+SPIKE_DECAY = 0.1
+RESIDUAL_DECAY = 0.9
+BASE_TARGET = 0.60
+BASE_REVERSION = 0.05
+BASE_MIN = 0.2
+BASE_MAX = 0.9
+MIN_TOTAL_MOOD = 0.05
+# Дрейф базового настроения: детерминированный шум от (seed, время) вместо random.uniform на каждом тике.
+# Амплитуда и шаг узлов подобраны под разброс старого процесса (±0.01 за шаг при возврате 5%).
+DRIFT_AMPLITUDE = 0.03
+DRIFT_KNOT_SECONDS = 20 * 60
+
+
+def _noise(seed, knot):
+    return zlib.crc32(f"{seed}:{knot}".encode('ascii')) / 0xFFFFFFFF * 2 - 1
+
+
+def drift(seed, ts):
+    """Гладкий шум в [-DRIFT_AMPLITUDE, DRIFT_AMPLITUDE]: одинаковый для одинаковых seed и времени."""
+    position = ts / DRIFT_KNOT_SECONDS
+    knot = math.floor(position)
+    frac = position - knot
+    smooth = frac * frac * (3 - 2 * frac)
+    a, b = _noise(seed, knot), _noise(seed, knot + 1)
+    return (a + (b - a) * smooth) * DRIFT_AMPLITUDE
+
+
+def decayed(state, now_ts):
+    """(базовая составляющая без дрейфа, spike, residual) на момент now_ts."""
+    steps = max(0.0, (now_ts - state["mood_updated_at"]) / MOOD_STEP_SECONDS)
+    base = BASE_TARGET + (state["base_mood"] - BASE_TARGET) * (1 - BASE_REVERSION) ** steps
+    return base, state["spike"] * SPIKE_DECAY ** steps, state["residual"] * RESIDUAL_DECAY ** steps
+
+
+def base_mood_at(state, now_ts):
+    base, _, _ = decayed(state, now_ts)
+    return max(BASE_MIN, min(BASE_MAX, base + drift(state["mood_seed"], now_ts)))
+
+
+def total_mood_at(state, now_ts):
+    _, spike, residual = decayed(state, now_ts)
+    return max(MIN_TOTAL_MOOD, base_mood_at(state, now_ts) + spike + residual)
+
+
+def fold(state, now_ts):
+    """Переносит точку отсчёта на now_ts: после этого параметры можно менять как текущие значения."""
+    state["base_mood"], state["spike"], state["residual"] = decayed(state, now_ts)
+    state["mood_updated_at"] = now_ts
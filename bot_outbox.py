@@ -0,0 +1,222 @@
+# --- START OF FILE bot_outbox.py ---
+
+import time
+import asyncio
+import logging
+import datetime
+import contextvars
+from collections import deque
+
+from telegram.constants import ChatAction
+from telegram.error import RetryAfter, TimedOut, NetworkError, TelegramError
+
+from bot_metrics import observe_stage
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate запросов в секунду, пачка до burst подряд."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        self._refill(time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def is_full(self):
+        """Полное ведро ничем не отличается от нового — его можно забыть."""
+        self._refill(time.monotonic())
+        return self.tokens >= self.burst
+
+
+class OutboundItem:
+    """Одна отправка: сообщение или статус набора. pause — не раньше чем через столько секунд после прошлой реплики чата."""
+    __slots__ = ("kind", "text", "pause", "reply_to", "attempts")
+
+    def __init__(self, kind, text=None, pause=0.0, reply_to=None):
+        self.kind = kind
+        self.text = text
+        self.pause = pause
+        self.reply_to = reply_to
+        self.attempts = 0
+
+
+class OutboundDispatcher:
+    """
+    Исходящие сообщения через очередь на каждый чат: обработчик кладёт реплики с паузами "набора текста"
+    и сразу освобождается, а паузы, лимиты Telegram и flood control (RetryAfter) выдерживает воркер чата.
+    Порядок внутри чата сохраняется, разные чаты отправляются параллельно под общим лимитом.
+    """
+    def __init__(self, bot, global_rate=25.0, global_burst=30, chat_rate=1.0, chat_burst=3,
+                 group_rate=20 / 60, group_burst=3, max_retries=3, idle_seconds=60.0):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        # Состояние чата (лимит, время последней реплики) забывается после стольких секунд тишины
+        self.idle_seconds = idle_seconds
+        self._queues = {}
+        self._workers = {}
+        self._buckets = {}
+        # Время последней доставленной реплики чата (loop.time()): от него отсчитываются паузы набора
+        self._last_sent = {}
+        self._paused_until = {}
+        self._hurry = False
+
+    def pending(self, chat_id):
+        queue = self._queues.get(chat_id)
+        return len(queue) if queue else 0
+
+    def send(self, chat_id, text, pause=0.0, reply_to=None, typing=False):
+        """Ставит реплику в очередь чата; typing — перед ней показать "печатает..." на время паузы."""
+        if typing:
+            self._enqueue(chat_id, OutboundItem("action"))
+        self._enqueue(chat_id, OutboundItem("message", text, pause, reply_to))
+
+    def send_action(self, chat_id):
+        self._enqueue(chat_id, OutboundItem("action"))
+
+    def _enqueue(self, chat_id, item):
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+        queue.append(item)
+        if chat_id not in self._workers:
+            # Воркер живёт дольше хода, который его создал: не наследуем трассу запроса
+            self._workers[chat_id] = asyncio.create_task(self._run(chat_id, queue), context=contextvars.Context())
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные id — группы и каналы: у Telegram для них лимит строже
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    async def _run(self, chat_id, queue):
+        loop = asyncio.get_running_loop()
+        try:
+            while queue:
+                item = queue[0]
+                if item.kind == "message" and not self._hurry:
+                    # Время генерации уже засчитано в паузу: ждём только остаток
+                    delay = self._last_sent.get(chat_id, 0.0) + item.pause - loop.time()
+                    if delay > 0:
+                        started = loop.time()
+                        await asyncio.sleep(delay)
+                        observe_stage("typing_sleep", loop.time() - started)
+                await self._wait_limits(chat_id, item)
+                if await self._deliver(chat_id, item):
+                    queue.popleft()
+                    if item.kind == "message":
+                        self._last_sent[chat_id] = loop.time()
+        finally:
+            del self._workers[chat_id]
+            if not queue:
+                del self._queues[chat_id]
+            self._prune_idle(loop.time())
+
+    def _prune_idle(self, loop_now):
+        """
+        Забывает чаты без очереди, чьё состояние уже не влияет на отправку: ведро снова полное,
+        пауза набора давно прошла, flood control истёк. Иначе словари росли бы на каждый чат,
+        включая выгруженные из реестра и ушедшие другому воркеру.
+        """
+        now = time.monotonic()
+        for chat_id in list(self._buckets.keys() | self._last_sent.keys() | self._paused_until.keys()):
+            if chat_id in self._queues:
+                continue
+            bucket = self._buckets.get(chat_id)
+            if ((bucket is None or bucket.is_full())
+                    and loop_now - self._last_sent.get(chat_id, float("-inf")) >= self.idle_seconds
+                    and self._paused_until.get(chat_id, 0.0) <= now):
+                self._buckets.pop(chat_id, None)
+                self._last_sent.pop(chat_id, None)
+                self._paused_until.pop(chat_id, None)
+
+    async def _wait_limits(self, chat_id, item):
+        buckets = (self.global_bucket, self._chat_bucket(chat_id)) if item.kind == "message" else (self.global_bucket,)
+        while True:
+            wait = max(
+                self._paused_until.get(chat_id, 0.0) - time.monotonic(),
+                *(bucket.wait_time() for bucket in buckets),
+            )
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        for bucket in buckets:
+            bucket.take()
+
+    async def _deliver(self, chat_id, item):
+        """True — отправлено или выброшено окончательно, False — повторить позже."""
+        item.attempts += 1
+        started = time.monotonic()
+        try:
+            if item.kind == "action":
+                await self.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+            elif item.reply_to is not None:
+                await self.bot.send_message(chat_id=chat_id, text=item.text, reply_to_message_id=item.reply_to,
+                                            allow_sending_without_reply=True)
+            else:
+                await self.bot.send_message(chat_id=chat_id, text=item.text)
+            return True
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            seconds = retry_after.total_seconds() if isinstance(retry_after, datetime.timedelta) else float(retry_after)
+            self._paused_until[chat_id] = time.monotonic() + seconds
+            logger.warning(f"🚦 [OUTBOX] [{chat_id}] Flood control: пауза {seconds:.0f} с.")
+            # Ожидание RetryAfter не считается попыткой — Telegram сам сказал, когда можно
+            item.attempts -= 1
+            return False
+        except (TimedOut, NetworkError) as e:
+            if item.kind == "action" or item.attempts > self.max_retries:
+                logger.error(f"💥 [OUTBOX] [{chat_id}] Не удалось отправить после {item.attempts} попыток: {e}")
+                return True
+            self._paused_until[chat_id] = time.monotonic() + 2 ** (item.attempts - 1)
+            logger.warning(f"⚠️ [OUTBOX] [{chat_id}] Сбой сети ({e}), повтор через {2 ** (item.attempts - 1)} с.")
+            return False
+        except TelegramError as e:
+            # BadRequest, Forbidden и т.п. — повтор не поможет
+            logger.error(f"💥 [OUTBOX] [{chat_id}] Отправка отклонена: {e}")
+            return True
+        except Exception:
+            logger.error(f"💥 [OUTBOX] [{chat_id}] Ошибка отправки!", exc_info=True)
+            return True
+        finally:
+            observe_stage("telegram_send", time.monotonic() - started)
+
+    async def join(self):
+        """Ждёт, пока все очереди не будут отправлены."""
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    async def close(self, timeout=5.0):
+        # При остановке реплики уже записаны в историю — досылаем без пауз набора, но не дольше timeout
+        self._hurry = True
+        workers = list(self._workers.values())
+        if workers:
+            _, still_running = await asyncio.wait(workers, timeout=timeout)
+            for worker in still_running:
+                worker.cancel()
+            await asyncio.gather(*still_running, return_exceptions=True)
+        pending = sum(len(queue) for queue in self._queues.values())
+        if pending:
+            logger.warning(f"⚠️ [OUTBOX] При остановке не отправлено: {pending}.")
@@ -0,0 +1,287 @@
+# --- START OF FILE bot_prompt.py ---
+
+import os
+import math
+import string
+import logging
+import weakref
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_FIELDS = frozenset({
+    "memory_context_block", "system_alert", "msk_time", "mood_instr", "thoughts_block",
+    "history", "task_execution_block", "user_text", "existing_tasks",
+})
+# Медленно меняющиеся поля: от них (и от шаблона) зависит кешированный префикс.
+# Время, задачи, мысли и память меняются каждый ход — им место после префикса
+PREFIX_FIELDS = frozenset({"system_alert", "mood_instr"})
+PREFIX_CACHE_SIZE = 16
+MIN_DUPLICATE_LINE_LENGTH = 40
+# Старые реплики длиннее этого обрезаются: целиком они почти никогда не нужны
+HISTORY_LINE_MAX_CHARS = 600
+# Грубая локальная оценка: кириллица ~2 байта на символ и ~2.5 символа на токен
+BYTES_PER_TOKEN = 4.5
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text.encode('utf-8')) / BYTES_PER_TOKEN) if text else 0
+
+
+def truncate_text(text, max_chars):
+    return text if len(text) <= max_chars else text[:max_chars].rstrip() + "…"
+
+
+def format_history_line(message):
+    return f"{'Юзер' if message['role']=='user' else 'Ты'}: {truncate_text(message['content'], HISTORY_LINE_MAX_CHARS)}"
+
+
+class ContextPacker:
+    """
+    Заполняет бюджет токенов одного вызова по приоритетам секций
+    и ведёт учёт: сколько токенов ушло и сколько отброшено по каждой секции.
+    """
+    def __init__(self, call_type, budget):
+        self.call_type = call_type
+        self.budget = budget
+        self.used = 0
+        self.used_by = {}
+        self.dropped_by = {}
+
+    @property
+    def remaining(self):
+        return max(0, self.budget - self.used)
+
+    def _account(self, section, used, dropped=0):
+        self.used += used
+        self.used_by[section] = self.used_by.get(section, 0) + used
+        if dropped:
+            self.dropped_by[section] = self.dropped_by.get(section, 0) + dropped
+
+    def drop(self, section, tokens):
+        self._account(section, 0, tokens)
+
+    def reserve_tokens(self, section, tokens):
+        self._account(section, tokens)
+
+    def reserve(self, section, *texts):
+        # Обязательная часть: учитывается всегда, даже если бюджет превышен
+        self._account(section, sum(estimate_tokens(t) for t in texts))
+
+    def take(self, section, items):
+        """Берёт элементы по порядку, пока они помещаются; остальное отбрасывает."""
+        kept = []
+        for i, item in enumerate(items):
+            tokens = estimate_tokens(item)
+            if tokens > self.remaining:
+                self.drop(section, sum(estimate_tokens(rest) for rest in items[i:]))
+                break
+            kept.append(item)
+            self._account(section, tokens)
+        return kept
+
+    def take_newest(self, section, items):
+        """То же, но с конца (свежие важнее); возвращает в хронологическом порядке."""
+        return list(reversed(self.take(section, list(reversed(items)))))
+
+    def fit_text(self, section, text):
+        tokens = estimate_tokens(text)
+        if tokens <= self.remaining:
+            self._account(section, tokens)
+            return text
+        max_chars = int(len(text) * self.remaining / tokens)
+        fitted = truncate_text(text, max_chars)
+        fitted_tokens = estimate_tokens(fitted)
+        self._account(section, fitted_tokens, tokens - fitted_tokens)
+        return fitted
+
+    def log(self):
+        used = ", ".join(f"{k}: {v}" for k, v in self.used_by.items())
+        dropped = ", ".join(f"{k}: {v}" for k, v in self.dropped_by.items()) or "нет"
+        logger.info(f"📦 [CONTEXT] {self.call_type}: {self.used}/{self.budget} токенов ({used}). Отброшено: {dropped}.")
+
+
+def find_duplicate_sections(template, min_length=MIN_DUPLICATE_LINE_LENGTH):
+    """Ищет повторяющиеся строки шаблона: каждая копия — впустую потраченные входные токены."""
+    seen = {}
+    duplicates = []
+    for line_no, line in enumerate(template.splitlines(), start=1):
+        normalized = " ".join(line.split())
+        if len(normalized) < min_length:
+            continue
+        if normalized in seen:
+            duplicates.append((seen[normalized], line_no, normalized))
+        else:
+            seen[normalized] = line_no
+    return duplicates
+
+
+class HistoryBuffer:
+    """
+    Кольцевой буфер отрендеренной истории.
+    Новые сообщения дописываются по одной строке, старые вытесняются с начала — без повторного join.
+    """
+    def __init__(self):
+        self.entries = deque()
+        self.text = ""
+        self.tokens = 0
+
+    @staticmethod
+    def _entry(message):
+        line = format_history_line(message)
+        return message, line, estimate_tokens(line)
+
+    def _rebuild(self, chat_history):
+        self.entries = deque(self._entry(m) for m in chat_history)
+        self.text = "\n".join(line for _, line, _ in self.entries)
+        self.tokens = sum(tokens for _, _, tokens in self.entries)
+
+    def render(self, chat_history):
+        if not chat_history:
+            self.entries.clear()
+            self.text = ""
+            self.tokens = 0
+            return self.text
+        if not self.entries:
+            self._rebuild(chat_history)
+            return self.text
+
+        # Ищем последнее уже отрендеренное сообщение (по идентичности объекта) с конца истории
+        last_known = self.entries[-1][0]
+        position = next((i for i in range(len(chat_history) - 1, -1, -1) if chat_history[i] is last_known), None)
+        if position is None:
+            self._rebuild(chat_history)
+            return self.text
+
+        for message in chat_history[position + 1:]:
+            entry = self._entry(message)
+            self.text = f"{self.text}\n{entry[1]}" if self.entries else entry[1]
+            self.entries.append(entry)
+            self.tokens += entry[2]
+        while self.entries and (len(self.entries) > len(chat_history) or self.entries[0][0] is not chat_history[0]):
+            _, line, tokens = self.entries.popleft()
+            self.text = self.text[len(line) + 1:]
+            self.tokens -= tokens
+        return self.text
+
+    def pack(self, chat_history, packer, leave=0):
+        """Свежие реплики в пределах бюджета (минус leave токенов для следующих секций); старые отбрасываются с пометкой."""
+        self.render(chat_history)
+        budget = max(0, packer.remaining - leave)
+        if self.tokens <= budget:
+            packer.reserve("history", self.text)
+            return self.text
+        kept = []
+        for _, line, tokens in reversed(self.entries):
+            if tokens > budget:
+                break
+            kept.append(line)
+            budget -= tokens
+        dropped = len(self.entries) - len(kept)
+        kept.reverse()
+        text = "\n".join([f"[…ещё {dropped} более ранних сообщений опущено]"] + kept)
+        packer.reserve("history", text)
+        packer.drop("history", self.tokens - sum(estimate_tokens(line) for line in kept))
+        return text
+
+
+class PromptBuilder:
+    """
+    Шаблон промпта, разобранный один раз на сегменты.
+    Перечитывается только при изменении mtime файла. Префикс — всё до первого поля не из PREFIX_FIELDS —
+    кешируется по вариантам настроения и тревоги; остальное рендерится на каждый вызов.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        self._prefix = []
+        self._suffix = []
+        self._prefix_fields = ()
+        self._static_tokens = 0
+        self._prefix_cache = OrderedDict()
+        self._histories = weakref.WeakKeyDictionary()
+
+    def _parse(self, template):
+        segments = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(template):
+            if field is None:
+                segments.append((literal, None))
+                continue
+            if field not in TEMPLATE_FIELDS:
+                raise ValueError(f"Неизвестное поле шаблона: {{{field}}}")
+            if format_spec or conversion:
+                raise ValueError(f"Форматирование полей не поддерживается: {{{field}}}")
+            segments.append((literal, field))
+        fields = {field for _, field in segments if field}
+        if "history" not in fields:
+            raise ValueError("В шаблоне нет поля {history}")
+        for missing in TEMPLATE_FIELDS - fields:
+            logger.warning(f"⚠️ [PROMPT] В шаблоне нет поля {{{missing}}}")
+        return segments
+
+    def _load(self, mtime):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            template = f.read()
+        segments = self._parse(template)
+
+        # Префикс тянется до первого часто меняющегося поля (самое позднее — до {history})
+        split_at = next(i for i, (_, field) in enumerate(segments) if field and field not in PREFIX_FIELDS)
+        self._prefix = segments[:split_at] + [(segments[split_at][0], None)]
+        self._suffix = [("", segments[split_at][1])] + segments[split_at + 1:]
+        self._prefix_fields = tuple(field for _, field in self._prefix if field)
+        self._static_tokens = sum(estimate_tokens(literal) for literal, _ in segments)
+        self._prefix_cache.clear()
+        self._mtime = mtime
+
+        for first, second, text in find_duplicate_sections(template):
+            logger.warning(f"⚠️ [PROMPT] Дубликат в шаблоне: строка {second} повторяет строку {first}: '{text[:60]}'")
+        prefix_chars = sum(len(literal) for literal, _ in self._prefix)
+        logger.info(f"📝 [PROMPT] Шаблон загружен ({len(template)} символов, кешируемый префикс {prefix_chars}).")
+
+    def ensure_loaded(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        try:
+            self._load(mtime)
+        except ValueError as e:
+            if self._mtime is None:
+                raise
+            # Битая правка шаблона не должна ронять бота — работаем на прошлой версии
+            logger.error(f"❌ [PROMPT] Новый шаблон не прошёл проверку: {e}. Оставляю прежний.")
+            self._mtime = mtime
+
+    @staticmethod
+    def _render(segments, fields):
+        return "".join(literal + (fields[field] if field else "") for literal, field in segments)
+
+    def static_tokens(self):
+        self.ensure_loaded()
+        return self._static_tokens
+
+    def _history_buffer(self, state_manager):
+        buffer = self._histories.get(state_manager)
+        if buffer is None:
+            buffer = self._histories[state_manager] = HistoryBuffer()
+        return buffer
+
+    def render_history(self, state_manager, packer=None, leave=0):
+        buffer = self._history_buffer(state_manager)
+        if packer is None:
+            return buffer.render(state_manager.state["chat_history"])
+        return buffer.pack(state_manager.state["chat_history"], packer, leave=leave)
+
+    def build(self, state_manager, history=None, **fields):
+        self.ensure_loaded()
+        key = tuple(fields[name] for name in self._prefix_fields)
+        prefix = self._prefix_cache.get(key)
+        if prefix is None:
+            prefix = self._render(self._prefix, fields)
+            self._prefix_cache[key] = prefix
+            if len(self._prefix_cache) > PREFIX_CACHE_SIZE:
+                self._prefix_cache.popitem(last=False)
+        else:
+            self._prefix_cache.move_to_end(key)
+        if history is None:
+            history = self.render_history(state_manager)
+        return prefix + self._render(self._suffix, {**fields, "history": history})
@@ -0,0 +1,151 @@
+# --- START OF FILE bot_registry.py ---
+
+import asyncio
+import logging
+import functools
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class ChatStateRegistry:
+    """
+    Отдельный StateManager на каждый чат: настроение, задачи, мысли и история у каждого свои.
+    Состояние чата загружается при первом сообщении, холодные чаты выгружаются по LRU
+    (с принудительным сбросом на диск), так что память растёт с числом активных чатов, а не всех когда-либо виденных.
+    """
+    def __init__(self, factory, allowed_chat_ids, max_active=32, memory_budget=50000, on_load=None,
+                 before_load=None, owner_check=None, lease_check=None):
+        self.factory = factory
+        self.allowed_chat_ids = frozenset(allowed_chat_ids)
+        self.max_active = max_active
+        # Бюджет памяти в сообщениях: индексы памяти держат весь архив чата в RAM
+        self.memory_budget = memory_budget
+        # on_load(chat_id, state_manager) вызывается в цикле событий после загрузки чата
+        self.on_load = on_load
+        # Для нескольких воркеров: async before_load(chat_id) ждёт аренду чата или бросает исключение,
+        # owner_check(chat_id) — обслуживает ли чат этот процесс, lease_check(chat_id) — действует ли ещё его аренда
+        # (проверяется перед каждой записью состояния в общее хранилище)
+        self.before_load = before_load
+        self.owner_check = owner_check
+        self.lease_check = lease_check
+        self._active = OrderedDict()
+        self._loading = {}
+        self._in_use = {}
+        self._unloading = {}
+
+    def is_allowed(self, chat_id):
+        return chat_id in self.allowed_chat_ids
+
+    def owns(self, chat_id):
+        return self.owner_check is None or self.owner_check(chat_id)
+
+    def active_chat_ids(self):
+        return list(self._active)
+
+    def memory_usage(self):
+        return sum(len(sm.memory_index) for sm in self._active.values())
+
+    @asynccontextmanager
+    async def use(self, chat_id):
+        """Состояние чата на время обработки; пока оно используется, его не выгрузят."""
+        self._in_use[chat_id] = self._in_use.get(chat_id, 0) + 1
+        try:
+            yield await self._get(chat_id)
+        finally:
+            self._in_use[chat_id] -= 1
+            if not self._in_use[chat_id]:
+                del self._in_use[chat_id]
+            await self._evict_cold()
+
+    async def _get(self, chat_id):
+        state_manager = self._active.get(chat_id)
+        if state_manager is not None:
+            self._active.move_to_end(chat_id)
+            return state_manager
+        # Два сообщения подряд в холодный чат не должны загрузить его дважды
+        loading = self._loading.get(chat_id)
+        if loading is None:
+            loading = self._loading[chat_id] = asyncio.create_task(self._load(chat_id))
+        return await asyncio.shield(loading)
+
+    async def _load(self, chat_id):
+        # Чтение базы и построение индексов — блокирующие, уводим из event loop
+        try:
+            # Если чат как раз выгружается, сначала дожидаемся его сброса на диск
+            if unloading := self._unloading.get(chat_id):
+                await asyncio.wait({unloading})
+            if self.before_load is not None:
+                await self.before_load(chat_id)
+            state_manager = await asyncio.to_thread(self.factory, chat_id)
+        finally:
+            self._loading.pop(chat_id, None)
+        if self.lease_check is not None:
+            state_manager.write_guard = functools.partial(self.lease_check, chat_id)
+        state_manager.start()
+        self._active[chat_id] = state_manager
+        if self.on_load is not None:
+            self.on_load(chat_id, state_manager)
+        logger.info(f"📂 [CHATS] Загружен чат {chat_id} (активных: {len(self._active)}).")
+        return state_manager
+
+    def _over_budget(self):
+        return len(self._active) > self.max_active or self.memory_usage() > self.memory_budget
+
+    async def _evict_cold(self):
+        for chat_id in list(self._active):
+            if not self._over_budget():
+                break
+            if chat_id in self._in_use:
+                continue
+            state_manager = self._active.pop(chat_id)
+            await self._unload(chat_id, state_manager)
+            logger.info(f"📤 [CHATS] Чат {chat_id} выгружен (активных: {len(self._active)}).")
+
+    async def _unload(self, chat_id, state_manager):
+        unloading = self._unloading[chat_id] = asyncio.create_task(state_manager.close())
+        try:
+            await unloading
+        except Exception:
+            logger.error(f"💥 [CHATS] Ошибка сохранения чата {chat_id} при выгрузке!", exc_info=True)
+        finally:
+            self._unloading.pop(chat_id, None)
+
+    async def unload(self, chat_id):
+        """Выгружает чат, дождавшись конца его обработки (например, перед передачей другому воркеру)."""
+        if loading := self._loading.get(chat_id):
+            await asyncio.gather(loading, return_exceptions=True)
+        while chat_id in self._in_use:
+            await asyncio.sleep(0.05)
+        state_manager = self._active.pop(chat_id, None)
+        if state_manager is not None:
+            await self._unload(chat_id, state_manager)
+            logger.info(f"📤 [CHATS] Чат {chat_id} выгружен (активных: {len(self._active)}).")
+
+    async def discard(self, chat_id):
+        """
+        Выгружает чат без сброса на диск — его аренду забрал другой воркер. Обработку не ждём:
+        её записи всё равно отсечёт lease_check, а новое сообщение в этот чат загрузит его заново.
+        """
+        if loading := self._loading.get(chat_id):
+            await asyncio.gather(loading, return_exceptions=True)
+        state_manager = self._active.pop(chat_id, None)
+        if state_manager is None:
+            return
+        unloading = self._unloading[chat_id] = asyncio.create_task(state_manager.discard())
+        try:
+            await unloading
+        except Exception:
+            logger.error(f"💥 [CHATS] Ошибка выгрузки чата {chat_id}!", exc_info=True)
+        finally:
+            self._unloading.pop(chat_id, None)
+        logger.info(f"🗑️ [CHATS] Чат {chat_id} выгружен без сохранения (активных: {len(self._active)}).")
+
+    async def close(self):
+        for loading in list(self._loading.values()):
+            await asyncio.gather(loading, return_exceptions=True)
+        while self._active:
+            chat_id, state_manager = self._active.popitem(last=False)
+            await self._unload(chat_id, state_manager)
+        logger.info("💾 [CHATS] Все чаты сохранены.")
@@ -0,0 +1,258 @@
+# --- START OF FILE bot_scheduler.py ---
+
+import os
+import json
+import math
+import time
+import heapq
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _due(task):
+    # Задача без срока никогда не наступает — как и раньше
+    return task.get("due_time", math.inf)
+
+
+class TaskHeap:
+    """
+    Двоичная куча задач по due_time прямо поверх state["task_list"]:
+    на диск уходит обычный список, а вставка, удаление и перенос срока — O(log n).
+    """
+    def __init__(self, tasks):
+        self.tasks = tasks
+        # Отсортированный список — уже корректная куча
+        self.tasks.sort(key=_due)
+        self.positions = {task["id"]: i for i, task in enumerate(self.tasks)}
+        self.keys = {}
+        for task in self.tasks:
+            self._count_key(task, 1)
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    def _count_key(self, task, delta):
+        key = (task["text"], task["priority"])
+        count = self.keys.get(key, 0) + delta
+        if count:
+            self.keys[key] = count
+        else:
+            self.keys.pop(key, None)
+
+    def contains(self, text, priority):
+        return (text, priority) in self.keys
+
+    def peek(self):
+        return self.tasks[0] if self.tasks else None
+
+    def get(self, task_id):
+        position = self.positions.get(task_id)
+        return None if position is None else self.tasks[position]
+
+    def due(self, now_ts):
+        """Все наступившие задачи: обход только тех узлов кучи, что не позже now_ts."""
+        stack = [0] if self.tasks else []
+        while stack:
+            i = stack.pop()
+            if _due(self.tasks[i]) > now_ts:
+                continue
+            yield self.tasks[i]
+            stack.extend(child for child in (2 * i + 1, 2 * i + 2) if child < len(self.tasks))
+
+    def push(self, task):
+        self.tasks.append(task)
+        self.positions[task["id"]] = len(self.tasks) - 1
+        self._count_key(task, 1)
+        self._sift_up(len(self.tasks) - 1)
+
+    def remove(self, task_id):
+        position = self.positions.pop(task_id, None)
+        if position is None:
+            return None
+        task = self.tasks[position]
+        self._count_key(task, -1)
+        last = self.tasks.pop()
+        if position < len(self.tasks):
+            self.tasks[position] = last
+            self.positions[last["id"]] = position
+            self._restore(position)
+        return task
+
+    def reschedule(self, task_id, due_time):
+        position = self.positions.get(task_id)
+        if position is None:
+            return None
+        self.tasks[position]["due_time"] = due_time
+        self._restore(position)
+        return self.tasks[position]
+
+    def _swap(self, i, j):
+        self.tasks[i], self.tasks[j] = self.tasks[j], self.tasks[i]
+        self.positions[self.tasks[i]["id"]] = i
+        self.positions[self.tasks[j]["id"]] = j
+
+    def _restore(self, i):
+        if i > 0 and _due(self.tasks[i]) < _due(self.tasks[(i - 1) // 2]):
+            self._sift_up(i)
+        else:
+            self._sift_down(i)
+
+    def _sift_up(self, i):
+        while i > 0:
+            parent = (i - 1) // 2
+            if _due(self.tasks[i]) >= _due(self.tasks[parent]):
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i):
+        n = len(self.tasks)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < n and _due(self.tasks[child]) < _due(self.tasks[smallest]):
+                    smallest = child
+            if smallest == i:
+                return
+            self._swap(i, smallest)
+            i = smallest
+
+
+class TaskScheduler:
+    """
+    Один таймер job_queue на ближайшую задачу среди всех чатов вместо опроса раз в минуту.
+    По каждому чату помнится только время следующего срабатывания, поэтому выгруженные
+    из памяти чаты тоже будят таймер. Перевзводится при каждом изменении задач.
+    """
+    def __init__(self, job_queue, handler, wakeups_file=None, min_delay=1.0, retry_seconds=60.0):
+        self.job_queue = job_queue
+        # async handler(context, chat_id) -> время следующего пробуждения чата или None
+        self.handler = handler
+        self.wakeups_file = wakeups_file
+        self.min_delay = min_delay
+        self.retry_seconds = retry_seconds
+        self.wakeups = self._load()
+        self._heap = [(due_time, chat_id) for chat_id, due_time in self.wakeups.items()]
+        heapq.heapify(self._heap)
+        self._job = None
+        self._armed_at = None
+        self._running = {}
+        self._dirty = False
+        self._save_task = None
+        self._closed = False
+
+    def attach(self, chat_id, state_manager):
+        """Подписка на изменения задач загруженного чата."""
+        state_manager.on_tasks_changed = lambda due_time: self.update(chat_id, due_time)
+        self.update(chat_id, state_manager.next_task_due())
+
+    def update(self, chat_id, due_time):
+        if self.wakeups.get(chat_id) == due_time:
+            return
+        if due_time is None:
+            self.wakeups.pop(chat_id, None)
+        else:
+            self.wakeups[chat_id] = due_time
+            heapq.heappush(self._heap, (due_time, chat_id))
+        self._schedule_save()
+        self._arm()
+
+    def _arm(self):
+        if self._closed:
+            return
+        # Устаревшие записи (время чата с тех пор сменилось) выбрасываются лениво
+        while self._heap and self.wakeups.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        next_due = self._heap[0][0] if self._heap else None
+        if next_due == self._armed_at:
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
+        self._armed_at = next_due
+        if next_due is not None:
+            self._job = self.job_queue.run_once(self._fire, when=max(0.0, next_due - time.time()), name="task_scheduler")
+
+    async def _fire(self, context):
+        self._job = None
+        self._armed_at = None
+        now_ts = time.time()
+        while self._heap and self._heap[0][0] <= now_ts:
+            due_time, chat_id = heapq.heappop(self._heap)
+            # Уже обрабатываемый чат сам сообщит следующее время, когда закончит
+            if self.wakeups.get(chat_id) != due_time or chat_id in self._running:
+                continue
+            self._running[chat_id] = asyncio.create_task(self._run(context, chat_id))
+        self._arm()
+
+    async def _run(self, context, chat_id):
+        next_wake = None
+        try:
+            next_wake = await self.handler(context, chat_id)
+        except asyncio.CancelledError:
+            # Остановка посреди обработки: задачи чата не потеряются, разберём их после перезапуска
+            next_wake = time.time()
+            raise
+        except Exception:
+            logger.error(f"💥 [SCHEDULER] Ошибка обработки задач чата {chat_id}!", exc_info=True)
+            next_wake = time.time() + self.retry_seconds
+        finally:
+            self._running.pop(chat_id, None)
+            # Наступившее время не перевзводим мгновенно — иначе невыполнимая задача крутила бы таймер вхолостую
+            if next_wake is not None and next_wake <= time.time():
+                next_wake = time.time() + self.min_delay
+            # Сбрасываем запись, чтобы update перевзвёл таймер, даже если время не изменилось
+            self.wakeups.pop(chat_id, None)
+            self._schedule_save()
+            self.update(chat_id, next_wake)
+
+    def _load(self):
+        if not self.wakeups_file or not os.path.exists(self.wakeups_file):
+            return {}
+        try:
+            with open(self.wakeups_file, 'r', encoding='utf-8') as f:
+                return {int(chat_id): due_time for chat_id, due_time in json.load(f).items()}
+        except (json.JSONDecodeError, IOError, ValueError) as e:
+            logger.error(f"Ошибка загрузки {self.wakeups_file}: {e}. Начинаю с пустого.")
+            return {}
+
+    def _write(self, payload):
+        temp_file = self.wakeups_file + ".tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(temp_file, self.wakeups_file)
+
+    def _schedule_save(self):
+        self._dirty = True
+        if self.wakeups_file and (self._save_task is None or self._save_task.done()):
+            self._save_task = asyncio.create_task(self._save())
+
+    async def _save(self):
+        # Изменения, пришедшие во время записи, уйдут следующим проходом
+        while self._dirty:
+            self._dirty = False
+            payload = json.dumps({str(chat_id): due_time for chat_id, due_time in self.wakeups.items()})
+            try:
+                await asyncio.to_thread(self._write, payload)
+            except Exception:
+                logger.error("💥 [SCHEDULER] Ошибка сохранения расписания!", exc_info=True)
+
+    async def close(self):
+        self._closed = True
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
+        running = list(self._running.values())
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        if self._save_task is not None:
+            await asyncio.gather(self._save_task, return_exceptions=True)
+        if self._dirty and self.wakeups_file:
+            self._dirty = False
+            self._write(json.dumps({str(chat_id): due_time for chat_id, due_time in self.wakeups.items()}))
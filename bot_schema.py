@@ -0,0 +1,167 @@
+# --- START OF FILE bot_schema.py ---
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Единое описание ответа модели: из него строится responseSchema для Gemini и разбор в Decision.
+# (поле, тип, может ли быть null)
+TASK_FIELDS = (
+    ("text", "string", False),
+    ("minutes", "integer", False),
+    ("priority", "priority", False),
+)
+DECISION_FIELDS = (
+    ("replies", "string_list", True),
+    ("mood_shift", "number", False),
+    ("add_task", "task", True),
+    ("ignored_topic_keywords", "string_list", True),
+    ("used_thought_id", "string", True),
+    ("is_offended", "boolean", False),
+    ("forgive", "boolean", False),
+    ("memory_query_topic", "string", True),
+)
+REFLECTION_FIELDS = (
+    ("thoughts", "string_list", False),
+)
+PRIORITIES = ("low", "high")
+
+_SCALAR_TYPES = {"string": "STRING", "integer": "INTEGER", "number": "NUMBER", "boolean": "BOOLEAN"}
+
+
+def _field_schema(kind):
+    if kind in _SCALAR_TYPES:
+        return {"type": _SCALAR_TYPES[kind]}
+    if kind == "priority":
+        return {"type": "STRING", "enum": list(PRIORITIES)}
+    if kind == "string_list":
+        return {"type": "ARRAY", "items": {"type": "STRING"}}
+    if kind == "task":
+        return build_response_schema(TASK_FIELDS)
+    raise ValueError(f"Неизвестный тип поля схемы: {kind}")
+
+
+def build_response_schema(fields):
+    """responseSchema в формате Gemini (подмножество OpenAPI)."""
+    properties = {}
+    required = []
+    for name, kind, nullable in fields:
+        schema = _field_schema(kind)
+        if nullable:
+            schema["nullable"] = True
+        else:
+            required.append(name)
+        properties[name] = schema
+    return {"type": "OBJECT", "properties": properties, "required": required}
+
+
+DECISION_SCHEMA = build_response_schema(DECISION_FIELDS)
+REFLECTION_SCHEMA = build_response_schema(REFLECTION_FIELDS)
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "1", "yes", "да")
+    return bool(value)
+
+
+def _to_float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _to_int(value, default):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+def _to_str_or_none(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _to_string_list(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value] if value else []
+    if not isinstance(value, (list, tuple)):
+        return []
+    result = []
+    for item in value:
+        if isinstance(item, dict):
+            item = item.get("text", "")
+        if isinstance(item, str) and item:
+            result.append(item)
+    return result
+
+
+class TaskSpec:
+    __slots__ = ("text", "minutes", "priority")
+
+    def __init__(self, text, minutes, priority):
+        self.text = text
+        self.minutes = minutes
+        self.priority = priority
+
+    @classmethod
+    def from_value(cls, value):
+        if not isinstance(value, dict):
+            return None
+        priority = value.get("priority", "low")
+        return cls(
+            text=str(value.get("text") or "без темы"),
+            minutes=max(1, _to_int(value.get("minutes"), 5)),
+            priority=priority if priority in PRIORITIES else "low",
+        )
+
+    def __repr__(self):
+        return f"TaskSpec(text={self.text!r}, minutes={self.minutes}, priority={self.priority!r})"
+
+
+class Decision:
+    """
+    Разобранное решение модели. Все поля приведены к своим типам один раз,
+    дальше обработчики читают атрибуты без проверок.
+    """
+    __slots__ = tuple(name for name, _, _ in DECISION_FIELDS)
+
+    def __init__(self, replies=(), mood_shift=0.0, add_task=None, ignored_topic_keywords=(), used_thought_id=None,
+                 is_offended=False, forgive=False, memory_query_topic=None):
+        self.replies = list(replies)
+        self.mood_shift = mood_shift
+        self.add_task = add_task
+        self.ignored_topic_keywords = list(ignored_topic_keywords)
+        self.used_thought_id = used_thought_id
+        self.is_offended = is_offended
+        self.forgive = forgive
+        self.memory_query_topic = memory_query_topic
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            return None
+        replies = _to_string_list(data.get("replies"))
+        if not replies and isinstance(data.get("text"), str) and data["text"]:
+            logger.warning("⚠️ [JSON] Обнаружен ответ в поле 'text' вместо 'replies'. Исправляю.")
+            replies = [data["text"]]
+        return cls(
+            replies=replies,
+            mood_shift=max(-1.0, min(1.0, _to_float(data.get("mood_shift")))),
+            add_task=TaskSpec.from_value(data.get("add_task")),
+            ignored_topic_keywords=_to_string_list(data.get("ignored_topic_keywords")),
+            used_thought_id=_to_str_or_none(data.get("used_thought_id")),
+            is_offended=_to_bool(data.get("is_offended", False)),
+            forgive=_to_bool(data.get("forgive", False)),
+            memory_query_topic=_to_str_or_none(data.get("memory_query_topic")),
+        )
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"Decision({fields})"
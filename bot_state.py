@@ -1,191 +1,398 @@
-# --- START OF FILE bot_state.py ---
-
-import asyncio
-import json
-import os
-import datetime
-import random
-import logging
-from datetime import timedelta, timezone
-
-logger = logging.getLogger(__name__)
-
-class StateManager:
-    def __init__(self, filename):
-        self.filename = filename
-        self.lock = asyncio.Lock()
-        self.state = self._load_initial()
-
-    def _load_initial(self):
-        default_state = {
-            "chat_history": [],
-            "task_list": [], 
-            "base_mood": 0.55, 
-            "spike": 0.0, 
-            "residual": 0.0,
-            "last_interaction": datetime.datetime.now(timezone.utc).timestamp(),
-            "pending_topic": None,
-            "background_thoughts": [],
-            "last_reflection_time": 0,
-            "offense_state": {"active": False, "timestamp": 0},
-            "is_at_peak": False,
-            "reflection_history": []
-        }
-        if os.path.exists(self.filename):
-            try:
-                with open(self.filename, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                # Миграция старых данных если нужно
-                for key, value in default_state.items():
-                    data.setdefault(key, value)
-                return data
-            except (json.JSONDecodeError, IOError) as e:
-                logger.error(f"Ошибка загрузки state.json: {e}. Создаю новый.")
-        return default_state
-
-    async def save(self):
-        async with self.lock:
-            temp_file = self.filename + ".tmp"
-            with open(temp_file, 'w', encoding='utf-8') as f:
-                json.dump(self.state, f, ensure_ascii=False, indent=2)
-            os.replace(temp_file, self.filename)
-
-    async def add_history(self, role, text):
-        new_message = {"role": role, "content": text}
-        # Краткосрочная память для промпта
-        self.state["chat_history"].append(new_message)
-        self.state["chat_history"] = self.state["chat_history"][-50:]
-        
-        # Долгосрочная память для рефлексии
-        self.state.setdefault("reflection_history", []).append(new_message)
-        self.state["reflection_history"] = self.state["reflection_history"][-400:]
-        await self.save()
-
-    async def add_task(self, text, minutes, priority):
-        due_time = (datetime.datetime.now(timezone.utc) + timedelta(minutes=minutes)).timestamp()
-        task_id = os.urandom(4).hex()
-        
-        # Простая проверка на полные дубликаты текста, чтобы не спамить
-        current_tasks = self.state.get("task_list", [])
-        for t in current_tasks:
-            if t["text"] == text and t["priority"] == priority:
-                logger.info(f"⚠️ [TASK] Дубликат задачи '{text}' пропущен.")
-                return
-
-        self.state.setdefault("task_list", []).append({
-            "id": task_id,
-            "text": text,
-            "due_time": due_time,
-            "priority": priority
-        })
-        logger.info(f"✅ [TASK] Новая задача '{text}' (приоритет: {priority}) запланирована через {minutes} мин.")
-        await self.save()
-
-    async def remove_task(self, task_id):
-        initial_len = len(self.state.get("task_list", []))
-        self.state["task_list"] = [t for t in self.state["task_list"] if t.get("id") != task_id]
-        if len(self.state["task_list"]) < initial_len:
-            logger.info(f"🗑️ [TASK] Задача {task_id} удалена из списка.")
-            await self.save()
-            return True
-        return False
-            
-    def get_total_mood(self):
-        return max(0.05, self.state["base_mood"] + self.state["spike"] + self.state["residual"])
-
-    async def apply_reaction(self, shift):
-        self.state["spike"] += shift
-        self.state["residual"] += (shift * 0.5)
-        await self.save()
-        logger.info(f"💥 [REACTION] Shift: {shift:+.2f} | Total: {self.get_total_mood():.2f}")
-
-    async def check_and_apply_peak_decay(self):
-        if self.state["is_at_peak"]:
-            logger.info("📉 [PSYCHOLOGY] Эйфория спадает.")
-            self.state["spike"] *= 0.1
-            self.state["residual"] = min(self.state["residual"], 0.3)
-            self.state["is_at_peak"] = False
-            await self.save()
-
-    def get_mood_instruction(self):
-        m = self.get_total_mood()
-        if m >= 1.0:
-            self.state["is_at_peak"] = True
-            return "ТВОЕ СОСТОЯНИЕ: ✨ Эйфория. СТИЛЬ: Ты на пике эмоций! Будь очень открытым. Можно использовать `)))` для радости, но уместно, не постоянно."
-        elif m < 0.30:
-            return "ТВОЕ СОСТОЯНИЕ: ☁️ Уставшее. СТИЛЬ: Пиши кратко, без эмоций."
-        elif m < 0.65:
-            return "ТВОЕ СОСТОЯНИЕ: 🌤️ Нормальное. СТИЛЬ: Обычный дружеский диалог."
-        else:
-            return "ТВОЕ СОСТОЯНИЕ: ☀️ Хорошее. СТИЛЬ: Дружелюбный. Можно использовать `)` в конце фразы для теплоты, но не в каждом сообщении."
-
-    async def set_offense_state(self, active: bool):
-        self.state["offense_state"]["active"] = active
-        self.state["offense_state"]["timestamp"] = datetime.datetime.now(timezone.utc).timestamp() if active else 0
-        await self.save()
-        if active:
-            logger.warning("😡 [PSYCHOLOGY] Бот 'обиделся'.")
-        else:
-            logger.info("😌 [PSYCHOLOGY] Бот 'простил'.")
-
-    def is_offended(self):
-        offense = self.state["offense_state"]
-        if not offense["active"]:
-            return False
-        if (datetime.datetime.now(timezone.utc).timestamp() - offense["timestamp"]) > 600:
-            logger.info("😌 [PSYCHOLOGY] Время 'обиды' истекло.")
-            offense["active"] = False
-            return False
-        return True
-
-    async def set_pending_topic(self, keywords):
-        self.state["pending_topic"] = {"keywords": keywords, "timestamp": datetime.datetime.now(timezone.utc).timestamp()}
-        await self.save()
-        logger.info(f"🧠 [THINKING] Запомнил проигнорированную тему: {keywords}")
-
-    def get_and_clear_pending_topic(self, user_text):
-        topic = self.state.get("pending_topic")
-        if not topic:
-            return None
-        if (datetime.datetime.now(timezone.utc).timestamp() - topic["timestamp"]) > 900:
-            self.state["pending_topic"] = None
-            logger.info("🧠 [THINKING] Проигнорированная тема устарела.")
-            return None
-        if any(keyword.lower() in user_text.lower() for keyword in topic["keywords"]):
-            self.state["pending_topic"] = None
-            logger.info(f"🧠 [THINKING] Пользователь вернулся к теме: {topic['keywords']}.")
-            return topic["keywords"]
-        return None
-
-    async def add_thoughts(self, thoughts):
-        if not thoughts:
-            return
-        for thought in thoughts:
-            # Генерация уникального ID
-            self.state["background_thoughts"].append({"id": os.urandom(4).hex(), "text": thought})
-            logger.info(f"💡 [REFLECTION] Сгенерирована новая мысль: {thought}")
-        self.state["last_reflection_time"] = datetime.datetime.now(timezone.utc).timestamp()
-        await self.save()
-
-    async def remove_thought(self, thought_id):
-        self.state["background_thoughts"] = [t for t in self.state["background_thoughts"] if t["id"] != thought_id]
-        logger.info(f"💡 [REFLECTION] Мысль {thought_id} была использована.")
-        await self.save()
-
-    async def update_physics(self):
-        # Естественное затухание эмоций
-        self.state["spike"] *= 0.1
-        self.state["residual"] *= 0.9
-        # Дрейф базового настроения
-        target_base = 0.60
-        self.state["base_mood"] += (target_base - self.state["base_mood"]) * 0.05 + random.uniform(-0.01, 0.01)
-        self.state["base_mood"] = max(0.2, min(0.9, self.state["base_mood"]))
-        await self.save()
-        logger.info(f"🌊 [PHYSICS] Total mood: {self.get_total_mood():.2f}")
-
-    async def update_interaction(self):
-        self.state["last_interaction"] = datetime.datetime.now(timezone.utc).timestamp()
-        await self.save()
-
-    def get_msk_time_obj(self):
+# --- START OF FILE bot_state.py ---
+
+import asyncio
+import os
+import datetime
+import random
+import logging
+from datetime import timedelta, timezone
+
+from bot_storage import JsonStateBackend, CHAT_HISTORY_LIMIT, REFLECTION_HISTORY_LIMIT
+import bot_memory
+import bot_mood
+import bot_metrics
+from bot_memory import MemoryIndex, SemanticIndex
+from bot_scheduler import TaskHeap
+
+logger = logging.getLogger(__name__)
+
+# Режимы долговечности записи:
+# "immediate" — сброс на диск после каждого изменения
+# "coalesce"  — изменения за coalesce_ms склеиваются в один сброс
+# "periodic"  — сброс раз в flush_interval секунд и при остановке
+DURABILITY_MODES = ("immediate", "coalesce", "periodic")
+
+class StateManager:
+    def __init__(self, filename, backend=None, durability="immediate", coalesce_ms=200, flush_interval=30.0,
+                 semantic_index_file=None, semantic_dim=512, memory_snapshot_file=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Неизвестный режим долговечности: {durability}")
+        self.filename = filename
+        self.backend = backend or JsonStateBackend(filename)
+        self.durability = durability
+        self.coalesce_ms = coalesce_ms
+        self.flush_interval = flush_interval
+        self.lock = asyncio.Lock()
+        # Что изменилось с последнего сохранения: ключи состояния и новые сообщения
+        self._dirty = set()
+        self._pending_messages = []
+        self._flush_task = None
+        self._periodic_task = None
+        self._stopping = asyncio.Event()
+        self.state = self._load_initial()
+        # Задачи — куча по due_time поверх state["task_list"]; о каждом изменении узнаёт планировщик
+        self.tasks = TaskHeap(self.state["task_list"])
+        self.on_tasks_changed = None
+        # write_guard() — можно ли сейчас писать в общее хранилище (с несколькими воркерами — действует ли аренда чата)
+        self.write_guard = None
+        self._discarded = False
+        self.memory_snapshot_file = None
+        self.memory_index, self.semantic_index = self._build_memory_indexes(
+            semantic_index_file, semantic_dim, memory_snapshot_file
+        )
+        if self.state["message_seq"] < len(self.memory_index):
+            # Состояние до появления сквозной нумерации: считаем от начала архива
+            self.state["message_seq"] = len(self.memory_index)
+            self.mark_dirty("message_seq")
+
+    def _load_initial(self):
+        default_state = {
+            "chat_history": [],
+            "task_list": [], 
+            "base_mood": 0.55, 
+            "spike": 0.0, 
+            "residual": 0.0,
+            # Настроение затухает аналитически от этой точки отсчёта, дрейф воспроизводим по seed
+            "mood_updated_at": datetime.datetime.now(timezone.utc).timestamp(),
+            "mood_seed": random.getrandbits(32),
+            "last_interaction": datetime.datetime.now(timezone.utc).timestamp(),
+            "pending_topic": None,
+            "background_thoughts": [],
+            "last_reflection_time": 0,
+            "offense_state": {"active": False, "timestamp": 0},
+            "is_at_peak": False,
+            "reflection_history": [],
+            # Сводки архива для рефлексии (bot_summary.SummaryTree) и сквозной номер следующего сообщения
+            "summaries": {},
+            "message_seq": 0
+        }
+        data = self.backend.load()
+        if data is None:
+            self._dirty.update(default_state.keys())
+            return default_state
+        # Миграция старых данных если нужно
+        for key, value in default_state.items():
+            if key not in data:
+                data[key] = value
+                self._dirty.add(key)
+        return data
+
+    def _build_memory_indexes(self, semantic_index_file, semantic_dim, memory_snapshot_file=None):
+        archive = self.backend.load_archive()
+        persistent = archive is not None
+        if archive is None:
+            archive = self.state.get("reflection_history", [])
+        if persistent:
+            # Снимок, как и семантическая матрица, сопоставим только с полным архивом
+            self.memory_snapshot_file = memory_snapshot_file
+        index, restored = MemoryIndex.load(archive, self.memory_snapshot_file)
+        self._snapshot_count = restored
+        logger.info(f"🧠 [MEMORY] Индекс памяти построен: {len(index)} сообщений (из снимка {restored}).")
+        if self.memory_snapshot_file and len(index) > restored:
+            # Хвост разобран заново (первый запуск или падение без сброса снимка): сохраняем, чтобы не повторять
+            self._write_memory_snapshot(index.snapshot(), len(index))
+
+        semantic = None
+        if semantic_index_file and bot_memory.import_numpy() is None:
+            logger.warning("⚠️ [SEMANTIC] numpy не установлен — семантическая память отключена.")
+        elif semantic_index_file:
+            # Без полного архива строки матрицы нельзя сопоставить с сообщениями между запусками
+            semantic = SemanticIndex(index.docs, path=semantic_index_file if persistent else None, dim=semantic_dim)
+        return index, semantic
+
+    def _may_write(self):
+        # Отброшенный менеджер не пишет, даже если аренду уже снова получили: чат загружен заново другим экземпляром
+        return not self._discarded and (self.write_guard is None or self.write_guard())
+
+    def _write_memory_snapshot(self, payload, count):
+        if not self._may_write():
+            return
+        try:
+            MemoryIndex.write_snapshot(self.memory_snapshot_file, payload)
+            self._snapshot_count = count
+        except OSError as e:
+            logger.warning(f"⚠️ [MEMORY] Не удалось сохранить снимок индекса: {e}")
+
+    def mark_dirty(self, *keys):
+        self._dirty.update(keys)
+
+    def is_dirty(self):
+        return bool(self._dirty or self._pending_messages)
+
+    async def save(self):
+        # Write-behind: в зависимости от режима пишем сразу, откладываем или ждём периодического сброса
+        if self.durability == "immediate":
+            await self.flush()
+        elif self.durability == "coalesce":
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.coalesce_ms / 1000)
+        # Новые изменения во время записи запланируют следующий сброс
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.error("💥 [STATE] Ошибка отложенного сохранения!", exc_info=True)
+
+    async def flush(self):
+        async with self.lock:
+            if not self.is_dirty():
+                return
+            if not self._may_write():
+                # Изменения остаются грязными: если аренда продлится, запишем их следующим сбросом
+                logger.warning(f"⚠️ [STATE] Аренда {self.filename} не действует — сброс на диск пропущен.")
+                return
+            dirty, self._dirty = self._dirty, set()
+            new_messages, self._pending_messages = self._pending_messages, []
+            try:
+                with bot_metrics.stage("state_flush"):
+                    payload = self.backend.snapshot(self.state, dirty, new_messages)
+                    await asyncio.to_thread(self.backend.write, payload)
+            except Exception:
+                # Возвращаем изменения, чтобы записать их при следующем сбросе
+                self._dirty |= dirty
+                self._pending_messages[:0] = new_messages
+                raise
+
+    def start(self):
+        if self.durability == "periodic" and self._periodic_task is None:
+            self._periodic_task = asyncio.create_task(self._periodic_flush())
+
+    async def _periodic_flush(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                logger.error("💥 [STATE] Ошибка периодического сохранения!", exc_info=True)
+
+    async def close(self):
+        # Принудительный сброс при остановке (в т.ч. по SIGTERM)
+        self._stopping.set()
+        for task in (self._periodic_task, self._flush_task):
+            if task and not task.done():
+                await asyncio.gather(task, return_exceptions=True)
+        await self.flush()
+        if self.memory_snapshot_file and len(self.memory_index) > self._snapshot_count:
+            # Снимок делается в цикле событий, запись — в потоке, как и при сбросе состояния
+            await asyncio.to_thread(self._write_memory_snapshot, self.memory_index.snapshot(), len(self.memory_index))
+        if self.semantic_index is not None:
+            if self._may_write():
+                self.semantic_index.close()
+            else:
+                self.semantic_index.discard()
+        self.backend.close()
+        logger.info("💾 [STATE] Состояние сохранено перед остановкой.")
+
+    async def discard(self):
+        """Выгрузка без записи: чат уже обслуживает другой воркер, и несохранённое здесь устарело."""
+        self._discarded = True
+        self._stopping.set()
+        for task in (self._periodic_task, self._flush_task):
+            if task and not task.done():
+                # Их сброс упрётся в write_guard; начатая до потери аренды запись завершится под lock
+                await asyncio.gather(task, return_exceptions=True)
+        async with self.lock:
+            self._dirty.clear()
+            self._pending_messages.clear()
+        if self.semantic_index is not None:
+            self.semantic_index.discard()
+        self.backend.close()
+        logger.warning(f"🗑️ [STATE] Несохранённое состояние {self.filename} отброшено.")
+
+    async def add_history(self, role, text):
+        new_message = {"role": role, "content": text}
+        # Краткосрочная память для промпта
+        self.state["chat_history"].append(new_message)
+        self.state["chat_history"] = self.state["chat_history"][-CHAT_HISTORY_LIMIT:]
+        
+        # Долгосрочная память для рефлексии
+        self.state.setdefault("reflection_history", []).append(new_message)
+        self.state["reflection_history"] = self.state["reflection_history"][-REFLECTION_HISTORY_LIMIT:]
+        self._pending_messages.append(new_message)
+        self.memory_index.add(new_message)
+        if self.semantic_index is not None:
+            if self._may_write():
+                self.semantic_index.add(new_message)
+            else:
+                # Матрица — общий memory-mapped файл: без аренды не пишем в неё, поиск до выгрузки только по BM25
+                self.semantic_index.discard()
+                self.semantic_index = None
+        self.state["message_seq"] += 1
+        self.mark_dirty("chat_history", "reflection_history", "message_seq")
+        await self.save()
+
+    def archive_offset(self):
+        """Сквозной номер первого сообщения, которое есть в индексе памяти."""
+        return self.state["message_seq"] - len(self.memory_index)
+
+    async def add_summary(self, key, text):
+        self.state["summaries"][key] = text
+        self.mark_dirty("summaries")
+        await self.save()
+
+    def next_task_due(self):
+        task = self.tasks.peek()
+        return task.get("due_time") if task else None
+
+    def _tasks_changed(self):
+        self.mark_dirty("task_list")
+        if self.on_tasks_changed is not None:
+            self.on_tasks_changed(self.next_task_due())
+
+    async def add_task(self, text, minutes, priority):
+        due_time = (datetime.datetime.now(timezone.utc) + timedelta(minutes=minutes)).timestamp()
+        task_id = os.urandom(4).hex()
+        
+        # Простая проверка на полные дубликаты текста, чтобы не спамить
+        if self.tasks.contains(text, priority):
+            logger.info(f"⚠️ [TASK] Дубликат задачи '{text}' пропущен.")
+            return
+
+        self.tasks.push({
+            "id": task_id,
+            "text": text,
+            "due_time": due_time,
+            "priority": priority
+        })
+        logger.info(f"✅ [TASK] Новая задача '{text}' (приоритет: {priority}) запланирована через {minutes} мин.")
+        self._tasks_changed()
+        await self.save()
+
+    async def remove_task(self, task_id):
+        if self.tasks.remove(task_id) is not None:
+            logger.info(f"🗑️ [TASK] Задача {task_id} удалена из списка.")
+            self._tasks_changed()
+            await self.save()
+            return True
+        return False
+
+    async def reschedule_task(self, task_id, minutes):
+        due_time = (datetime.datetime.now(timezone.utc) + timedelta(minutes=minutes)).timestamp()
+        if self.tasks.reschedule(task_id, due_time) is not None:
+            logger.info(f"⏳ [TASK] Задача {task_id} перенесена на {minutes} мин.")
+            self._tasks_changed()
+            await self.save()
+            return True
+        return False
+            
+    def get_total_mood(self):
+        # Вычисляется на текущий момент при чтении — без периодических перезаписей состояния
+        return bot_mood.total_mood_at(self.state, datetime.datetime.now(timezone.utc).timestamp())
+
+    def _fold_mood(self):
+        bot_mood.fold(self.state, datetime.datetime.now(timezone.utc).timestamp())
+        self.mark_dirty("base_mood", "spike", "residual", "mood_updated_at")
+
+    async def apply_reaction(self, shift):
+        self._fold_mood()
+        self.state["spike"] += shift
+        self.state["residual"] += (shift * 0.5)
+        await self.save()
+        logger.info(f"💥 [REACTION] Shift: {shift:+.2f} | Total: {self.get_total_mood():.2f}")
+
+    async def check_and_apply_peak_decay(self):
+        if self.state["is_at_peak"]:
+            logger.info("📉 [PSYCHOLOGY] Эйфория спадает.")
+            self._fold_mood()
+            self.state["spike"] *= 0.1
+            self.state["residual"] = min(self.state["residual"], 0.3)
+            self.state["is_at_peak"] = False
+            self.mark_dirty("is_at_peak")
+            await self.save()
+
+    def get_mood_instruction(self):
+        m = self.get_total_mood()
+        if m >= 1.0:
+            self.state["is_at_peak"] = True
+            self.mark_dirty("is_at_peak")
+            return "ТВОЕ СОСТОЯНИЕ: ✨ Эйфория. СТИЛЬ: Ты на пике эмоций! Будь очень открытым. Можно использовать `)))` для радости, но уместно, не постоянно."
+        elif m < 0.30:
+            return "ТВОЕ СОСТОЯНИЕ: ☁️ Уставшее. СТИЛЬ: Пиши кратко, без эмоций."
+        elif m < 0.65:
+            return "ТВОЕ СОСТОЯНИЕ: 🌤️ Нормальное. СТИЛЬ: Обычный дружеский диалог."
+        else:
+            return "ТВОЕ СОСТОЯНИЕ: ☀️ Хорошее. СТИЛЬ: Дружелюбный. Можно использовать `)` в конце фразы для теплоты, но не в каждом сообщении."
+
+    async def set_offense_state(self, active: bool):
+        self.state["offense_state"]["active"] = active
+        self.state["offense_state"]["timestamp"] = datetime.datetime.now(timezone.utc).timestamp() if active else 0
+        self.mark_dirty("offense_state")
+        await self.save()
+        if active:
+            logger.warning("😡 [PSYCHOLOGY] Бот 'обиделся'.")
+        else:
+            logger.info("😌 [PSYCHOLOGY] Бот 'простил'.")
+
+    def is_offended(self):
+        offense = self.state["offense_state"]
+        if not offense["active"]:
+            return False
+        if (datetime.datetime.now(timezone.utc).timestamp() - offense["timestamp"]) > 600:
+            logger.info("😌 [PSYCHOLOGY] Время 'обиды' истекло.")
+            offense["active"] = False
+            self.mark_dirty("offense_state")
+            return False
+        return True
+
+    async def set_pending_topic(self, keywords):
+        self.state["pending_topic"] = {"keywords": keywords, "timestamp": datetime.datetime.now(timezone.utc).timestamp()}
+        self.mark_dirty("pending_topic")
+        await self.save()
+        logger.info(f"🧠 [THINKING] Запомнил проигнорированную тему: {keywords}")
+
+    def get_and_clear_pending_topic(self, user_text):
+        topic = self.state.get("pending_topic")
+        if not topic:
+            return None
+        if (datetime.datetime.now(timezone.utc).timestamp() - topic["timestamp"]) > 900:
+            self.state["pending_topic"] = None
+            self.mark_dirty("pending_topic")
+            logger.info("🧠 [THINKING] Проигнорированная тема устарела.")
+            return None
+        if any(keyword.lower() in user_text.lower() for keyword in topic["keywords"]):
+            self.state["pending_topic"] = None
+            self.mark_dirty("pending_topic")
+            logger.info(f"🧠 [THINKING] Пользователь вернулся к теме: {topic['keywords']}.")
+            return topic["keywords"]
+        return None
+
+    async def add_thoughts(self, thoughts):
+        if not thoughts:
+            return
+        for thought in thoughts:
+            # Генерация уникального ID
+            self.state["background_thoughts"].append({"id": os.urandom(4).hex(), "text": thought})
+            logger.info(f"💡 [REFLECTION] Сгенерирована новая мысль: {thought}")
+        self.state["last_reflection_time"] = datetime.datetime.now(timezone.utc).timestamp()
+        self.mark_dirty("background_thoughts", "last_reflection_time")
+        await self.save()
+
+    async def remove_thought(self, thought_id):
+        self.state["background_thoughts"] = [t for t in self.state["background_thoughts"] if t["id"] != thought_id]
+        logger.info(f"💡 [REFLECTION] Мысль {thought_id} была использована.")
+        self.mark_dirty("background_thoughts")
+        await self.save()
+
+    async def update_interaction(self):
+        self.state["last_interaction"] = datetime.datetime.now(timezone.utc).timestamp()
+        self.mark_dirty("last_interaction")
+        await self.save()
+
+    def get_msk_time_obj(self):
         return datetime.datetime.now(timezone.utc) + timedelta(hours=3)
\ No newline at end of file
@@ -0,0 +1,183 @@
+# --- START OF FILE bot_storage.py ---
+
+import json
+import os
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Ключи состояния, которые хранятся как отдельные строки сообщений, а не в kv
+MESSAGE_KEYS = ("chat_history", "reflection_history")
+CHAT_HISTORY_LIMIT = 50
+REFLECTION_HISTORY_LIMIT = 400
+
+
+class JsonStateBackend:
+    """
+    Классическое хранилище: всё состояние целиком в одном JSON-файле.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return None
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            logger.error(f"Ошибка загрузки {self.filename}: {e}. Создаю новый.")
+            return None
+
+    def load_archive(self):
+        # Архив в JSON-режиме — это и есть reflection_history из состояния
+        return None
+
+    def snapshot(self, state, dirty_keys, new_messages):
+        # JSON не умеет частичную запись — сериализуем состояние целиком
+        return json.dumps(state, ensure_ascii=False, separators=(',', ':'))
+
+    def write(self, payload):
+        temp_file = self.filename + ".tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.filename)
+
+    def persist(self, state, dirty_keys, new_messages):
+        self.write(self.snapshot(state, dirty_keys, new_messages))
+
+    def close(self):
+        pass
+
+
+class SqliteStateBackend:
+    """
+    Инкрементальное хранилище на SQLite в режиме WAL.
+    Пишет только изменившиеся строки: новое сообщение, задачу, скаляр настроения.
+    """
+    def __init__(self, db_path, legacy_json_path=None):
+        self.db_path = db_path
+        self.legacy_json_path = legacy_json_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS kv (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS tasks (
+                id TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                data TEXT NOT NULL
+            );
+        """)
+        self._task_ids = set()
+
+    def _is_empty(self):
+        row = self.conn.execute("SELECT (SELECT COUNT(*) FROM kv) + (SELECT COUNT(*) FROM messages)").fetchone()
+        return row[0] == 0
+
+    def _migrate_from_json(self):
+        legacy = JsonStateBackend(self.legacy_json_path).load()
+        if not legacy:
+            return
+        messages = legacy.get("reflection_history") or legacy.get("chat_history") or []
+        dirty = {key for key in legacy if key not in MESSAGE_KEYS}
+        self.persist(legacy, dirty, messages)
+        logger.info(f"📦 [STORAGE] Миграция {self.legacy_json_path} -> {self.db_path}: {len(messages)} сообщений, {len(legacy.get('task_list', []))} задач.")
+
+    def load(self):
+        if self._is_empty() and self.legacy_json_path and os.path.exists(self.legacy_json_path):
+            self._migrate_from_json()
+        if self._is_empty():
+            return None
+
+        state = {key: json.loads(value) for key, value in self.conn.execute("SELECT key, value FROM kv")}
+        rows = self.conn.execute(
+            "SELECT role, content FROM messages ORDER BY id DESC LIMIT ?", (REFLECTION_HISTORY_LIMIT,)
+        ).fetchall()
+        history = [{"role": role, "content": content} for role, content in reversed(rows)]
+        state["reflection_history"] = history
+        state["chat_history"] = history[-CHAT_HISTORY_LIMIT:]
+
+        tasks = [json.loads(data) for (data,) in self.conn.execute("SELECT data FROM tasks ORDER BY position")]
+        state["task_list"] = tasks
+        self._task_ids = {t.get("id") for t in tasks}
+        return state
+
+    def load_archive(self):
+        # Полный архив переписки, без ограничения в 400 сообщений
+        return [{"role": role, "content": content} for role, content in self.conn.execute("SELECT role, content FROM messages ORDER BY id")]
+
+    def _sync_tasks(self, tasks):
+        """Пишет задачи в открытой транзакции и возвращает их id — _task_ids обновляется только после COMMIT."""
+        current_ids = set()
+        for task_id, position, data in tasks:
+            current_ids.add(task_id)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO tasks (id, position, data) VALUES (?, ?, ?)",
+                (task_id, position, data),
+            )
+        removed = self._task_ids - current_ids
+        if removed:
+            self.conn.executemany("DELETE FROM tasks WHERE id = ?", [(task_id,) for task_id in removed])
+        return current_ids
+
+    def snapshot(self, state, dirty_keys, new_messages):
+        # Снимок делается в цикле событий: после него запись в потоке не зависит от живого state
+        messages = [(m["role"], m["content"]) for m in new_messages]
+        kv = {}
+        tasks = None
+        for key in dirty_keys:
+            if key in MESSAGE_KEYS:
+                continue
+            if key == "task_list":
+                tasks = [
+                    (t.get("id"), position, json.dumps(t, ensure_ascii=False))
+                    for position, t in enumerate(state.get("task_list", []))
+                ]
+            else:
+                kv[key] = json.dumps(state.get(key), ensure_ascii=False)
+        return messages, kv, tasks
+
+    def write(self, payload):
+        messages, kv, tasks = payload
+        task_ids = None
+        self.conn.execute("BEGIN")
+        try:
+            if messages:
+                self.conn.executemany("INSERT INTO messages (role, content) VALUES (?, ?)", messages)
+            if kv:
+                self.conn.executemany("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", kv.items())
+            if tasks is not None:
+                task_ids = self._sync_tasks(tasks)
+            self.conn.execute("COMMIT")
+        except Exception:
+            # Откат возвращает таблицу к прежним задачам — и _task_ids остаётся прежним
+            self.conn.execute("ROLLBACK")
+            raise
+        if task_ids is not None:
+            self._task_ids = task_ids
+
+    def persist(self, state, dirty_keys, new_messages):
+        self.write(self.snapshot(state, dirty_keys, new_messages))
+
+    def close(self):
+        self.conn.close()
+
+
+def create_backend(kind, json_path, db_path):
+    if kind == "sqlite":
+        return SqliteStateBackend(db_path, legacy_json_path=json_path)
+    if kind == "json":
+        return JsonStateBackend(json_path)
+    raise ValueError(f"Неизвестный тип хранилища: {kind}")
@@ -0,0 +1,77 @@
+# --- START OF FILE bot_summary.py ---
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SummaryTree:
+    """
+    Иерархия сводок архива: листья — куски по chunk сообщений, выше — сводки сводок по fanout штук.
+    Ключ сводки — уровень и диапазон абсолютных номеров сообщений, поэтому каждая создаётся один раз
+    и переживает обрезку истории. Хранится прямо в state["summaries"].
+    """
+    def __init__(self, summaries, chunk=50, fanout=4):
+        self.summaries = summaries
+        self.chunk = chunk
+        self.fanout = fanout
+
+    @staticmethod
+    def key(level, start, end):
+        return f"{level}:{start}-{end}"
+
+    def span(self, level):
+        return self.chunk * self.fanout ** (level - 1)
+
+    def get(self, level, start):
+        return self.summaries.get(self.key(level, start, start + self.span(level)))
+
+    def children(self, level, start):
+        """Что сжимается в сводку: для уровня 1 — диапазон сообщений, выше — тексты сводок уровнем ниже."""
+        if level == 1:
+            return None
+        child_span = self.span(level - 1)
+        return [self.get(level - 1, s) for s in range(start, start + self.span(level), child_span)]
+
+    def next_missing(self, limit, available_start):
+        """
+        Следующая сводка, которую пора создать, для сообщений [0, limit). None — всё готово.
+        Сначала сводки сводок с готовыми частями (сильнее всего сокращают контекст), потом листья от новых к старым.
+        """
+        level = 2
+        while self.span(level) <= limit:
+            span = self.span(level)
+            for start in range(limit // span * span - span, -1, -span):
+                if self.get(level, start) is None and all(self.children(level, start)):
+                    return level, start, start + span
+            level += 1
+        for start in range(limit // self.chunk * self.chunk - self.chunk, -1, -self.chunk):
+            if start < available_start:
+                # Сообщения этого куска уже не в архиве — сжимать нечего
+                break
+            if self.get(1, start) is None:
+                return 1, start, start + self.chunk
+        return None
+
+    def cover(self, limit):
+        """
+        Минимальный набор готовых сводок по [0, limit) в хронологическом порядке
+        и номер сообщения, с которого начинается несжатый хвост.
+        """
+        covered = []
+        position = 0
+        covered_end = 0
+        while position + self.chunk <= limit:
+            level = 1
+            while position % self.span(level + 1) == 0 and position + self.span(level + 1) <= limit \
+                    and self.get(level + 1, position) is not None:
+                level += 1
+            text = self.get(level, position)
+            if text is None:
+                # Пропуск (сводка ещё не создана) — пробуем следующий кусок
+                position += self.chunk
+                continue
+            end = position + self.span(level)
+            covered.append((level, position, end, text))
+            position = covered_end = end
+        return covered, covered_end
@@ -0,0 +1,176 @@
+# --- START OF FILE bot_webhook.py ---
+
+import hmac
+import json
+import asyncio
+import logging
+from collections import deque
+
+import httpx
+from telegram import Update
+
+import bot_metrics
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+# Обновление, пересланное другим воркером: обрабатываем у себя, дальше не пересылаем
+FORWARDED_HEADER = "x-bot-forwarded"
+FORWARD_TIMEOUT_SECONDS = 5.0
+IDLE_TIMEOUT_SECONDS = 75
+HEADER_TIMEOUT_SECONDS = 10
+MAX_HEADER_LINES = 100
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+async def read_request(reader, max_body):
+    """Один HTTP/1.1-запрос: (метод, путь, заголовки, тело) или None, если клиент закрыл соединение."""
+    request_line = await asyncio.wait_for(reader.readline(), timeout=IDLE_TIMEOUT_SECONDS)
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(" ", 2)
+    headers = {}
+    for _ in range(MAX_HEADER_LINES):
+        line = await asyncio.wait_for(reader.readline(), timeout=HEADER_TIMEOUT_SECONDS)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode('latin-1').partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > max_body:
+        raise RequestTooLarge()
+    body = await asyncio.wait_for(reader.readexactly(length), timeout=HEADER_TIMEOUT_SECONDS) if length else b""
+    return method, path.split("?")[0], headers, body
+
+
+def render_response(status, body=b"", keep_alive=True, extra_headers=()):
+    head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}", "Content-Type: text/plain; charset=utf-8",
+            f"Content-Length: {len(body)}", f"Connection: {'keep-alive' if keep_alive else 'close'}", *extra_headers]
+    return ("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + body
+
+
+class WebhookReceiver:
+    """
+    Приём обновлений от Telegram по вебхуку: проверка секретного токена, отсев повторных доставок
+    по update_id и ответ сразу после постановки в ограниченную очередь приложения — обработка идёт отдельно.
+    Переполненная очередь отвечает 503: Telegram доставит обновление позже, это и есть обратное давление.
+    С несколькими воркерами router(update) возвращает адрес владельца чата, и обновление пересылается ему.
+    """
+    def __init__(self, bot, update_queue, secret_token, path="/telegram", dedup_size=10000, max_body=1 << 20,
+                 router=None):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.secret_token = secret_token
+        self.path = path
+        self.dedup_size = dedup_size
+        self.max_body = max_body
+        self._seen_ids = set()
+        self._seen_order = deque()
+        self._full = False
+        self.router = router
+        self._client = None
+
+    async def start(self, host, port):
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"🌐 [WEBHOOK] Приём обновлений на http://{host}:{port}{self.path} (очередь до {self.update_queue.maxsize or '∞'}).")
+        return server
+
+    def _is_duplicate(self, update_id):
+        return update_id in self._seen_ids
+
+    def _remember(self, update_id):
+        self._seen_ids.add(update_id)
+        self._seen_order.append(update_id)
+        if len(self._seen_order) > self.dedup_size:
+            self._seen_ids.discard(self._seen_order.popleft())
+
+    def accept(self, method, path, headers, body):
+        """
+        Разбор одного запроса без await, чтобы ответить за миллисекунды.
+        Возвращает (статус, итог, пересылка): пересылка — (адрес, update_id), если чат у другого воркера.
+        """
+        if path != self.path:
+            return 404, "not_found", None
+        if method != "POST":
+            return 405, "bad_method", None
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, "").encode(), self.secret_token.encode()):
+            return 403, "forbidden", None
+        try:
+            data = json.loads(body)
+            update_id = int(data["update_id"])
+        except (ValueError, TypeError, KeyError):
+            return 400, "bad_request", None
+        if self._is_duplicate(update_id):
+            # Повторная доставка уже принятого: подтверждаем, чтобы Telegram перестал слать
+            return 200, "duplicate", None
+        try:
+            update = Update.de_json(data, self.bot)
+        except Exception:
+            logger.warning(f"⚠️ [WEBHOOK] Не удалось разобрать обновление {update_id}.", exc_info=True)
+            return 400, "bad_request", None
+        if self.router is not None and FORWARDED_HEADER not in headers:
+            if address := self.router(update):
+                return None, "forwarded", (address, update_id)
+        try:
+            self.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            if not self._full:
+                self._full = True
+                logger.warning("🚧 [WEBHOOK] Очередь обновлений заполнена — отвечаю 503, Telegram повторит доставку позже.")
+            return 503, "queue_full", None
+        self._full = False
+        self._remember(update_id)
+        return 200, "accepted", None
+
+    async def _forward(self, address, update_id, body):
+        if self._client is None:
+            # Прокси из окружения (PROXY_URL) — для Telegram и Gemini, не для соседних воркеров
+            self._client = httpx.AsyncClient(timeout=FORWARD_TIMEOUT_SECONDS, trust_env=False)
+        try:
+            response = await self._client.post(address, content=body, headers={
+                SECRET_HEADER: self.secret_token, FORWARDED_HEADER: "1", "Content-Type": "application/json",
+            })
+        except httpx.HTTPError as e:
+            logger.warning(f"⚠️ [WEBHOOK] Не удалось переслать обновление {update_id} на {address}: {e}")
+            return 503, "forward_failed"
+        if response.status_code != 200:
+            return response.status_code, "forward_failed"
+        self._remember(update_id)
+        return 200, "forwarded"
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader, self.max_body)
+                except RequestTooLarge:
+                    bot_metrics.webhook_updates_total.inc(result="too_large")
+                    writer.write(render_response(413, keep_alive=False))
+                    await writer.drain()
+                    return
+                if request is None:
+                    return
+                status, result, forward = self.accept(*request)
+                if forward is not None:
+                    # Ответ Telegram — после ответа владельца: если он недоступен, Telegram повторит доставку
+                    status, result = await self._forward(*forward, request[3])
+                bot_metrics.webhook_updates_total.inc(result=result)
+                keep_alive = request[2].get("connection", "").lower() != "close"
+                writer.write(render_response(status, keep_alive=keep_alive,
+                                             extra_headers=("Retry-After: 1",) if status == 503 else ()))
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
@@ -1,46 +1,190 @@
-import os
-from dotenv import load_dotenv
-
-# Загружаем переменные окружения из .env
-load_dotenv()
-
-# ================= НАСТРОЙКИ БОТА =================
-
-# --- Основные ---
-TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
-ALLOWED_USER_ID = int(os.getenv('ALLOWED_USER_ID', 0))
-BOT_VERSION = "30.0 (Stable Architecture)"
-
-# --- Ключи API (Gemini) ---
-API_KEYS = [
-    os.getenv('API_KEY_1'),
-    os.getenv('API_KEY_2'),
-    os.getenv('API_KEY_3')
-]
-# Фильтруем None значения на случай, если какой-то ключ не задан
-API_KEYS = [key for key in API_KEYS if key]
-
-# --- Прокси ---
-PROXY_URL = os.getenv('PROXY_URL')
-
-# --- Имена файлов ---
-STATE_FILE = "state.json"
-PROMPT_FILE = "prompt_template.txt"
-
-# --- Временные интервалы ---
-CHECK_INTERVAL_SECONDS = 60
-REFLECTION_INTERVAL_HOURS = 1
-SILENCE_BEFORE_REFLECTION_HOURS = 0.15
-SILENCE_BEFORE_PROACTIVE_MINUTES = 30
-
-# --- Параметры "человечности" ---
-TYPO_CHANCE = 0.15
-FALLBACK_PHRASES = ["отвлекли щас", "телега подвисла кажется", "подожди", "щас", "сек"]
-
-# --- Проверка критических переменных ---
-if not TELEGRAM_TOKEN:
-    raise ValueError("❌ TELEGRAM_TOKEN не найден в .env файле!")
-if not ALLOWED_USER_ID:
-    raise ValueError("❌ ALLOWED_USER_ID не найден в .env файле!")
-if not API_KEYS:
+import os
+from dotenv import load_dotenv
+
+# Загружаем переменные окружения из .env
+load_dotenv()
+
+# ================= НАСТРОЙКИ БОТА =================
+
+# --- Основные ---
+TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+ALLOWED_USER_ID = int(os.getenv('ALLOWED_USER_ID', 0))
+# Разрешённые чаты через запятую; ALLOWED_USER_ID (личка владельца) разрешён всегда
+ALLOWED_CHAT_IDS = {int(chat_id) for chat_id in os.getenv('ALLOWED_CHAT_IDS', '').split(',') if chat_id.strip()}
+if ALLOWED_USER_ID:
+    ALLOWED_CHAT_IDS.add(ALLOWED_USER_ID)
+BOT_VERSION = "30.0 (Stable Architecture)"
+
+# --- Ключи API (Gemini) ---
+API_KEYS = [
+    os.getenv('API_KEY_1'),
+    os.getenv('API_KEY_2'),
+    os.getenv('API_KEY_3')
+]
+# Фильтруем None значения на случай, если какой-то ключ не задан
+API_KEYS = [key for key in API_KEYS if key]
+
+# --- LLM ---
+# "rest" — нативный async-клиент с пулом соединений, "sdk" — старый google.generativeai в отдельном пуле потоков
+LLM_PROVIDER = os.getenv('LLM_PROVIDER', 'rest')
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-flash-latest')
+# Можно направить на локальную заглушку для тестов
+GEMINI_BASE_URL = os.getenv('GEMINI_BASE_URL', 'https://generativelanguage.googleapis.com')
+LLM_TIMEOUT_SECONDS = 30
+LLM_MAX_CONCURRENCY = 4
+LLM_POOL_SIZE = 10
+# Лимиты на один ключ: запросов в минуту, размер пачки, максимальный кулдаун после ошибок
+KEY_RPM_LIMIT = 15
+KEY_BURST = 3
+KEY_MAX_COOLDOWN_SECONDS = 600
+# Хеджирование: дубль запроса на другой ключ, если ответ задерживается дольше p90 (но не раньше минимума).
+# Потоковый ответ дублируется только до первого куска — по p90 времени до первого куска
+HEDGE_ENABLED = True
+HEDGE_CALL_TYPES = ("chat", "memory")
+HEDGE_MIN_DELAY_SECONDS = 4.0
+HEDGE_MAX_PER_MINUTE = 5
+# Структурированный вывод: responseSchema из bot_schema, модель возвращает валидный JSON
+STRUCTURED_OUTPUT = True
+# Потоковая генерация: первая реплика уходит, как только закрылась её строка в JSON
+STREAMING_ENABLED = True
+
+# --- Контроль нагрузки на модель ---
+# Срок хода диалога: если первая реплика к нему не готова (или модель заведомо не успеет) — фраза-заглушка
+CHAT_DEADLINE_SECONDS = 25
+# Давление: слотов LLM_MAX_CONCURRENCY ждут больше вызовов, чем ADMISSION_PRESSURE_QUEUE, p90 вызовов
+# за окно дольше порога или все ключи недоступны дольше порога — рефлексия, проактивные задачи и хеджи откладываются.
+# Занятые, но не переполненные слоты — обычный ход с ремонтом JSON или хеджем, это ещё не нагрузка
+ADMISSION_PRESSURE_QUEUE = 0
+ADMISSION_SLOW_SECONDS = 10.0
+ADMISSION_KEY_WAIT_SECONDS = 5.0
+ADMISSION_WINDOW_SECONDS = 60
+
+# --- Входящие сообщения ---
+# Серия сообщений, разделённых паузами короче debounce, уходит в модель одним вызовом
+INBOUND_DEBOUNCE_SECONDS = 1.5
+INBOUND_MAX_WAIT_SECONDS = 6.0
+# Сообщение, пришедшее до первой реплики ответа, отменяет генерацию и перезапускает её вместе с собой
+INBOUND_SUPERSEDE = True
+
+# --- Приём обновлений ---
+# "polling" — long polling; "webhook" — свой HTTP-приёмник (можно держать за балансировщиком)
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+# Публичный адрес вебхука для setWebhook; пусто — не регистрировать (например, для нагрузочного теста локально)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token; пусто — случайный на каждый запуск (только вместе с WEBHOOK_URL)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = 40
+# Ограничение очереди принятых, но не обработанных обновлений; сверх него — 503 и повтор от Telegram
+WEBHOOK_QUEUE_SIZE = 1000
+# Сколько последних update_id помнить для отсева повторных доставок
+WEBHOOK_DEDUP_SIZE = 10000
+
+# --- Несколько воркеров ---
+# Имя воркера; пусто — один процесс. Воркеры делят папку chats/ и договариваются через CLUSTER_DB_FILE (только с вебхуком)
+WORKER_ID = os.getenv('WORKER_ID', '')
+# Куда другие воркеры пересылают обновления чатов этого воркера — его собственный вебхук
+WORKER_ADDRESS = os.getenv('WORKER_ADDRESS', f'http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}')
+CLUSTER_DB_FILE = "chats/cluster.db"
+CLUSTER_HEARTBEAT_SECONDS = 2
+# Воркер без пульса дольше этого выпадает из кольца; аренда чата живёт дольше, чтобы прежний владелец успел её отдать
+CLUSTER_WORKER_TTL_SECONDS = 10
+CLUSTER_LEASE_SECONDS = 15
+CLUSTER_VNODES = 64
+
+# --- Исходящие сообщения ---
+# Лимиты Telegram: ~30 сообщений в секунду на бота, ~1 в секунду в чат, 20 в минуту в группу
+OUTBOX_GLOBAL_RATE = 25
+OUTBOX_GLOBAL_BURST = 30
+OUTBOX_CHAT_RATE = 1.0
+OUTBOX_CHAT_BURST = 3
+OUTBOX_GROUP_PER_MINUTE = 20
+# Повторы при сетевых сбоях (RetryAfter ждём сколько скажет Telegram, без лимита попыток)
+OUTBOX_MAX_RETRIES = 3
+# Сколько при остановке досылать очередь без пауз набора
+OUTBOX_SHUTDOWN_TIMEOUT_SECONDS = 5
+
+# --- Метрики ---
+# Локальный /metrics в формате Prometheus; 0 — выключено
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+# Ход диалога дольше этого попадает в лог с разбивкой по этапам
+SLOW_REQUEST_SECONDS = 8.0
+
+# --- Прокси ---
+PROXY_URL = os.getenv('PROXY_URL')
+
+# --- Имена файлов ---
+STATE_FILE = "state.json"
+PROMPT_FILE = "prompt_template.txt"
+
+# --- Хранилище состояния ---
+# "sqlite" — инкрементальная запись в state.db (WAL), при первом запуске импортирует state.json
+# "json" — старый режим: весь state.json переписывается при каждом изменении
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite')
+STATE_DB_FILE = "state.db"
+# Режим записи: "immediate" | "coalesce" | "periodic"
+STATE_DURABILITY = os.getenv('STATE_DURABILITY', 'coalesce')
+STATE_COALESCE_MS = 200
+# Состояние каждого чата лежит в своей папке (у чата ALLOWED_USER_ID — прежние файлы в корне)
+STATE_DIR = "chats"
+# Время ближайшей задачи по каждому чату — по нему планировщик поднимает и выгруженные чаты
+CHAT_WAKEUPS_FILE = "chats/wakeups.json"
+# Сколько чатов держать в памяти и сколько сообщений архива суммарно; холодные выгружаются по LRU
+STATE_MAX_ACTIVE_CHATS = 32
+STATE_MEMORY_BUDGET_MESSAGES = 50000
+STATE_FLUSH_INTERVAL_SECONDS = 30
+# Бинарный снимок индекса памяти: загрузка чата без повторного разбора всего архива (только для sqlite)
+MEMORY_SNAPSHOT_FILE = "memory.idx"
+
+# --- Семантическая память (нужен numpy) ---
+SEMANTIC_INDEX_FILE = "semantic.f32"
+SEMANTIC_DIM = 512
+
+# --- Бюджеты токенов на один вызов модели (оценка локальная, приблизительная) ---
+TOKEN_BUDGETS = {
+    "chat": 6000,
+    "memory": 8000,
+    "reflection": 12000,
+    "repair": 4000,
+    "summary": 6000,
+}
+# Сводки для рефлексии: кусок в сообщениях, сколько сводок сжимается в одну уровнем выше,
+# и сколько новых сводок (вызовов модели) можно создать за одну рефлексию
+SUMMARY_CHUNK_MESSAGES = 50
+SUMMARY_FANOUT = 4
+SUMMARY_MAX_PER_RUN = 3
+# Сколько токенов из бюджета "memory" гарантированно остаётся под найденные воспоминания
+MEMORY_MIN_TOKENS = 2000
+# Вопрос о прошлом без явного "помнишь": параллельно с обычным вызовом готовить ответ с памятью.
+# Экономит второй последовательный вызов, но тратит лишний запрос, если память не понадобилась.
+MEMORY_SPECULATIVE_RECALL = False
+MEMORY_RECALL_LIMIT = 20
+
+# --- Временные интервалы ---
+CHECK_INTERVAL_SECONDS = 60
+# Повтор для наступившей задачи, которую пока нельзя выполнить (ждёт тишины или ответ модели не удался)
+TASK_RETRY_SECONDS = 60
+REFLECTION_INTERVAL_HOURS = 1
+SILENCE_BEFORE_REFLECTION_HOURS = 0.15
+SILENCE_BEFORE_PROACTIVE_MINUTES = 30
+
+# --- Параметры "человечности" ---
+TYPO_CHANCE = 0.15
+FALLBACK_PHRASES = ["отвлекли щас", "телега подвисла кажется", "подожди", "щас", "сек"]
+
+# --- Проверка критических переменных ---
+if not TELEGRAM_TOKEN:
+    raise ValueError("❌ TELEGRAM_TOKEN не найден в .env файле!")
+if not ALLOWED_CHAT_IDS:
+    raise ValueError("❌ Ни ALLOWED_USER_ID, ни ALLOWED_CHAT_IDS не найдены в .env файле!")
+if UPDATE_MODE not in ("polling", "webhook"):
+    raise ValueError(f"❌ Неизвестный UPDATE_MODE: {UPDATE_MODE}")
+if UPDATE_MODE == "webhook" and not WEBHOOK_SECRET and not WEBHOOK_URL:
+    raise ValueError("❌ Для вебхука без WEBHOOK_URL нужен WEBHOOK_SECRET — иначе в него некому будет писать!")
+if WORKER_ID and (UPDATE_MODE != "webhook" or not WEBHOOK_SECRET):
+    raise ValueError("❌ Несколько воркеров работают только с вебхуком и общим WEBHOOK_SECRET!")
+if not API_KEYS:
     raise ValueError("❌ API ключи не найдены в .env файле!")
\ No newline at end of file
@@ -1,60 +1,293 @@
-# --- START OF FILE main.py ---
-
-import logging
-import os
-from telegram.ext import ApplicationBuilder, MessageHandler, filters
-
-import config
-from bot_state import StateManager
-import bot_ai
-from bot_handlers import handle_message, background_tasks
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO, 
-    format='%(asctime)s | %(levelname)s | %(name)s | %(message)s', 
-    datefmt='%Y-%m-%d %H:%M:%S', 
-    handlers=[logging.StreamHandler()]
-)
-logging.getLogger("httpx").setLevel(logging.WARNING)
-logging.getLogger("telegram.ext").setLevel(logging.INFO)
-
-logger = logging.getLogger(__name__)
-
-def main():
-    # Проверки перед запуском
-    if not os.path.exists(config.PROMPT_FILE): 
-        logger.critical(f"❌ Файл промпта '{config.PROMPT_FILE}' не найден!"); return
-    if not config.TELEGRAM_TOKEN or "YOUR_TOKEN" in config.TELEGRAM_TOKEN: 
-        logger.critical("❌ TELEGRAM_TOKEN не установлен!"); return
-    if not bot_ai.init_ai(config.API_KEYS): 
-        logger.critical("❌ Не удалось инициализировать модель Gemini."); return
-
-    # Настройка прокси
-    os.environ['http_proxy'] = config.PROXY_URL
-    os.environ['https_proxy'] = config.PROXY_URL
-    os.environ['HTTP_PROXY'] = config.PROXY_URL
-    os.environ['HTTPS_PROXY'] = config.PROXY_URL
-    
-    # Инициализация состояния
-    state_manager = StateManager(config.STATE_FILE)
-    
-    app = ApplicationBuilder().token(config.TELEGRAM_TOKEN).build()
-    
-    # Dependency Injection: Передаем зависимости в bot_data
-    # Это разрывает круг импортов: handlers не нужно импортировать bot_ai напрямую
-    app.bot_data["state_manager"] = state_manager
-    app.bot_data["process_user_input"] = bot_ai.process_user_input
-    app.bot_data["retrieve_memory"] = bot_ai.retrieve_memory
-    app.bot_data["generate_reflection"] = bot_ai.generate_reflection
-
-    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message))
-    
-    if app.job_queue:
-        app.job_queue.run_repeating(background_tasks, interval=config.CHECK_INTERVAL_SECONDS, first=10)
-    
-    logger.info(f"🚀 Бот v{config.BOT_VERSION} запущен.")
-    app.run_polling()
-
-if __name__ == '__main__':
+# --- START OF FILE main.py ---
+
+import time
+# Отсчёт для --profile-startup: импорты ниже — первая фаза холодного старта
+STARTED = time.perf_counter()
+
+import logging
+import os
+import signal
+import asyncio
+import secrets
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update
+from telegram.ext import ApplicationBuilder, MessageHandler, TypeHandler, filters
+
+import config
+from bot_state import StateManager
+from bot_registry import ChatStateRegistry
+from bot_scheduler import TaskScheduler
+from bot_outbox import OutboundDispatcher
+from bot_webhook import WebhookReceiver
+from bot_cluster import ChatCluster, ClusterStore
+from bot_storage import create_backend
+import bot_ai
+import bot_metrics
+from bot_handlers import ChatInbox, handle_message, background_tasks, run_due_tasks
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO, 
+    format='%(asctime)s | %(levelname)s | %(name)s | %(message)s', 
+    datefmt='%Y-%m-%d %H:%M:%S', 
+    handlers=[logging.StreamHandler()]
+)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("telegram.ext").setLevel(logging.INFO)
+
+logger = logging.getLogger(__name__)
+
+def build_state_manager(chat_id):
+    # Старые файлы единственного чата остаются на месте — миграция не нужна
+    directory = "." if chat_id == config.ALLOWED_USER_ID else os.path.join(config.STATE_DIR, str(chat_id))
+    os.makedirs(directory, exist_ok=True)
+    state_file = os.path.join(directory, config.STATE_FILE)
+    return StateManager(
+        state_file,
+        backend=create_backend(config.STATE_BACKEND, state_file, os.path.join(directory, config.STATE_DB_FILE)),
+        durability=config.STATE_DURABILITY,
+        coalesce_ms=config.STATE_COALESCE_MS,
+        flush_interval=config.STATE_FLUSH_INTERVAL_SECONDS,
+        semantic_index_file=os.path.join(directory, config.SEMANTIC_INDEX_FILE),
+        semantic_dim=config.SEMANTIC_DIM,
+        memory_snapshot_file=os.path.join(directory, config.MEMORY_SNAPSHOT_FILE),
+    )
+
+def build_cluster(chat_registry, outbox, get_scheduler):
+    """Несколько процессов: чаты делятся по консистентному хешу и обслуживаются только под арендой."""
+    async def on_acquire(chat_id):
+        # Чат поднимаем сразу — так планировщик узнаёт о его задачах
+        try:
+            async with chat_registry.use(chat_id):
+                pass
+        except Exception:
+            logger.error(f"💥 [CLUSTER] Не удалось загрузить чат {chat_id}!", exc_info=True)
+
+    def on_release(chat_id):
+        if task_scheduler := get_scheduler():
+            task_scheduler.update(chat_id, None)
+
+    def on_membership(workers):
+        # Лимит Telegram общий на бота — делим его между живыми воркерами
+        outbox.global_bucket.rate = config.OUTBOX_GLOBAL_RATE / workers
+
+    os.makedirs(os.path.dirname(config.CLUSTER_DB_FILE), exist_ok=True)
+    cluster = ChatCluster(
+        ClusterStore(config.CLUSTER_DB_FILE),
+        config.WORKER_ID,
+        config.WORKER_ADDRESS,
+        config.ALLOWED_CHAT_IDS,
+        chat_registry,
+        lease_seconds=config.CLUSTER_LEASE_SECONDS,
+        heartbeat_seconds=config.CLUSTER_HEARTBEAT_SECONDS,
+        worker_ttl=config.CLUSTER_WORKER_TTL_SECONDS,
+        vnodes=config.CLUSTER_VNODES,
+        on_acquire=on_acquire,
+        on_release=on_release,
+        on_membership=on_membership,
+    )
+    chat_registry.before_load = cluster.before_load
+    chat_registry.owner_check = cluster.serves
+    chat_registry.lease_check = cluster.holds_lease
+    return cluster
+
+def start_ai_init(profile):
+    """
+    Клиент модели строится в фоновом потоке, параллельно с подключением к Telegram; следом там же
+    прогреваются ленивые импорты. Возвращает future готовности клиента — её ждёт post_init.
+    """
+    def init():
+        with profile.overlapped("ai_init"):
+            return bot_ai.init_ai(config.API_KEYS)
+
+    def warm_up():
+        with profile.overlapped("warm_up"):
+            bot_ai.warm_up()
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="startup")
+    ai_ready = executor.submit(init)
+    executor.submit(warm_up)
+    executor.shutdown(wait=False)
+    return ai_ready
+
+def run_webhook(app, router=None):
+    """Жизненный цикл приложения без Updater: обновления приходят в WebhookReceiver вместо long polling."""
+    secret = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    receiver = WebhookReceiver(app.bot, app.update_queue, secret, path=config.WEBHOOK_PATH,
+                               dedup_size=config.WEBHOOK_DEDUP_SIZE, router=router)
+
+    async def serve():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            loop.add_signal_handler(sig, stop.set)
+        await app.initialize()
+        try:
+            if app.post_init:
+                await app.post_init(app)
+            server = await receiver.start(config.WEBHOOK_LISTEN, config.WEBHOOK_PORT)
+            if config.WEBHOOK_URL:
+                await app.bot.set_webhook(config.WEBHOOK_URL, secret_token=secret, max_connections=config.WEBHOOK_MAX_CONNECTIONS)
+                logger.info(f"🌐 [WEBHOOK] Вебхук зарегистрирован: {config.WEBHOOK_URL}")
+            await app.start()
+            await stop.wait()
+            # Новые обновления больше не принимаем; уже принятые app.stop дообработает
+            server.close()
+            await receiver.close()
+            await app.stop()
+        finally:
+            await app.shutdown()
+            if app.post_shutdown:
+                await app.post_shutdown(app)
+
+    asyncio.run(serve())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Telegram-бот с памятью и настроением.")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="вывести длительность фаз запуска до первого обновления")
+    args = parser.parse_args(argv)
+    profile = bot_metrics.StartupProfile(STARTED, enabled=args.profile_startup)
+    profile.mark("imports")
+
+    # Проверки перед запуском
+    if not os.path.exists(config.PROMPT_FILE): 
+        logger.critical(f"❌ Файл промпта '{config.PROMPT_FILE}' не найден!"); return
+    if not config.TELEGRAM_TOKEN or "YOUR_TOKEN" in config.TELEGRAM_TOKEN: 
+        logger.critical("❌ TELEGRAM_TOKEN не установлен!"); return
+
+    # Настройка прокси
+    os.environ['http_proxy'] = config.PROXY_URL
+    os.environ['https_proxy'] = config.PROXY_URL
+    os.environ['HTTP_PROXY'] = config.PROXY_URL
+    os.environ['HTTPS_PROXY'] = config.PROXY_URL
+
+    ai_ready = start_ai_init(profile)
+    
+    # Инициализация состояния: отдельный StateManager на чат, загружается по первому сообщению
+    os.makedirs(config.STATE_DIR, exist_ok=True)
+    chat_registry = ChatStateRegistry(
+        build_state_manager,
+        config.ALLOWED_CHAT_IDS,
+        max_active=config.STATE_MAX_ACTIVE_CHATS,
+        memory_budget=config.STATE_MEMORY_BUDGET_MESSAGES,
+    )
+    task_scheduler = None
+
+    chat_inbox = ChatInbox(
+        debounce=config.INBOUND_DEBOUNCE_SECONDS,
+        max_wait=config.INBOUND_MAX_WAIT_SECONDS,
+        supersede=config.INBOUND_SUPERSEDE,
+    )
+
+    metrics_server = None
+    owner_preload = None
+
+    async def preload_owner_chat():
+        with profile.overlapped("owner_preload"):
+            try:
+                async with chat_registry.use(config.ALLOWED_USER_ID):
+                    pass
+            except Exception:
+                logger.error(f"💥 Не удалось загрузить чат {config.ALLOWED_USER_ID}!", exc_info=True)
+
+    async def post_init(application):
+        nonlocal metrics_server, owner_preload
+        profile.mark("telegram_init")
+        if not await asyncio.wrap_future(ai_ready):
+            logger.critical("❌ Не удалось инициализировать модель Gemini.")
+            raise SystemExit(1)
+        profile.mark("ai_init_wait")
+        if config.METRICS_PORT:
+            try:
+                metrics_server = await bot_metrics.start_metrics_server(config.METRICS_HOST, config.METRICS_PORT)
+            except OSError as e:
+                logger.error(f"❌ [METRICS] Не удалось открыть порт {config.METRICS_PORT}: {e}")
+        if cluster:
+            await cluster.start()
+        # Чат владельца поднимаем сразу, если планировщик ещё не знает о его задачах (первый запуск после обновления).
+        # В фоне: приём обновлений не ждёт загрузки архива
+        elif task_scheduler and config.ALLOWED_USER_ID and config.ALLOWED_USER_ID not in task_scheduler.wakeups:
+            owner_preload = asyncio.create_task(preload_owner_chat())
+        profile.mark("post_init")
+
+    async def post_shutdown(application):
+        if metrics_server is not None:
+            metrics_server.close()
+        if owner_preload is not None:
+            await asyncio.gather(owner_preload, return_exceptions=True)
+        await chat_inbox.close()
+        if task_scheduler:
+            await task_scheduler.close()
+        await outbox.close(timeout=config.OUTBOX_SHUTDOWN_TIMEOUT_SECONDS)
+        if cluster:
+            await cluster.close()
+        await bot_ai.shutdown_ai()
+        await chat_registry.close()
+    
+    # Порядок внутри чата держит ChatInbox, поэтому разные чаты обрабатываются параллельно
+    builder = ApplicationBuilder().token(config.TELEGRAM_TOKEN).concurrent_updates(True).post_init(post_init).post_shutdown(post_shutdown)
+    if config.UPDATE_MODE == "webhook":
+        # Updater не нужен: обновления кладёт WebhookReceiver, очередь ограничена, чтобы всплеск не съел память
+        builder = builder.updater(None).update_queue(asyncio.Queue(maxsize=config.WEBHOOK_QUEUE_SIZE))
+    app = builder.build()
+
+    # Все отправки — через очереди чатов с паузами набора и лимитами Telegram; обработчики их не ждут
+    outbox = OutboundDispatcher(
+        app.bot,
+        global_rate=config.OUTBOX_GLOBAL_RATE,
+        global_burst=config.OUTBOX_GLOBAL_BURST,
+        chat_rate=config.OUTBOX_CHAT_RATE,
+        chat_burst=config.OUTBOX_CHAT_BURST,
+        group_rate=config.OUTBOX_GROUP_PER_MINUTE / 60,
+        max_retries=config.OUTBOX_MAX_RETRIES,
+    )
+    
+    # Dependency Injection: Передаем зависимости в bot_data
+    # Это разрывает круг импортов: handlers не нужно импортировать bot_ai напрямую
+    app.bot_data["chat_registry"] = chat_registry
+    app.bot_data["chat_inbox"] = chat_inbox
+    app.bot_data["outbox"] = outbox
+
+    cluster = None
+    if config.WORKER_ID:
+        cluster = build_cluster(chat_registry, outbox, lambda: task_scheduler)
+    app.bot_data["process_user_input"] = bot_ai.process_user_input
+    app.bot_data["retrieve_memory"] = bot_ai.retrieve_memory
+    app.bot_data["respond_to_user"] = bot_ai.respond_to_user
+    app.bot_data["generate_reflection"] = bot_ai.generate_reflection
+    app.bot_data["admission"] = bot_ai.admission
+
+    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message))
+    
+    if app.job_queue:
+        # Напоминания — по таймеру на ближайшую задачу; минутный тик остался только для рефлексии
+        task_scheduler = TaskScheduler(
+            app.job_queue, run_due_tasks,
+            # У нескольких воркеров общего файла нет: пробуждения чата восстанавливаются при получении его аренды
+            wakeups_file=None if cluster else config.CHAT_WAKEUPS_FILE,
+            retry_seconds=config.TASK_RETRY_SECONDS,
+        )
+        chat_registry.on_load = task_scheduler.attach
+        app.job_queue.run_repeating(background_tasks, interval=config.CHECK_INTERVAL_SECONDS, first=10)
+    else:
+        logger.warning("⚠️ JobQueue недоступна — напоминания и фоновые задачи отключены.")
+    
+    if args.profile_startup:
+        async def on_first_update(update, context):
+            profile.mark("first_update")
+            profile.report()
+        # Группа -1 — раньше основного обработчика; обновление идёт дальше как обычно
+        app.add_handler(TypeHandler(Update, on_first_update), group=-1)
+
+    profile.mark("app_build")
+    logger.info(f"🚀 Бот v{config.BOT_VERSION} запущен.")
+    if config.UPDATE_MODE == "webhook":
+        run_webhook(app, router=cluster.route if cluster else None)
+    else:
+        # run_polling перехватывает SIGINT/SIGTERM/SIGABRT и вызывает post_shutdown -> финальный сброс состояния
+        app.run_polling(stop_signals=(signal.SIGINT, signal.SIGTERM, signal.SIGABRT))
+
+if __name__ == '__main__':
     main()
\ No newline at end of file
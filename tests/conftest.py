@@ -0,0 +1,9 @@
+import os
+import sys
+
+# config проверяет обязательные переменные при импорте — для тестов хватает фиктивных
+os.environ.setdefault("TELEGRAM_TOKEN", "123:test")
+os.environ.setdefault("ALLOWED_USER_ID", "1")
+os.environ.setdefault("API_KEY_1", "test-key")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
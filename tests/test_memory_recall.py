@@ -0,0 +1,30 @@
+import asyncio
+
+import bot_ai
+from bot_state import StateManager
+from bot_storage import SqliteStateBackend, CHAT_HISTORY_LIMIT
+
+
+def open_state(tmp_path):
+    return StateManager(str(tmp_path / "state.json"), backend=SqliteStateBackend(str(tmp_path / "state.db")))
+
+
+def test_recall_skips_history_after_restart(tmp_path):
+    async def fill():
+        state_manager = open_state(tmp_path)
+        await state_manager.add_history("user", "мой кот рыжик любит рыбу")
+        for i in range(CHAT_HISTORY_LIMIT):
+            await state_manager.add_history("user" if i % 2 else "model", f"болтовня номер {i}")
+        await state_manager.add_history("user", "помнишь, как зовут моего кота?")
+        await state_manager.close()
+
+    asyncio.run(fill())
+    # Заново открытое состояние: история и документы индекса — разные словари
+    state_manager = open_state(tmp_path)
+    try:
+        history = {m["content"] for m in state_manager.state["chat_history"]}
+        hits = [m["content"] for m in bot_ai.find_memories("кот", state_manager)]
+        assert hits == ["мой кот рыжик любит рыбу"]
+        assert not history & {m["content"] for m in bot_ai.find_memories("болтовня", state_manager, limit=100)}
+    finally:
+        state_manager.backend.close()
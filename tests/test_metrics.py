@@ -0,0 +1,23 @@
+import asyncio
+
+import bot_ai
+import bot_metrics
+from bot_llm import KeyPool
+
+
+def test_per_key_series_are_exported(monkeypatch):
+    monkeypatch.setattr(bot_ai, "key_pool", KeyPool(["key-a", "key-b"]))
+
+    async def run():
+        first = await bot_ai.key_pool.acquire()
+        second = await bot_ai.key_pool.acquire(exclude={first.index})
+        bot_ai.key_pool.release(second, "quota")
+        return first, second
+
+    first, second = asyncio.run(run())
+    text = bot_metrics.render_metrics()
+    assert f'bot_key_in_flight{{key="{first.label}"}} 1' in text
+    assert f'bot_key_in_flight{{key="{second.label}"}} 0' in text
+    assert f'bot_llm_key_errors_total{{key="{second.label}",kind="quota"}} 1' in text
+    assert f'bot_llm_key_requests_total{{key="{first.label}"}} 1' in text
+    assert f'bot_key_cooldown_seconds{{key="{second.label}"}} 30.0' in text
@@ -0,0 +1,40 @@
+import asyncio
+
+from bot_outbox import OutboundDispatcher
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+    async def send_chat_action(self, chat_id, action):
+        pass
+
+
+def run_two_chats(idle_seconds):
+    outbox = OutboundDispatcher(FakeBot(), chat_rate=1000.0, idle_seconds=idle_seconds)
+
+    async def run():
+        outbox.send(1, "привет")
+        await outbox.join()
+        await asyncio.sleep(0.02)
+        outbox.send(2, "привет")
+        await outbox.join()
+
+    asyncio.run(run())
+    return outbox
+
+
+def test_idle_chat_state_is_dropped():
+    outbox = run_two_chats(idle_seconds=0.01)
+    assert 1 not in outbox._buckets and 1 not in outbox._last_sent
+    assert not outbox._queues and not outbox._workers
+
+
+def test_recent_chat_state_is_kept():
+    # Пауза набора следующей реплики отсчитывается от прошлой — свежий чат забывать нельзя
+    outbox = run_two_chats(idle_seconds=60.0)
+    assert 1 in outbox._buckets and 1 in outbox._last_sent
@@ -0,0 +1,37 @@
+import os
+
+import config
+from bot_prompt import PromptBuilder
+
+
+class FakeStateManager:
+    def __init__(self, history):
+        self.state = {"chat_history": history}
+
+
+def turn_fields(msk_time, tasks, thoughts):
+    return dict(memory_context_block="", system_alert="", msk_time=msk_time, mood_instr="ТВОЕ СОСТОЯНИЕ: нормальное",
+                thoughts_block=thoughts, task_execution_block="", user_text="привет", existing_tasks=tasks)
+
+
+def test_turns_a_minute_apart_reuse_prefix():
+    builder = PromptBuilder(os.path.join(os.path.dirname(os.path.dirname(__file__)), config.PROMPT_FILE))
+    state_manager = FakeStateManager([{"role": "user", "content": "привет"}])
+
+    first = builder.build(state_manager, **turn_fields("12:00", "Список пуст.", ""))
+    second = builder.build(state_manager, **turn_fields("12:01", "- [low] спросить про сон", "<BACKGROUND_THOUGHTS>мысль</BACKGROUND_THOUGHTS>"))
+
+    assert len(builder._prefix_cache) == 1
+    prefix = next(iter(builder._prefix_cache.values()))
+    assert first.startswith(prefix) and second.startswith(prefix)
+    assert "</SYSTEM>" in prefix
+    assert "12:01" in second and "спросить про сон" in second and "мысль" in second
+
+
+def test_prefix_varies_with_mood():
+    builder = PromptBuilder(os.path.join(os.path.dirname(os.path.dirname(__file__)), config.PROMPT_FILE))
+    state_manager = FakeStateManager([])
+    fields = turn_fields("12:00", "Список пуст.", "")
+    builder.build(state_manager, **fields)
+    builder.build(state_manager, **{**fields, "mood_instr": "ТВОЕ СОСТОЯНИЕ: уставшее"})
+    assert len(builder._prefix_cache) == 2
@@ -0,0 +1,45 @@
+import json
+import sqlite3
+
+import pytest
+
+from bot_storage import SqliteStateBackend
+
+
+class FailingCommit:
+    """Соединение, у которого COMMIT падает, — как при ошибке диска посреди сброса."""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, *args):
+        if sql == "COMMIT":
+            raise sqlite3.OperationalError("disk I/O error")
+        return self.conn.execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.conn.executemany(sql, *args)
+
+
+def tasks_payload(*task_ids):
+    return [], {}, [(task_id, position, json.dumps({"id": task_id})) for position, task_id in enumerate(task_ids)]
+
+
+def stored_task_ids(backend):
+    return {task_id for task_id, in backend.conn.execute("SELECT id FROM tasks")}
+
+
+def test_failed_task_sync_is_retried(tmp_path):
+    backend = SqliteStateBackend(str(tmp_path / "state.db"))
+    backend.write(tasks_payload("a", "b"))
+
+    conn = backend.conn
+    backend.conn = FailingCommit(conn)
+    with pytest.raises(sqlite3.OperationalError):
+        backend.write(tasks_payload("a"))
+    backend.conn = conn
+    assert stored_task_ids(backend) == {"a", "b"}
+
+    # Повторный сброс того же списка должен всё-таки удалить "b"
+    backend.write(tasks_payload("a"))
+    assert stored_task_ids(backend) == {"a"}
+    backend.close()
@@ -0,0 +1,44 @@
+import asyncio
+
+import bot_ai
+import config
+from bot_llm import KeyPool, HedgeLimiter
+
+
+class FakeClient:
+    """Поток на ключе "slow" начинается через секунду, на "fast" — сразу."""
+    def __init__(self):
+        self.cancelled = []
+
+    async def stream(self, prompt, temperature, api_key, response_schema=None):
+        try:
+            if api_key == "slow":
+                await asyncio.sleep(1.0)
+            for chunk in (f"{api_key}-1", f"{api_key}-2"):
+                yield chunk
+                await asyncio.sleep(0.01)
+        except asyncio.CancelledError:
+            self.cancelled.append(api_key)
+            raise
+
+
+def test_stream_is_hedged_before_first_chunk(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(bot_ai, "llm_client", client)
+    monkeypatch.setattr(bot_ai, "key_pool", KeyPool(["slow", "fast"]))
+    monkeypatch.setattr(bot_ai, "hedge_limiter", HedgeLimiter(5))
+    monkeypatch.setattr(config, "HEDGE_MIN_DELAY_SECONDS", 0.05)
+    chunks = []
+
+    async def on_chunk(chunk):
+        chunks.append(chunk)
+
+    async def run():
+        primary = await bot_ai.key_pool.acquire(exclude={1})
+        return await bot_ai._hedged_stream("промпт", 0.8, primary, "chat", None, on_chunk)
+
+    received, error_kind = asyncio.run(run())
+    assert error_kind is None
+    assert received == chunks == ["fast-1", "fast-2"]
+    assert client.cancelled == ["slow"]
+    assert all(k.in_flight == 0 for k in bot_ai.key_pool.keys)
@@ -0,0 +1,58 @@
+import json
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import config
+from bot_handlers import ReplySender
+from bot_json import StreamingRepliesParser
+from bot_schema import Decision
+
+
+class FakeOutbox:
+    def __init__(self):
+        self.texts = []
+
+    def send(self, chat_id, text, **kwargs):
+        self.texts.append(text)
+
+
+class FakeStateManager:
+    async def add_history(self, role, text):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def no_typos(monkeypatch):
+    monkeypatch.setattr(config, "TYPO_CHANCE", 0.0)
+
+
+def stream_then_tail(raw):
+    """Реплики из потока, затем хвост из Decision — как в handle_chat_turn."""
+    outbox = FakeOutbox()
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=1, type="private"), message=SimpleNamespace(message_id=1))
+    sender = ReplySender(update, SimpleNamespace(bot_data={"outbox": outbox}), FakeStateManager())
+
+    async def run():
+        parser = StreamingRepliesParser()
+        for ch in raw:
+            for reply in parser.feed(ch):
+                await sender.on_reply(reply)
+        for item in sender.unsent(Decision.from_dict(json.loads(raw)).replies):
+            await sender.enqueue(item)
+
+    asyncio.run(run())
+    return outbox.texts
+
+
+@pytest.mark.parametrize("replies, expected", [
+    (["привет", "", "как дела"], ["привет", "как дела"]),
+    (["привет", {"text": "давно не виделись"}, "как дела"], ["привет", "давно не виделись", "как дела"]),
+    (["привет", {"mood": "ok", "text": "давно не виделись"}, {"text": 5}, "как дела"],
+     ["привет", "давно не виделись", "как дела"]),
+    (["ага", {"text": "ага"}, "ага"], ["ага", "ага", "ага"]),
+])
+def test_tail_sends_each_reply_once(replies, expected):
+    raw = json.dumps({"replies": replies, "mood_shift": 0.1}, ensure_ascii=False)
+    assert stream_then_tail(raw) == expected
@@ -0,0 +1,97 @@
+# --- START OF FILE webhook_client.py ---
+"""
+Локальный клиент вебхука: шлёт синтетические обновления в запущенный бот (UPDATE_MODE=webhook)
+без сети Telegram и меряет время подтверждения — нагрузочный тест приёма.
+
+    python webhook_client.py --url http://127.0.0.1:8443/telegram --secret $WEBHOOK_SECRET --count 500 --concurrency 20
+
+Чаты должны быть в ALLOWED_CHAT_IDS, иначе обновления примутся, но обработчик их отбросит.
+"""
+
+import sys
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter
+
+import httpx
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+TEXTS = ["привет", "как дела?", "что делаешь", "ахах", "ну и денёк", "помнишь, что я говорил вчера?", "ок"]
+
+
+def synthetic_update(update_id, chat_id, rng):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "from": {"id": abs(chat_id), "is_bot": False, "first_name": "Bench"},
+            "text": rng.choice(TEXTS),
+        },
+    }
+
+
+def _percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else None
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    queue = asyncio.Queue()
+    first_id = args.first_update_id
+    for update_id in range(first_id, first_id + args.count):
+        update = synthetic_update(update_id, rng.choice(args.chats), rng)
+        queue.put_nowait(update)
+        if rng.random() < args.duplicate_rate:
+            # Повторная доставка того же update_id, как при таймауте у Telegram
+            queue.put_nowait(update)
+
+    statuses = Counter()
+    latencies = []
+
+    async def worker(client):
+        while not queue.empty():
+            update = queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                response = await client.post(args.url, json=update, headers={SECRET_HEADER: args.secret})
+                statuses[response.status_code] += 1
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=10.0, trust_env=False) as client:
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    total = sum(statuses.values())
+    print(f"запросов: {total} за {elapsed:.2f} s ({total / elapsed:.0f}/s), ответы: "
+          + ", ".join(f"{status} × {count}" for status, count in sorted(statuses.items(), key=str)))
+    if latencies:
+        print("подтверждение, ms: " + "  ".join(
+            f"{name} {_percentile(latencies, q) * 1000:.1f}" for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+        ) + f"  max {max(latencies) * 1000:.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Синтетические обновления в локальный вебхук бота.")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret", required=True)
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--chats", type=int, nargs="+", default=[1], help="id чатов, из которых идут сообщения")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="доля обновлений, отправленных дважды")
+    parser.add_argument("--first-update-id", type=int, default=int(time.time()))
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])